@@ -24,7 +24,7 @@ if config.config_file_name is not None:
 base_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
 sys.path.append(base_dir)
 from models import *
-from database import Base, SQLALCHEMY_DATABASE_URL
+from database import Base, SQLALCHEMY_DATABASE_URL, engine_options
 
 target_metadata = Base.metadata
 
@@ -66,7 +66,7 @@ def run_migrations_online() -> None:
     and associate a connection with the context.
 
     """
-    connectable = create_engine(SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False})
+    connectable = create_engine(SQLALCHEMY_DATABASE_URL, **engine_options(SQLALCHEMY_DATABASE_URL, is_async=False))
 
     with connectable.connect() as connection:
         context.configure(
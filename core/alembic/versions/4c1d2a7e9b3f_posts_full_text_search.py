@@ -0,0 +1,43 @@
+"""posts full text search
+
+Revision ID: 4c1d2a7e9b3f
+Revises: bfca5b75fec9
+Create Date: 2026-10-17 10:12:31.418265
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '4c1d2a7e9b3f'
+down_revision = 'bfca5b75fec9'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.execute("CREATE VIRTUAL TABLE posts_fts USING fts5(title, description, content='posts', content_rowid='id')")
+    op.execute(
+        "CREATE TRIGGER posts_fts_insert AFTER INSERT ON posts BEGIN "
+        "INSERT INTO posts_fts(rowid, title, description) VALUES (new.id, new.title, new.description); END"
+    )
+    op.execute(
+        "CREATE TRIGGER posts_fts_delete AFTER DELETE ON posts BEGIN "
+        "INSERT INTO posts_fts(posts_fts, rowid, title, description) "
+        "VALUES ('delete', old.id, old.title, old.description); END"
+    )
+    op.execute(
+        "CREATE TRIGGER posts_fts_update AFTER UPDATE ON posts BEGIN "
+        "INSERT INTO posts_fts(posts_fts, rowid, title, description) "
+        "VALUES ('delete', old.id, old.title, old.description); "
+        "INSERT INTO posts_fts(rowid, title, description) VALUES (new.id, new.title, new.description); END"
+    )
+    # Index the posts written before the migration
+    op.execute("INSERT INTO posts_fts(posts_fts) VALUES ('rebuild')")
+
+
+def downgrade() -> None:
+    op.execute("DROP TRIGGER posts_fts_update")
+    op.execute("DROP TRIGGER posts_fts_delete")
+    op.execute("DROP TRIGGER posts_fts_insert")
+    op.execute("DROP TABLE posts_fts")
@@ -0,0 +1,27 @@
+"""authors post count
+
+Revision ID: 9e2f6b1c5a47
+Revises: 4c1d2a7e9b3f
+Create Date: 2026-10-17 11:02:54.730114
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9e2f6b1c5a47'
+down_revision = '4c1d2a7e9b3f'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column('authors', sa.Column('post_count', sa.Integer(), server_default='0', nullable=False))
+    # Count the posts written before the migration
+    op.execute("UPDATE authors SET post_count = (SELECT COUNT(*) FROM posts WHERE posts.owner_id = authors.id)")
+
+
+def downgrade() -> None:
+    with op.batch_alter_table('authors') as batch_op:
+        batch_op.drop_column('post_count')
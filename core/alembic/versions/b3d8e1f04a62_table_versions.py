@@ -0,0 +1,30 @@
+"""table versions
+
+Revision ID: b3d8e1f04a62
+Revises: 9e2f6b1c5a47
+Create Date: 2026-10-17 15:21:08.418392
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b3d8e1f04a62'
+down_revision = '9e2f6b1c5a47'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    table_versions = op.create_table(
+        'table_versions',
+        sa.Column('name', sa.String(), nullable=False),
+        sa.Column('version', sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint('name'),
+    )
+    op.bulk_insert(table_versions, [{'name': 'authors', 'version': 0}, {'name': 'posts', 'version': 0}])
+
+
+def downgrade() -> None:
+    op.drop_table('table_versions')
@@ -0,0 +1,119 @@
+"""
+Group commit of the post creations
+"""
+import asyncio
+import logging
+from typing import Optional
+
+from sqlalchemy.orm import sessionmaker
+
+import crud
+import models
+import schemas
+from config.settings import settings
+from database import AsyncSessionLocal
+
+logger = logging.getLogger(__name__)
+
+
+class PostWriter:
+    """
+    Single task writing the posts created concurrently. SQLite has one writer at a time, so instead of every request
+    committing its own transaction and waiting for the lock, the requests queue their post and the task writes them
+    in batches, one transaction (and one commit) per batch. Each request still gets its own post or error back.
+    """
+
+    def __init__(self, session_factory: sessionmaker, batch_size: int, window_seconds: float, queue_size: int):
+        self.session_factory = session_factory
+        self.batch_size = batch_size
+        self.window_seconds = window_seconds
+        self.queue_size = queue_size
+        self.batches = 0
+        self.written = 0
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        """
+        Start the writer task on the running event loop
+        """
+        if self._task is None:
+            self._queue = asyncio.Queue(self.queue_size)
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """
+        Write the queued posts, then stop the task
+        """
+        if self._task is not None:
+            await self._queue.put(None)
+            await self._task
+            self._task = self._queue = None
+
+    async def create(self, post: schemas.PostCreate, author_id: int) -> models.Posts:
+        """
+        Create a post with the next batch
+        :param post: the infos about the new post
+        :param author_id: id of the current author/user
+        :return: the created post, or raises the error its insert raised
+        """
+        self.start()
+        created = asyncio.get_running_loop().create_future()
+        await self._queue.put((post, author_id, created))
+        return await created
+
+    async def _run(self):
+        stopping = False
+        while not stopping:
+            item = await self._queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = asyncio.get_running_loop().time() + self.window_seconds
+            # Collect what comes in during the window, the queue fills up while the previous batch is written
+            while len(batch) < self.batch_size:
+                try:
+                    item = self._queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    remaining = deadline - asyncio.get_running_loop().time()
+                    if remaining <= 0:
+                        break
+                    await asyncio.sleep(remaining)
+                    continue
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            await self._write(batch)
+
+    async def _write(self, batch: list):
+        try:
+            async with self.session_factory() as db:
+                results = await crud.create_posts_of_authors(db, [(post, author_id) for post, author_id, _ in batch])
+        except Exception as error:
+            logger.exception("Writing a batch of %s posts failed", len(batch))
+            results = [error] * len(batch)
+        self.batches += 1
+        for (_, _, created), result in zip(batch, results):
+            if created.done():
+                continue
+            if isinstance(result, Exception):
+                created.set_exception(result)
+            else:
+                self.written += 1
+                created.set_result(result)
+
+    def stats(self) -> dict:
+        """
+        Usage of the writer
+        :return: dict with the queue length and counters
+        """
+        return {
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "batches_total": self.batches,
+            "written_total": self.written,
+        }
+
+
+post_writer = PostWriter(AsyncSessionLocal, settings.POST_WRITE_BATCH_SIZE, settings.POST_WRITE_BATCH_WINDOW_MS / 1000,
+                         settings.POST_WRITE_QUEUE_SIZE)
@@ -0,0 +1,454 @@
+"""
+Benchmark of every route of the app, run in process against a synthetic SQLite database
+
+    python benchmark.py --authors 100 --posts-per-author 20 --requests 200 --concurrency 16 --output bench.json
+
+With --fixture, the database is a copy of one generated by seed.py instead, e.g. millions of posts with a skewed
+number of posts per author.
+
+With --workers N, the app is served by serve.py with N workers and called over HTTP instead, to measure the
+throughput of a deployment (the SQL queries per request are then not counted).
+
+The results (latency percentiles, requests per second and SQL queries per request of every route) are written as JSON.
+Given the results of a previous run with --baseline, the routes whose p95 latency grew by more than --max-regression
+are reported and the exit code is 1, so a commit slowing a route down can be caught before it is deployed.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Callable, NamedTuple, Optional
+from urllib.parse import urlencode
+
+from seed import read_manifest, seed_database
+
+BENCHMARK_PASSWORD = "benchmark-password"
+# Routes whose response never ends, they can't be timed as requests
+ENDLESS_ROUTES = {("GET", "/posts/stream")}
+
+
+class ASGIClient:
+    """
+    Minimal HTTP client calling an ASGI app directly, without sockets
+    """
+
+    def __init__(self, app, host: str = "localhost"):
+        self.app = app
+        self.host = host
+
+    async def request(self, method: str, path: str, headers: Optional[dict] = None, body: bytes = b""):
+        """
+        Send a request to the app
+        :param method: HTTP method
+        :param path: path with its query string
+        :param headers: request headers
+        :param body: request body
+        :return: tuple of the status code and the response body
+        """
+        path, _, query_string = path.partition("?")
+        raw_headers = [(b"host", self.host.encode()), (b"content-length", str(len(body)).encode())]
+        raw_headers += [(name.lower().encode(), value.encode()) for name, value in (headers or {}).items()]
+        scope = {
+            "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": method, "scheme": "http",
+            "path": path, "raw_path": path.encode(), "query_string": query_string.encode(), "root_path": "",
+            "headers": raw_headers, "client": ("127.0.0.1", 50000), "server": (self.host, 80),
+        }
+        request_messages = [{"type": "http.request", "body": body, "more_body": False}]
+        response = {"status": None, "body": []}
+
+        async def receive():
+            if request_messages:
+                return request_messages.pop(0)
+            # The request is fully sent, the app only waits here for a disconnection
+            await asyncio.Event().wait()
+
+        async def send(message):
+            if message["type"] == "http.response.start":
+                response["status"] = message["status"]
+            elif message["type"] == "http.response.body":
+                response["body"].append(message.get("body", b""))
+
+        await self.app(scope, receive, send)
+        return response["status"], b"".join(response["body"])
+
+
+def dechunk(payload: bytes) -> bytes:
+    """
+    Decode a body sent with 'Transfer-Encoding: chunked'
+    """
+    body = []
+    while payload:
+        size, _, payload = payload.partition(b"\r\n")
+        size = int(size.split(b";")[0], 16)
+        if size == 0:
+            break
+        body.append(payload[:size])
+        payload = payload[size + 2:]
+    return b"".join(body)
+
+
+class HTTPClient:
+    """
+    Minimal HTTP/1.1 client opening a connection per request, same interface as ASGIClient
+    """
+
+    def __init__(self, port: int, host: str = "localhost"):
+        self.port = port
+        self.host = host
+
+    async def request(self, method: str, path: str, headers: Optional[dict] = None, body: bytes = b""):
+        reader, writer = await asyncio.open_connection("127.0.0.1", self.port)
+        head = f"{method} {path} HTTP/1.1\r\nHost: {self.host}\r\nContent-Length: {len(body)}\r\nConnection: close\r\n"
+        head += "".join(f"{name}: {value}\r\n" for name, value in (headers or {}).items())
+        writer.write(head.encode() + b"\r\n" + body)
+        response = await reader.read()
+        writer.close()
+        await writer.wait_closed()
+        head, _, payload = response.partition(b"\r\n\r\n")
+        if b"transfer-encoding: chunked" in head.lower():
+            payload = dechunk(payload)
+        return int(head.split(b" ", 2)[1]), payload
+
+
+async def start_server(workers: int) -> tuple[subprocess.Popen, HTTPClient]:
+    """
+    Run serve.py on a free port, with the environment of the benchmark
+    :param workers: number of workers
+    :return: the server process and a client calling it, once it answers
+    """
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
+    environment = {**os.environ, "SERVE_HOST": "127.0.0.1", "SERVE_PORT": str(port), "SERVE_WORKERS": str(workers),
+                   "RESPONSE_CACHE_BACKEND": os.getenv("RESPONSE_CACHE_BACKEND", "file" if workers > 1 else "memory")}
+    server = subprocess.Popen([sys.executable, "serve.py"], env=environment, cwd=os.path.dirname(__file__) or ".",
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    client = HTTPClient(port)
+    deadline = time.monotonic() + 60
+    while True:
+        try:
+            # Every worker must be up, the first answers come from the first one started
+            await asyncio.sleep(0.5)
+            await client.request("GET", "/status/db-pool")
+            return server, client
+        except OSError:
+            if server.poll() is not None or time.monotonic() > deadline:
+                server.kill()
+                raise RuntimeError("serve.py didn't start")
+
+
+class Scenario(NamedTuple):
+    """
+    How to call one route: build returns the (path, headers, body) of the request number i
+    """
+    name: str
+    method: str
+    route: str
+    build: Callable
+
+
+class Dataset(NamedTuple):
+    """
+    What was seeded, so the scenarios can pick existing ids
+    """
+    authors: int
+    posts: int
+    tokens: dict
+    password: str = BENCHMARK_PASSWORD
+
+
+def form(**fields) -> tuple[dict, bytes]:
+    return {"Content-Type": "application/x-www-form-urlencoded"}, urlencode(fields).encode()
+
+
+def json_body(content) -> tuple[dict, bytes]:
+    return {"Content-Type": "application/json"}, json.dumps(content).encode()
+
+
+def authenticated(dataset: Dataset, author_id: int, headers: dict) -> dict:
+    return {**headers, "Authorization": f"Bearer {dataset.tokens[author_id]}"}
+
+
+def build_scenarios(dataset: Dataset, rng: random.Random, run_id: str) -> list:
+    """
+    One scenario per route of the app
+    :param dataset: the seeded dataset
+    :param rng: random generator picking the ids
+    :param run_id: unique prefix of the rows written by the benchmark
+    :return: list of Scenario
+    """
+    def author_id():
+        return rng.randint(1, dataset.authors)
+
+    def post_id():
+        return rng.randint(1, dataset.posts)
+
+    def token_author():
+        return rng.choice(list(dataset.tokens))
+
+    def login(i):
+        return ("/token", *form(username=f"author{author_id()}", password=dataset.password))
+
+    def create_author(i):
+        return ("/authors/", *json_body({"username": f"{run_id}-author{i}", "password": BENCHMARK_PASSWORD}))
+
+    def create_post(i):
+        owner = token_author()
+        headers, body = json_body({"title": f"{run_id}-post{i}", "description": "Benchmark post"})
+        return f"/author/{owner}/posts/", authenticated(dataset, owner, headers), body
+
+    def create_posts_bulk(i):
+        owner = token_author()
+        headers, body = json_body([{"title": f"{run_id}-bulk{i}-{index}"} for index in range(10)])
+        return f"/author/{owner}/posts/bulk", authenticated(dataset, owner, headers), body
+
+    def read_authors_batch_from_body(i):
+        return ("/authors/batch", *json_body({"ids": [author_id() for _ in range(20)]}))
+
+    def get(path_builder):
+        return lambda i: (path_builder(), {}, b"")
+
+    return [
+        Scenario("login", "POST", "/token", login),
+        Scenario("read_authors", "GET", "/authors/", get(lambda: f"/authors/?skip={author_id() - 1}&limit=10")),
+        Scenario("read_authors_without_posts", "GET", "/authors/",
+                 get(lambda: f"/authors/?skip={author_id() - 1}&limit=10&include_posts=false")),
+        Scenario("read_authors_summary", "GET", "/authors/summary",
+                 get(lambda: f"/authors/summary?skip={author_id() - 1}&limit=10")),
+        Scenario("create_author", "POST", "/authors/", create_author),
+        Scenario("read_author", "GET", "/author/{author_id}", get(lambda: f"/author/{author_id()}")),
+        Scenario("read_authors_batch", "GET", "/authors/batch",
+                 get(lambda: "/authors/batch?ids=" + ",".join(str(author_id()) for _ in range(20)))),
+        Scenario("read_authors_batch_from_body", "POST", "/authors/batch", read_authors_batch_from_body),
+        Scenario("read_posts", "GET", "/posts/", get(lambda: f"/posts/?skip={post_id() - 1}&limit=10")),
+        Scenario("read_posts_deep_page", "GET", "/posts/", get(lambda: f"/posts/?skip={dataset.posts - 10}&limit=10")),
+        Scenario("search_posts", "GET", "/posts/search", get(lambda: f"/posts/search?q=post+{post_id()}")),
+        Scenario("export_posts", "GET", "/posts/export", get(lambda: f"/posts/export?owner_id={author_id()}")),
+        Scenario("read_post", "GET", "/posts/{post_id}", get(lambda: f"/posts/{post_id()}")),
+        Scenario("create_post", "POST", "/author/{author_id}/posts/", create_post),
+        Scenario("create_posts_bulk", "POST", "/author/{author_id}/posts/bulk", create_posts_bulk),
+        Scenario("read_article", "GET", "/article/{article_id}", get(lambda: f"/article/{post_id()}")),
+        Scenario("hashing_pool_status", "GET", "/status/hashing-pool", get(lambda: "/status/hashing-pool")),
+        Scenario("db_pool_status", "GET", "/status/db-pool", get(lambda: "/status/db-pool")),
+        Scenario("metrics", "GET", "/metrics", get(lambda: "/metrics")),
+    ]
+
+
+def seed(database_path: str, arguments) -> tuple:
+    """
+    Create the database: a copy of the fixture if one was given, else authors author1..authorN with the same number of
+    posts each
+    :param database_path: path of the SQLite file to create
+    :param arguments: the parsed command line
+    :return: number of authors, number of posts and password of the authors
+    """
+    if arguments.fixture:
+        shutil.copyfile(arguments.fixture, database_path)
+        manifest = read_manifest(arguments.fixture)
+    else:
+        manifest = seed_database(database_path, arguments.authors, arguments.authors * arguments.posts_per_author,
+                                 BENCHMARK_PASSWORD, skew=0, seed=arguments.seed)
+    return manifest.authors, manifest.posts, manifest.password
+
+
+def percentile(sorted_values: list, fraction: float) -> float:
+    """
+    Nearest-rank percentile
+    :param sorted_values: the measures, sorted
+    :param fraction: 0.5 for the median, 0.95 for p95...
+    :return: the percentile
+    """
+    index = min(len(sorted_values) - 1, max(0, round(fraction * len(sorted_values) + 0.5) - 1))
+    return sorted_values[index]
+
+
+async def run_scenario(client, scenario: Scenario, requests: int, concurrency: int,
+                       statements: Optional[list]) -> dict:
+    """
+    Send the requests of a scenario, at most concurrency of them at a time
+    :param client: the in-process client, or the HTTP one
+    :param scenario: the scenario to run
+    :param requests: how many requests are measured
+    :param concurrency: how many requests run at the same time
+    :param statements: counter of the SQL statements, shared with the engines' event listeners, None over HTTP
+    :return: dict of the scenario's results
+    """
+    latencies, errors = [], 0
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one_request(index: int):
+        nonlocal errors
+        path, headers, body = scenario.build(index)
+        async with semaphore:
+            start = time.perf_counter()
+            status, _ = await client.request(scenario.method, path, headers, body)
+            latencies.append(time.perf_counter() - start)
+        if status >= 400:
+            errors += 1
+
+    # Warm up the route (template compilation, first connections...) before measuring
+    await one_request(-1)
+    latencies.clear()
+    errors = 0
+    if statements:
+        statements[0] = 0
+    start = time.perf_counter()
+    await asyncio.gather(*(one_request(index) for index in range(requests)))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        "method": scenario.method,
+        "route": scenario.route,
+        "requests": requests,
+        "errors": errors,
+        "requests_per_second": round(requests / elapsed, 2),
+        "mean_ms": round(sum(latencies) / len(latencies) * 1000, 3),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 3),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+        "queries_per_request": round(statements[0] / requests, 2) if statements else None,
+    }
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def benchmark(arguments) -> dict:
+    """
+    Seed the database, then run every scenario
+    :param arguments: the parsed command line
+    :return: the results document
+    """
+    authors, posts, password = seed(os.environ["DATABASE_URL"].removeprefix("sqlite:///"), arguments)
+    # The app reads its settings at import, it must only be imported once the environment is ready
+    import database
+    from sqlalchemy import event
+
+    if arguments.workers:
+        server, client = await start_server(arguments.workers)
+        statements = None
+    else:
+        from main import app
+
+        server, client = None, ASGIClient(app)
+        statements = [0]
+
+        def count_statement(*args):
+            statements[0] += 1
+
+        for engine in [database.async_engine, *database.replica_engines]:
+            event.listen(engine.sync_engine, "before_cursor_execute", count_statement)
+        await app.router.startup()
+    try:
+        tokens = {}
+        for author_id in range(1, min(authors, arguments.concurrency) + 1):
+            _, body = await client.request("POST", "/token", *form(username=f"author{author_id}", password=password))
+            tokens[author_id] = json.loads(body)["access_token"]
+        dataset = Dataset(authors, posts, tokens, password)
+        rng = random.Random(arguments.seed)
+        results = {}
+        for scenario in build_scenarios(dataset, rng, run_id=f"bench{int(time.time())}"):
+            if arguments.only and scenario.name not in arguments.only:
+                continue
+            results[scenario.name] = await run_scenario(client, scenario, arguments.requests, arguments.concurrency,
+                                                        statements)
+            print(f"{scenario.name:<28} {results[scenario.name]['requests_per_second']:>10} req/s  "
+                  f"p95 {results[scenario.name]['p95_ms']:>9} ms", file=sys.stderr)
+    finally:
+        if server is not None:
+            # Drained and stopped like in production
+            server.terminate()
+            server.wait()
+        else:
+            await app.router.shutdown()
+
+    return {
+        "meta": {
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "authors": authors,
+            "posts": posts,
+            "fixture": arguments.fixture,
+            "requests": arguments.requests,
+            "concurrency": arguments.concurrency,
+            "workers": arguments.workers,
+            "seed": arguments.seed,
+        },
+        "results": results,
+    }
+
+
+def regressions(results: dict, baseline: dict, max_regression: float) -> list:
+    """
+    Compare the p95 latencies with the ones of a previous run
+    :param results: the current results document
+    :param baseline: the previous results document
+    :param max_regression: allowed relative growth, 0.25 for 25%
+    :return: list of messages, one per slower route
+    """
+    messages = []
+    for name, result in results["results"].items():
+        previous = baseline["results"].get(name)
+        if previous and result["p95_ms"] > previous["p95_ms"] * (1 + max_regression):
+            messages.append(f"{name}: p95 {previous['p95_ms']} ms -> {result['p95_ms']} ms")
+    return messages
+
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--authors", type=int, default=50, help="number of seeded authors")
+    parser.add_argument("--posts-per-author", type=int, default=20, help="number of seeded posts of every author")
+    parser.add_argument("--fixture", help="database generated by seed.py to run against, instead of seeding one")
+    parser.add_argument("--requests", type=int, default=100, help="measured requests per route")
+    parser.add_argument("--concurrency", type=int, default=8, help="requests running at the same time")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="serve the app with serve.py and this many workers, in process when 0")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the random ids, for comparable runs")
+    parser.add_argument("--only", nargs="*", help="names of the scenarios to run, all of them by default")
+    parser.add_argument("--output", help="file receiving the JSON results, stdout by default")
+    parser.add_argument("--baseline", help="JSON results of a previous run to compare with")
+    parser.add_argument("--max-regression", type=float, default=0.25,
+                        help="allowed relative growth of the p95 latency compared to the baseline")
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> int:
+    arguments = parse_arguments(argv)
+    directory = tempfile.mkdtemp(prefix="benchmark-")
+    os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(directory, 'benchmark.db')}"
+    os.environ.setdefault("SECRET_KEY", "benchmark-secret-key")
+    os.environ.setdefault("ALGORITHM", "HS256")
+    # The routes are measured, not the limits protecting them
+    os.environ.setdefault("RATE_LIMIT_BACKEND", "none")
+
+    results = asyncio.run(benchmark(arguments))
+    document = json.dumps(results, indent=2)
+    if arguments.output:
+        with open(arguments.output, "w") as file:
+            file.write(document)
+    else:
+        print(document)
+
+    if arguments.baseline:
+        with open(arguments.baseline) as file:
+            messages = regressions(results, json.load(file), arguments.max_regression)
+        for message in messages:
+            print(f"Regression: {message}", file=sys.stderr)
+        return 1 if messages else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,147 @@
+"""
+Reading the body of the bulk post creation endpoint
+"""
+import codecs
+import json
+from typing import AsyncIterator, Union
+
+from fastapi import HTTPException, Request, status
+from pydantic import ValidationError
+
+import schemas
+from export import NDJSON_MEDIA_TYPE
+
+_json_decoder = json.JSONDecoder()
+NUMBER_START = "-0123456789"
+NUMBER_PART = "0123456789.eE+-"
+
+
+def _parse_post(index: int, item) -> Union[schemas.PostCreate, schemas.BulkPostResult]:
+    """
+    Validate one item of the body
+    :param index: position of the item in the body
+    :param item: the decoded item
+    :return: the post to create, or the failed result of the item
+    """
+    try:
+        return schemas.PostCreate.parse_obj(item)
+    except ValidationError as error:
+        return schemas.BulkPostResult(index=index, error=f"Invalid post: {error.errors()[0]['msg']}")
+
+
+async def _ndjson_items(request: Request) -> AsyncIterator:
+    """
+    Decode a NDJSON body line by line while it is received, so it is never held in memory as a whole
+    :param request: the incoming request
+    :return: the decoded lines, or None for the lines that aren't valid JSON
+    """
+    buffer = b""
+    async for data in request.stream():
+        buffer += data
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            if line.strip():
+                yield _decode_line(line)
+    if buffer.strip():
+        yield _decode_line(buffer)
+
+
+def _decode_line(line: bytes):
+    try:
+        return json.loads(line)
+    except ValueError:
+        return None
+
+
+def _invalid_json() -> HTTPException:
+    return HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="The body is not valid JSON")
+
+
+def _scan_json_array(buffer: str, expected: str, final: bool) -> tuple[list, str, str]:
+    """
+    Read what can be read of a JSON array
+    :param buffer: the text received and not read yet
+    :param expected: what comes next: "start" for the "[", "first" for an item or the "]", "item", "separator" for a
+    "," or the "]", "end" once the array is closed
+    :param final: if the whole body was received
+    :return: the items read, the text left and what comes next, or a 400 exception if the body isn't a JSON array
+    """
+    items = []
+    while True:
+        buffer = buffer.lstrip()
+        if not buffer or expected == "end":
+            return items, buffer, expected
+        if expected == "start":
+            if buffer[0] != "[":
+                raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="The body must be a list of posts")
+            buffer, expected = buffer[1:], "first"
+        elif expected == "separator" or (expected == "first" and buffer[0] == "]"):
+            if buffer[0] not in ",]":
+                raise _invalid_json()
+            buffer, expected = buffer[1:], "item" if buffer[0] == "," else "end"
+        else:
+            try:
+                item, end = _json_decoder.raw_decode(buffer)
+            except ValueError:
+                if final:
+                    raise _invalid_json()
+                return items, buffer, expected
+            if not final and (end == len(buffer) or (buffer[0] in NUMBER_START and buffer[end] in NUMBER_PART)):
+                # A number could go on in the next data, e.g. 3. is read as 3
+                return items, buffer, expected
+            items.append(item)
+            buffer, expected = buffer[end:], "separator"
+
+
+async def _json_items(request: Request) -> AsyncIterator:
+    """
+    Decode a JSON array body item by item while it is received, only the item being received is buffered
+    :param request: the incoming request
+    :return: the items of the array, or a 400 exception if the body isn't a JSON array
+    """
+    text_decoder = codecs.getincrementaldecoder("utf-8")()
+    buffer, expected = "", "start"
+    try:
+        async for data in request.stream():
+            items, buffer, expected = _scan_json_array(buffer + text_decoder.decode(data), expected, final=False)
+            for item in items:
+                yield item
+        buffer += text_decoder.decode(b"", final=True)
+    except UnicodeDecodeError:
+        raise _invalid_json()
+    items, buffer, expected = _scan_json_array(buffer, expected, final=True)
+    for item in items:
+        yield item
+    if expected != "end" or buffer:
+        raise _invalid_json()
+
+
+async def read_post_chunks(request: Request, chunk_size: int, max_posts: int) -> AsyncIterator[tuple[list, list]]:
+    """
+    Read the posts of a bulk request, either a JSON array or NDJSON, in chunks. The body is decoded while it is
+    received, the posts are all validated before the first chunk is given, so a request above max_posts writes
+    nothing.
+    :param request: the incoming request
+    :param chunk_size: how many valid posts are in a chunk
+    :param max_posts: the MAX_BULK_POSTS setting, a 413 exception is raised for a body with more items
+    :return: tuples of the (index, post) pairs to create and of the results of the invalid items, all of them in
+    the first tuple
+    """
+    is_ndjson = request.headers.get("content-type", "").startswith(NDJSON_MEDIA_TYPE)
+    items = _ndjson_items(request) if is_ndjson else _json_items(request)
+    posts, invalid = [], []
+    index = 0
+    async for item in items:
+        if index >= max_posts:
+            raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                                detail=f"At most {max_posts} posts can be created at once")
+        parsed = _parse_post(index, item)
+        if isinstance(parsed, schemas.BulkPostResult):
+            invalid.append(parsed)
+        else:
+            posts.append((index, parsed))
+        index += 1
+    for start in range(0, len(posts), chunk_size):
+        yield posts[start:start + chunk_size], invalid if start == 0 else []
+    if invalid and not posts:
+        yield [], invalid
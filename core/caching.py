@@ -0,0 +1,388 @@
+"""
+In-process caches
+"""
+import hashlib
+import json
+import os
+import stat
+import tempfile
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Hashable, NamedTuple, Optional
+
+from fastapi import Request, Response, status
+
+from compression import choose_encoding, compress_variants
+from config.settings import settings
+
+
+class TTLCache:
+    """
+    Least recently used cache, where every entry also expires after a time to live
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries: OrderedDict = OrderedDict()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """
+        Read an entry, expired entries are dropped on the way
+        :param key: the entry's key
+        :param default: returned when the key is missing or expired
+        :return: the cached value
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            return default
+        value, expires_at = entry
+        if expires_at <= time.monotonic():
+            del self._entries[key]
+            return default
+        self._entries.move_to_end(key)
+        return value
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None):
+        """
+        Store an entry, evicting the least recently used one if the cache is full
+        :param key: the entry's key
+        :param value: the value to cache
+        :param ttl: seconds the entry lives, it can only shorten the cache's own ttl
+        """
+        if self.maxsize <= 0:
+            return
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        self._entries[key] = (value, time.monotonic() + ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def delete(self, key: Hashable):
+        """
+        Invalidate an entry
+        :param key: the entry's key
+        """
+        self._entries.pop(key, None)
+
+    def clear(self):
+        """
+        Invalidate every entry
+        """
+        self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class CachedResponse(NamedTuple):
+    """
+    A rendered response body, with the ETag computed from it and its pre-compressed variants by encoding. A response
+    read from a replica also has the wall clock time it expires at, the cache's ttl applies to the others.
+    """
+    body: bytes
+    media_type: str
+    etag: str
+    encodings: dict = {}
+    expires_at: Optional[float] = None
+
+
+class MemoryBackend:
+    """
+    Response cache backend private to the process
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self._cache = TTLCache(maxsize, ttl)
+
+    def get(self, key: str) -> Optional[dict]:
+        return self._cache.get(key)
+
+    def set(self, key: str, value: dict):
+        self._cache.set(key, value)
+
+    def delete(self, key: str):
+        self._cache.delete(key)
+
+    def clear(self):
+        self._cache.clear()
+
+
+def private_directory(path) -> Path:
+    """
+    Create a directory only the user can write to, or check that an existing one is. What the app reads back from a
+    directory others can write to could have been planted there.
+    :param path: the directory
+    :return: the directory, or a RuntimeError if another user owns it or can write to it
+    """
+    path = Path(path)
+    path.mkdir(mode=0o700, parents=True, exist_ok=True)
+    info = path.lstat()
+    if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid() or info.st_mode & 0o022:
+        raise RuntimeError(f"{path} must be a directory of the user that only the user can write to")
+    return path
+
+
+def _dump_variants(variants: dict) -> bytes:
+    """
+    File content of a cache entry: one JSON line describing the variants, then their bodies one after the other.
+    Unlike pickle, reading it back can't run code.
+    """
+    header, bodies, offset = {}, [], 0
+    for variant, response in variants.items():
+        spans = {}
+        for encoding, body in [("identity", response.body), *response.encodings.items()]:
+            spans[encoding] = [offset, len(body)]
+            bodies.append(body)
+            offset += len(body)
+        header[variant] = {"media_type": response.media_type, "etag": response.etag, "spans": spans,
+                           "expires_at": response.expires_at}
+    return json.dumps(header).encode() + b"\n" + b"".join(bodies)
+
+
+def _load_variants(content: bytes) -> dict:
+    header, _, blob = content.partition(b"\n")
+    variants = {}
+    for variant, fields in json.loads(header).items():
+        bodies = {encoding: blob[start:start + length] for encoding, (start, length) in fields["spans"].items()}
+        variants[variant] = CachedResponse(bodies.pop("identity"), fields["media_type"], fields["etag"], bodies,
+                                           fields["expires_at"])
+    return variants
+
+
+class FileBackend:
+    """
+    Response cache backend storing one file per entry, shared by all the processes of the host
+    """
+
+    def __init__(self, directory: str, ttl: float):
+        self.path = Path(directory)
+        self.ttl = ttl
+        self._directory: Optional[Path] = None
+
+    @property
+    def directory(self) -> Path:
+        """
+        The directory is only created and checked on first use, so importing the module does no I/O
+        """
+        if self._directory is None:
+            self._directory = private_directory(self.path)
+        return self._directory
+
+    def _path(self, key: str) -> Path:
+        return self.directory / hashlib.sha1(key.encode()).hexdigest()
+
+    def get(self, key: str) -> Optional[dict]:
+        path = self._path(key)
+        try:
+            if path.stat().st_mtime + self.ttl <= time.time():
+                return None
+            return _load_variants(path.read_bytes())
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def set(self, key: str, value: dict):
+        # Written to a temporary file first, so the other processes never read a partial entry
+        descriptor, temporary_path = tempfile.mkstemp(dir=self.directory)
+        with os.fdopen(descriptor, "wb") as file:
+            file.write(_dump_variants(value))
+        os.replace(temporary_path, self._path(key))
+
+    def delete(self, key: str):
+        self._path(key).unlink(missing_ok=True)
+
+    def clear(self):
+        for path in self.directory.iterdir():
+            path.unlink(missing_ok=True)
+
+
+class ResponseCache:
+    """
+    Read-through cache of rendered responses. An entry holds every variant (query parameters, host) of one object's
+    route, so invalidating the object drops all of them at once.
+    """
+
+    def __init__(self, backend, max_generations: int = 4096):
+        self.backend = backend
+        # Generation of the recently invalidated keys: the invalidation counter when they were last invalidated. Past
+        # max_generations the oldest keys are forgotten and get the generation of the last one forgotten, still newer
+        # than any render they had in flight.
+        self.max_generations = max_generations
+        self._invalidations = 0
+        self._forgotten_generation = 0
+        self._generations: OrderedDict = OrderedDict()
+
+    @staticmethod
+    def _key(route: str, object_id: int) -> str:
+        return f"{route}:{object_id}"
+
+    def get(self, route: str, object_id: int, variant: str) -> Optional[CachedResponse]:
+        """
+        Read a cached response
+        :param route: name of the cached route
+        :param object_id: id of the object the route renders
+        :param variant: anything else the rendered body depends on
+        :return: the cached response if any
+        """
+        if self.backend is None:
+            return None
+        response = (self.backend.get(self._key(route, object_id)) or {}).get(variant)
+        if response is not None and response.expires_at is not None and response.expires_at <= time.time():
+            return None
+        return response
+
+    def generation(self, route: str, object_id: int) -> int:
+        """
+        Generation of an object's entry, to take before rendering it
+        :param route: name of the cached route
+        :param object_id: id of the object the route renders
+        :return: a value that changes whenever the object is invalidated
+        """
+        return self._generations.get(self._key(route, object_id), self._forgotten_generation)
+
+    def set(self, route: str, object_id: int, variant: str, response: CachedResponse, generation: Optional[int] = None):
+        """
+        Store a rendered response
+        :param route: name of the cached route
+        :param object_id: id of the object the route renders
+        :param variant: anything else the rendered body depends on
+        :param response: the rendered response
+        :param generation: the object's generation when the rendering started, the response isn't stored if the
+        object was invalidated since
+        """
+        if self.backend is None:
+            return
+        if generation is not None and generation != self.generation(route, object_id):
+            return
+        key = self._key(route, object_id)
+        variants = self.backend.get(key) or {}
+        variants[variant] = response
+        self.backend.set(key, variants)
+
+    def invalidate(self, route: str, object_id: int):
+        """
+        Drop every cached variant of an object's route
+        :param route: name of the cached route
+        :param object_id: id of the object that changed
+        """
+        key = self._key(route, object_id)
+        self._invalidations += 1
+        self._generations[key] = self._invalidations
+        self._generations.move_to_end(key)
+        while len(self._generations) > self.max_generations:
+            _, self._forgotten_generation = self._generations.popitem(last=False)
+        if self.backend is not None:
+            self.backend.delete(key)
+
+    def clear(self):
+        if self.backend is not None:
+            self.backend.clear()
+
+
+def make_etag(body: bytes) -> str:
+    """
+    Strong ETag of a response body
+    :param body: the rendered body
+    :return: quoted ETag value
+    """
+    return '"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+
+
+def encoded_etag(etag: str, encoding: Optional[str]) -> str:
+    """
+    ETag of a compressed representation, it differs from the uncompressed one as required for strong ETags
+    :param etag: ETag of the uncompressed body
+    :param encoding: content encoding of the representation
+    :return: quoted ETag value
+    """
+    return etag if encoding is None else f'{etag[:-1]}-{encoding}"'
+
+
+def list_etag(request: Request, versions: tuple) -> str:
+    """
+    Weak ETag of a list page, built from its URL and the versions of the tables it reads instead of its body, so it is
+    known before running the page's query
+    :param request: the incoming request
+    :param versions: versions of the read tables, from crud.get_table_versions
+    :return: quoted weak ETag value
+    """
+    key = f"{request.url.path}?{request.query_params}:{versions}".encode()
+    return 'W/"' + hashlib.blake2b(key, digest_size=16).hexdigest() + '"'
+
+
+def etag_matches(request: Request, etag: Optional[str]) -> bool:
+    """
+    Check the request's If-None-Match header against an ETag, with the weak comparison
+    :param request: the incoming request
+    :param etag: the current ETag of the resource, any of its encoded representations matches too
+    :return: True if the client's copy is still valid
+    """
+    if_none_match = request.headers.get("if-none-match")
+    if not if_none_match or etag is None:
+        return False
+    etag = etag.removeprefix("W/")
+    candidates = [candidate.strip().removeprefix("W/") for candidate in if_none_match.split(",")]
+    return "*" in candidates or any(candidate == etag or candidate.startswith(etag[:-1] + "-")
+                                    for candidate in candidates)
+
+
+async def cached_response(request: Request, route: str, object_id: int, render: Callable[[], Awaitable[Response]],
+                          cache_control: Optional[str] = None) -> Response:
+    """
+    Serve a route from the response cache, rendering and storing it on a miss. Bodies above the compression threshold
+    are stored with their gzip/brotli variants, which are sent to the clients accepting them.
+    The cache is shared by every client, so it is skipped for a client whose reads are pinned to the primary after a
+    write (request.state.read_pinned). A response read from a replica (request.state.read_from_replica) may not have
+    seen the latest writes yet, it is only stored for READ_YOUR_WRITES_SECONDS, the time the replicas take to catch up.
+    :param request: the incoming request
+    :param route: name of the cached route
+    :param object_id: id of the object the route renders
+    :param render: coroutine function building the full response, it may raise an HTTPException that isn't cached
+    :param cache_control: Cache-Control header sent with the response
+    :return: the response, or an empty 304 if the client's ETag still matches
+    """
+    variant = f"{request.base_url}?{request.query_params}"
+    pinned = getattr(request.state, "read_pinned", False)
+    entry = None if pinned else response_cache.get(route, object_id, variant)
+    if entry is None:
+        # Taken before rendering: a write invalidating the object while the render awaits the database makes the
+        # rendered body stale, it is then sent but not stored
+        generation = response_cache.generation(route, object_id)
+        rendered = await render()
+        encodings = compress_variants(rendered.body) if len(rendered.body) >= settings.COMPRESSION_MINIMUM_SIZE else {}
+        entry = CachedResponse(rendered.body, rendered.media_type, make_etag(rendered.body), encodings)
+        if getattr(request.state, "read_from_replica", False):
+            entry = entry._replace(expires_at=time.time() + settings.READ_YOUR_WRITES_SECONDS)
+        if not pinned:
+            response_cache.set(route, object_id, variant, entry, generation)
+
+    encoding = choose_encoding(request.headers.get("accept-encoding", ""), entry.encodings)
+    headers = {"ETag": encoded_etag(entry.etag, encoding)}
+    if entry.encodings:
+        headers["Vary"] = "Accept-Encoding"
+    if cache_control:
+        headers["Cache-Control"] = cache_control
+    if etag_matches(request, entry.etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    if encoding is not None:
+        headers["Content-Encoding"] = encoding
+        return Response(entry.encodings[encoding], media_type=entry.media_type, headers=headers)
+    return Response(entry.body, media_type=entry.media_type, headers=headers)
+
+
+def _response_cache_backend():
+    if settings.RESPONSE_CACHE_BACKEND == "memory":
+        return MemoryBackend(settings.RESPONSE_CACHE_SIZE, settings.RESPONSE_CACHE_TTL_SECONDS)
+    if settings.RESPONSE_CACHE_BACKEND == "file":
+        return FileBackend(settings.RESPONSE_CACHE_DIR, settings.RESPONSE_CACHE_TTL_SECONDS)
+    if settings.RESPONSE_CACHE_BACKEND == "none":
+        return None
+    raise ValueError(f"Unknown response cache backend: {settings.RESPONSE_CACHE_BACKEND}")
+
+
+# Authenticated principals by username, so a valid token doesn't need a database query on every request
+principal_cache = TTLCache(settings.PRINCIPAL_CACHE_SIZE, settings.PRINCIPAL_CACHE_TTL_SECONDS)
+
+# Rendered responses of the single object routes
+response_cache = ResponseCache(_response_cache_backend(), settings.RESPONSE_CACHE_SIZE)
@@ -0,0 +1,99 @@
+"""
+Response body compression
+"""
+import gzip
+import zlib
+from typing import Optional
+
+try:
+    import brotli
+except ImportError:  # brotli is optional, only gzip is offered without it
+    brotli = None
+
+# Levels of the responses compressed on the fly, cheap enough for every request while still shrinking JSON a lot
+DYNAMIC_GZIP_LEVEL = 6
+DYNAMIC_BROTLI_QUALITY = 4
+
+
+def compress_variants(body: bytes) -> dict:
+    """
+    Compress a body with every available encoding, at the best level since the result is stored and reused
+    :param body: the uncompressed body
+    :return: dict of encoding name to compressed body
+    """
+    variants = {"gzip": gzip.compress(body, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        variants["br"] = brotli.compress(body, quality=11)
+    return variants
+
+
+def available_encodings() -> tuple:
+    """
+    Encodings this process can compress with
+    """
+    return ("gzip", "br") if brotli is not None else ("gzip",)
+
+
+class StreamCompressor:
+    """
+    Incremental compressor of a response body, every chunk given is flushed so a streamed response keeps streaming
+    """
+
+    def __init__(self, encoding: str):
+        self.encoding = encoding
+        if encoding == "br":
+            self._brotli = brotli.Compressor(quality=DYNAMIC_BROTLI_QUALITY)
+        else:
+            # wbits 31 writes the gzip header and trailer around the deflate stream
+            self._zlib = zlib.compressobj(DYNAMIC_GZIP_LEVEL, zlib.DEFLATED, 31)
+
+    def compress(self, chunk: bytes, final: bool) -> bytes:
+        """
+        Compress the next chunk of the body
+        :param chunk: the uncompressed chunk
+        :param final: True for the last chunk, the stream is then closed
+        :return: the compressed bytes to send
+        """
+        if self.encoding == "br":
+            return self._brotli.process(chunk) + (self._brotli.finish() if final else self._brotli.flush())
+        return self._zlib.compress(chunk) + self._zlib.flush(zlib.Z_FINISH if final else zlib.Z_SYNC_FLUSH)
+
+
+def accepted_encodings(accept_encoding: str) -> dict:
+    """
+    Parse an Accept-Encoding header
+    :param accept_encoding: the header's value
+    :return: dict of encoding name to its quality value
+    """
+    encodings = {}
+    for part in accept_encoding.split(","):
+        name, *parameters = [piece.strip() for piece in part.split(";")]
+        if not name:
+            continue
+        quality = 1.0
+        for parameter in parameters:
+            if parameter.startswith("q="):
+                try:
+                    quality = float(parameter[2:])
+                except ValueError:
+                    quality = 0.0
+        encodings[name.lower()] = quality
+    return encodings
+
+
+def choose_encoding(accept_encoding: str, available) -> Optional[str]:
+    """
+    Negotiate the encoding of a response, brotli being preferred to gzip at equal quality
+    :param accept_encoding: the request's Accept-Encoding header
+    :param available: the encodings the response can be sent with
+    :return: the chosen encoding, or None for the uncompressed body
+    """
+    accepted = accepted_encodings(accept_encoding)
+    candidates = [
+        (accepted.get(encoding, accepted.get("*", 0.0)), encoding == "br", encoding)
+        for encoding in available
+    ]
+    candidates = [candidate for candidate in candidates if candidate[0] > 0]
+    if not candidates:
+        return None
+    return max(candidates)[2]
@@ -2,6 +2,7 @@
 Configuration/settings module
 """
 import os
+import tempfile
 from dotenv import load_dotenv
 
 from pathlib import Path
@@ -18,6 +19,140 @@ class Settings:
     ALGORITHM: str = os.getenv('ALGORITHM')
     ACCESS_TOKEN_EXPIRE_MINUTES = 30
 
+    # Comma separated hosts the app answers to, and origins allowed to call it from a browser
+    ALLOWED_HOSTS: list = [host.strip() for host in
+                           os.getenv('ALLOWED_HOSTS', '127.0.0.1,localhost,192.100.1.50').split(',') if host.strip()]
+    CORS_ORIGINS: list = [origin.strip() for origin in
+                          os.getenv('CORS_ORIGINS', 'http://localhost,http://localhost:8080,http://localhost:7000')
+                          .split(',') if origin.strip()]
+
+    # Database connection, SQLite only (the search uses FTS5). The driver named in the URL is ignored, the sync engine
+    # (alembic and scripts) uses pysqlite and the app aiosqlite.
+    DATABASE_URL: str = os.getenv('DATABASE_URL', 'sqlite:///./sql_app.db')
+    DB_POOL_SIZE: int = int(os.getenv('DB_POOL_SIZE', 5))
+    DB_MAX_OVERFLOW: int = int(os.getenv('DB_MAX_OVERFLOW', 10))
+    DB_POOL_TIMEOUT: float = float(os.getenv('DB_POOL_TIMEOUT', 30))
+    DB_POOL_RECYCLE: int = int(os.getenv('DB_POOL_RECYCLE', -1))
+
+    # Comma separated URLs of read replicas, the read-only routes use them in turn. A client that just wrote reads
+    # from the primary for READ_YOUR_WRITES_SECONDS, so it sees its own writes despite the replication lag.
+    DATABASE_REPLICA_URLS: list = [url.strip() for url in os.getenv('DATABASE_REPLICA_URLS', '').split(',')
+                                   if url.strip()]
+    READ_YOUR_WRITES_SECONDS: int = int(os.getenv('READ_YOUR_WRITES_SECONDS', 5))
+
+    # PRAGMAs applied to every new SQLite connection. WAL lets readers go on while a writer commits, and NORMAL
+    # synchronous is safe with WAL (a power loss can only drop the last commits, never corrupt the database)
+    SQLITE_JOURNAL_MODE: str = os.getenv('SQLITE_JOURNAL_MODE', 'WAL')
+    SQLITE_SYNCHRONOUS: str = os.getenv('SQLITE_SYNCHRONOUS', 'NORMAL')
+    SQLITE_MMAP_SIZE: int = int(os.getenv('SQLITE_MMAP_SIZE', 256 * 1024 * 1024))
+    # Negative values are in KiB, positive ones in pages
+    SQLITE_CACHE_SIZE: int = int(os.getenv('SQLITE_CACHE_SIZE', -64 * 1024))
+    SQLITE_BUSY_TIMEOUT_MS: int = int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', 5000))
+
+    # Pool running bcrypt outside the event loop: "thread" or "process" workers, and how many calls may wait for a
+    # free worker before new ones are rejected with a 503
+    HASHING_POOL_KIND: str = os.getenv('HASHING_POOL_KIND', 'thread')
+    HASHING_POOL_WORKERS: int = int(os.getenv('HASHING_POOL_WORKERS', os.cpu_count() or 1))
+    HASHING_POOL_MAX_QUEUE: int = int(os.getenv('HASHING_POOL_MAX_QUEUE', 32))
+
+    # Cache of the authors resolved from a token, an entry never outlives the token it was resolved for
+    PRINCIPAL_CACHE_SIZE: int = int(os.getenv('PRINCIPAL_CACHE_SIZE', 1024))
+    PRINCIPAL_CACHE_TTL_SECONDS: float = float(os.getenv('PRINCIPAL_CACHE_TTL_SECONDS', 300))
+
+    # Rendered responses of the single post/author/article routes. The "memory" backend is private to each process,
+    # the "file" backend stores the entries in RESPONSE_CACHE_DIR and is shared by every process of the host, so an
+    # invalidation seen by one worker is seen by all of them. "none" turns the cache off. The directory must be the
+    # user's and not writable by others, the default one is created with mode 0700. A response read from a replica may
+    # miss the latest writes, it is only cached for READ_YOUR_WRITES_SECONDS.
+    RESPONSE_CACHE_BACKEND: str = os.getenv('RESPONSE_CACHE_BACKEND', 'memory')
+    RESPONSE_CACHE_SIZE: int = int(os.getenv('RESPONSE_CACHE_SIZE', 4096))
+    RESPONSE_CACHE_TTL_SECONDS: float = float(os.getenv('RESPONSE_CACHE_TTL_SECONDS', 60))
+    RESPONSE_CACHE_DIR: str = os.getenv('RESPONSE_CACHE_DIR',
+                                        str(Path(tempfile.gettempdir()) / f'fastapi_post_cache-{os.getuid()}'))
+
+    # Responses smaller than this are never compressed, the gain would not be worth the work
+    COMPRESSION_MINIMUM_SIZE: int = int(os.getenv('COMPRESSION_MINIMUM_SIZE', 500))
+
+    # Compiled templates are kept on disk, so a new worker doesn't compile them again. Jinja runs the bytecode it
+    # finds there: by default they go to Jinja's own directory, private to the user; a directory set here must not be
+    # writable by anyone else.
+    TEMPLATE_BYTECODE_CACHE_DIR: str = os.getenv('TEMPLATE_BYTECODE_CACHE_DIR', '')
+    # How long browsers and proxies may keep an article page
+    ARTICLE_CACHE_MAX_AGE_SECONDS: int = int(os.getenv('ARTICLE_CACHE_MAX_AGE_SECONDS', 60))
+
+    # Build the /posts/ and /authors/ responses straight from the selected columns and encode them with orjson (when
+    # installed), instead of going through the ORM, pydantic validation and jsonable_encoder. The JSON is the same.
+    FAST_SERIALIZATION: bool = os.getenv('FAST_SERIALIZATION', 'false').lower() in ('1', 'true', 'yes')
+
+    # Keep the HOT_POSTS_SIZE newest posts in memory, already encoded, to answer /posts/{id} and the /posts/ pages over
+    # them without the database. The index is written to HOT_POSTS_SNAPSHOT_PATH at shutdown and memory mapped at the
+    # next start, an empty path turns the snapshot off. Its directory must be the user's and not writable by others,
+    # the default one is created with mode 0700.
+    HOT_POSTS_ENABLED: bool = os.getenv('HOT_POSTS_ENABLED', 'false').lower() in ('1', 'true', 'yes')
+    HOT_POSTS_SIZE: int = int(os.getenv('HOT_POSTS_SIZE', 100000))
+    HOT_POSTS_SNAPSHOT_PATH: str = os.getenv('HOT_POSTS_SNAPSHOT_PATH', str(
+        Path(tempfile.gettempdir()) / f'fastapi_post_hot_posts-{os.getuid()}' / 'hot_posts.snapshot'))
+
+    # Most ids a batch lookup of authors accepts
+    MAX_BATCH_IDS: int = int(os.getenv('MAX_BATCH_IDS', 1000))
+
+    # How many posts of a bulk creation are inserted in one transaction
+    BULK_INSERT_CHUNK_SIZE: int = int(os.getenv('BULK_INSERT_CHUNK_SIZE', 500))
+    # Most posts a bulk creation accepts, a larger body gets a 413 before any post is written
+    MAX_BULK_POSTS: int = int(os.getenv('MAX_BULK_POSTS', 10000))
+
+    # Group commit of the post creations: the posts created at the same time are written by a single task, up to
+    # POST_WRITE_BATCH_SIZE of them in one transaction, waiting at most POST_WRITE_BATCH_WINDOW_MS for a batch to fill
+    POST_WRITE_BATCHING: bool = os.getenv('POST_WRITE_BATCHING', 'false').lower() in ('1', 'true', 'yes')
+    POST_WRITE_BATCH_SIZE: int = int(os.getenv('POST_WRITE_BATCH_SIZE', 100))
+    POST_WRITE_BATCH_WINDOW_MS: float = float(os.getenv('POST_WRITE_BATCH_WINDOW_MS', 2))
+    # Posts waiting to be written, the next creations wait for room
+    POST_WRITE_QUEUE_SIZE: int = int(os.getenv('POST_WRITE_QUEUE_SIZE', 1000))
+
+    # How many rows of the posts export are fetched from the database cursor at a time
+    EXPORT_FETCH_SIZE: int = int(os.getenv('EXPORT_FETCH_SIZE', 1000))
+
+    # Stream of the new posts: events buffered per subscriber before it has to catch up from the database, seconds
+    # between the keep-alive comments of an idle stream and between the polls of the posts written by the other
+    # workers, streams open at once per worker and posts per catch-up query
+    POST_STREAM_BUFFER_SIZE: int = int(os.getenv('POST_STREAM_BUFFER_SIZE', 64))
+    POST_STREAM_HEARTBEAT_SECONDS: float = float(os.getenv('POST_STREAM_HEARTBEAT_SECONDS', 15))
+    POST_STREAM_MAX_SUBSCRIBERS: int = int(os.getenv('POST_STREAM_MAX_SUBSCRIBERS', 10000))
+    POST_STREAM_BACKFILL_PAGE_SIZE: int = int(os.getenv('POST_STREAM_BACKFILL_PAGE_SIZE', 100))
+
+    # SQL statements slower than this are logged and counted in /metrics
+    SLOW_QUERY_THRESHOLD_MS: float = float(os.getenv('SLOW_QUERY_THRESHOLD_MS', 100))
+    # Let a request ask for its own cProfile report with ?__profile=1, never enable it in production
+    PROFILING_ENABLED: bool = os.getenv('PROFILING_ENABLED', 'false').lower() in ('1', 'true', 'yes')
+
+    # Token buckets of the routes that cost a bcrypt call or a write, '<rule>=<requests>/<second|minute|hour>' comma
+    # separated. A rule is '<route>_ip', per client address, or '<route>_user', per username or author. A value in the
+    # environment only replaces the rules it names. "memory" keeps the buckets per process, "none" turns it off.
+    RATE_LIMIT_BACKEND: str = os.getenv('RATE_LIMIT_BACKEND', 'memory')
+    RATE_LIMIT_MAX_KEYS: int = int(os.getenv('RATE_LIMIT_MAX_KEYS', 100000))
+    RATE_LIMITS: dict = {
+        "token_ip": "30/minute",
+        "token_user": "10/minute",
+        "create_author_ip": "20/minute",
+        "create_post_user": "120/minute",
+        "create_posts_bulk_user": "10/minute",
+        **dict(rule.strip().split('=', 1) for rule in os.getenv('RATE_LIMITS', '').split(',') if rule.strip()),
+    }
+    # Requests handled at the same time by a worker, the ones above get a 503 right away (0 for no cap). The /status
+    # and /metrics routes are never refused.
+    MAX_CONCURRENT_REQUESTS: int = int(os.getenv('MAX_CONCURRENT_REQUESTS', 256))
+
+    # serve.py: address, number of uvicorn workers and how long a stopped worker may take to finish its requests
+    SERVE_HOST: str = os.getenv('SERVE_HOST', '127.0.0.1')
+    SERVE_PORT: int = int(os.getenv('SERVE_PORT', 7000))
+    SERVE_WORKERS: int = int(os.getenv('SERVE_WORKERS', 1))
+    SERVE_GRACEFUL_TIMEOUT_SECONDS: float = float(os.getenv('SERVE_GRACEFUL_TIMEOUT_SECONDS', 30))
+    # Import the app once in the supervisor and fork the workers from it: less memory and faster restarts, but a
+    # reload (SIGHUP) then keeps the code of the supervisor
+    SERVE_PRELOAD: bool = os.getenv('SERVE_PRELOAD', 'false').lower() in ('1', 'true', 'yes')
+    # Open the pooled connections and compile the templates before a worker accepts its first request
+    SERVE_PREWARM: bool = os.getenv('SERVE_PREWARM', 'true').lower() in ('1', 'true', 'yes')
+
 
 # Store the class inside a variable to declare once for multiple usage
 settings = Settings()
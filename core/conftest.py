@@ -0,0 +1,89 @@
+import os
+import tempfile
+
+os.environ.setdefault("SECRET_KEY", "test-secret-key")
+os.environ.setdefault("ALGORITHM", "HS256")
+# Importing the app must not touch the committed sql_app.db
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{tempfile.mkdtemp()}/app.db")
+
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, event
+from sqlalchemy.ext.asyncio import create_async_engine
+
+import models
+from caching import principal_cache, response_cache
+from database import AsyncSessionLocal, async_engine, tune_sqlite
+from instrumentation import instrument_engine
+from main import app
+from ratelimit import rate_limiter
+
+
+@pytest.fixture
+def db_engine(tmp_path):
+    db_path = tmp_path / "test.db"
+    models.Base.metadata.create_all(bind=create_engine(f"sqlite:///{db_path}"))
+    test_engine = create_async_engine(f"sqlite+aiosqlite:///{db_path}")
+    tune_sqlite(test_engine.sync_engine)
+    instrument_engine(test_engine.sync_engine)
+    return test_engine
+
+
+@pytest.fixture
+def client(db_engine):
+    # Every session of the app, on the primary and on the read path, now goes to the test database
+    AsyncSessionLocal.configure(bind=db_engine)
+    principal_cache.clear()
+    rate_limiter.clear()
+    response_cache.clear()
+    # The TrustedHostMiddleware rejects the default "testserver" host
+    with TestClient(app, base_url="http://localhost") as test_client:
+        yield test_client
+    AsyncSessionLocal.configure(bind=async_engine)
+
+
+@pytest.fixture
+def sql_statements(db_engine):
+    """
+    Every SQL statement sent to the test database while the test runs
+    """
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(db_engine.sync_engine, "before_cursor_execute", before_cursor_execute)
+    yield statements
+    event.remove(db_engine.sync_engine, "before_cursor_execute", before_cursor_execute)
+
+
+@pytest.fixture
+def sqlite_statements(db_engine):
+    """
+    Every statement SQLite runs on the test database while the test runs, with the BEGIN and COMMIT sent by the
+    sqlite3 module on its own
+    """
+    statements = []
+
+    def trace(dbapi_connection, connection_record):
+        driver_connection = dbapi_connection.driver_connection
+        dbapi_connection.await_(driver_connection._execute(driver_connection._conn.set_trace_callback,
+                                                           statements.append))
+
+    event.listen(db_engine.sync_engine, "connect", trace)
+    yield statements
+    event.remove(db_engine.sync_engine, "connect", trace)
+
+
+@pytest.fixture
+def author(client):
+    response = client.post("/authors/", json={"username": "greg", "password": "secret"})
+    assert response.status_code == 200
+    return response.json()
+
+
+@pytest.fixture
+def auth_headers(client, author):
+    response = client.post("/token", data={"username": "greg", "password": "secret"})
+    assert response.status_code == 200
+    return {"Authorization": f"Bearer {response.json()['access_token']}"}
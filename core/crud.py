@@ -1,82 +1,340 @@
 """
 Handle database queries
 """
-import sqlalchemy.exc
+import collections
+import re
+from typing import Optional
 
-from security import get_password_hash
-from sqlalchemy.orm import Session
+from sqlalchemy import func, insert, literal_column, select, update
+from sqlalchemy.exc import IntegrityError, OperationalError
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import joinedload, noload, selectinload
+
+from caching import principal_cache, response_cache
+from pubsub import post_broker, post_event
+from security import async_get_password_hash
 import models
 import schemas
 
+# Ways of loading Authors.posts, so every endpoint can pick the one that fits its query:
+# "selectin" batches the posts of all the returned authors in one extra query, "joined" loads them in the same query
+# and "none" does not load them at all (the authors come back with an empty posts list)
+POSTS_LOADERS = {
+    "selectin": selectinload,
+    "joined": joinedload,
+    "none": noload,
+}
+
 
-def get_author(db: Session, author_id: int):
+def _paginate(query, id_column, skip: int, limit: int, after_id: Optional[int]):
+    """
+    Apply offset or keyset pagination to a query, rows are always ordered by id so both modes give the same pages
+    :param query: the select to paginate
+    :param id_column: indexed id column of the queried table
+    :param skip: how many rows to skip in offset mode
+    :param limit: page size
+    :param after_id: last id of the previous page in keyset mode
+    :return: the paginated select
+    """
+    query = query.order_by(id_column).limit(limit)
+    if after_id is not None:
+        return query.filter(id_column > after_id)
+    return query.offset(skip)
+
+
+async def get_author(db: AsyncSession, author_id: int, posts_loading: str = "joined"):
     """
     Get an author by id
     :param db: addresses the session of the database
     :param author_id: stores the given id
+    :param posts_loading: how the author's posts are loaded, one of POSTS_LOADERS
     :return: first query from Author's table with the same given author's id
     """
-    return db.query(models.Authors).filter(models.Authors.id == author_id).one_or_none()
+    query = select(models.Authors).options(POSTS_LOADERS[posts_loading](models.Authors.posts))
+    result = await db.execute(query.filter(models.Authors.id == author_id))
+    return result.unique().scalars().one_or_none()
 
 
-def get_author_by_username(db: Session, username: str):
+async def get_authors_by_ids(db: AsyncSession, author_ids: list, posts_loading: str = "selectin"):
+    """
+    Get the authors of a list of ids in one query
+    :param db: addresses the session of the database
+    :param author_ids: ids of the wanted authors
+    :param posts_loading: how the authors' posts are loaded, one of POSTS_LOADERS
+    :return: list of the authors found, in no particular order
+    """
+    query = select(models.Authors).options(POSTS_LOADERS[posts_loading](models.Authors.posts))
+    result = await db.execute(query.filter(models.Authors.id.in_(author_ids)))
+    return result.unique().scalars().all()
+
+
+async def get_author_by_username(db: AsyncSession, username: str):
     """
     Get an author by username
     :param db: addresses the session of the database
     :param username: stores the given username
     :return: first query from Author's table with the same given author's username
     """
-    return db.query(models.Authors).filter(models.Authors.username == username).one_or_none()
+    result = await db.execute(select(models.Authors).filter(models.Authors.username == username))
+    return result.scalars().one_or_none()
 
 
-def get_authors(db: Session, skip: int = 0, limit: int = 10):
+async def get_authors(db: AsyncSession, skip: int = 0, limit: int = 10, posts_loading: str = "selectin",
+                      after_id: Optional[int] = None):
     """
     Get a specific query of authors
     :param db: addresses the session of the database
     :param skip: how many authors we need to skip first (from where we should start)
     :param limit: how many authors we want to see
+    :param posts_loading: how the authors' posts are loaded, one of POSTS_LOADERS
+    :param after_id: if given, the page starts right after this id through the primary key index and skip is ignored
     :return: query from skip to limit from Author's table
     """
-    return db.query(models.Authors).offset(skip).limit(limit).all()
+    query = select(models.Authors).options(POSTS_LOADERS[posts_loading](models.Authors.posts))
+    query = _paginate(query, models.Authors.id, skip, limit, after_id)
+    result = await db.execute(query)
+    return result.unique().scalars().all()
+
+
+async def get_authors_rows(db: AsyncSession, skip: int = 0, limit: int = 10, include_posts: bool = True,
+                           after_id: Optional[int] = None):
+    """
+    Same page as get_authors, as plain dicts with the keys of schemas.Author, built from the needed columns only
+    :param db: addresses the session of the database
+    :param skip: how many authors we need to skip first (from where we should start)
+    :param limit: how many authors we want to see
+    :param include_posts: if false, every author has an empty posts list
+    :param after_id: if given, the page starts right after this id and skip is ignored
+    :return: list of dicts
+    """
+    query = select(models.Authors.username, models.Authors.id, models.Authors.is_active)
+    result = await db.execute(_paginate(query, models.Authors.id, skip, limit, after_id))
+    authors = [{**row, "posts": []} for row in result.mappings()]
+    if include_posts and authors:
+        authors_by_id = {author["id"]: author for author in authors}
+        posts = await db.execute(_post_columns().filter(models.Posts.owner_id.in_(list(authors_by_id)))
+                                 .order_by(models.Posts.id))
+        for post in posts.mappings():
+            authors_by_id[post["owner_id"]]["posts"].append(dict(post))
+    return authors
+
+
+async def get_authors_summary(db: AsyncSession, skip: int = 0, limit: int = 10, after_id: Optional[int] = None):
+    """
+    Get a page of authors with their number of posts, from the authors table only
+    :param db: addresses the session of the database
+    :param skip: how many authors we need to skip first (from where we should start)
+    :param limit: how many authors we want to see
+    :param after_id: if given, the page starts right after this id and skip is ignored
+    :return: list of rows with id, username and post_count
+    """
+    query = select(models.Authors.id, models.Authors.username, models.Authors.post_count)
+    result = await db.execute(_paginate(query, models.Authors.id, skip, limit, after_id))
+    return result.all()
 
 
-def create_author(db: Session, author: schemas.AuthorCreate):
+async def get_table_versions(db: AsyncSession, tables: tuple) -> Optional[tuple]:
+    """
+    Current versions of tables, a primary key lookup that is much cheaper than the queries they stand for
+    :param db: addresses the session of the database
+    :param tables: names of the tables, from models.VERSIONED_TABLES
+    :return: their versions in the same order, or None if the database doesn't track them
+    """
+    try:
+        result = await db.execute(select(models.TableVersions.name, models.TableVersions.version)
+                                  .filter(models.TableVersions.name.in_(tables)))
+    except OperationalError as error:
+        # A database from before the table_versions migration, the pages are served without ETag
+        if "no such table" not in str(error.orig):
+            raise
+        return None
+    versions = dict(result.all())
+    if len(versions) != len(tables):
+        return None
+    return tuple(versions[name] for name in tables)
+
+
+def _bump_versions(*tables: str):
+    """
+    Statement counting a write of tables, to run in the transaction of the write
+    :param tables: names of the written tables
+    :return: the update statement
+    """
+    return (update(models.TableVersions).filter(models.TableVersions.name.in_(tables))
+            .values(version=models.TableVersions.version + 1))
+
+
+def _count_posts(author_id: int, created: int):
+    """
+    Statement adding the created posts to the author's post_count, to run in the transaction creating them
+    :param author_id: id of the posts' author
+    :param created: how many posts were created
+    :return: the update statement
+    """
+    return (update(models.Authors).filter(models.Authors.id == author_id)
+            .values(post_count=models.Authors.post_count + created))
+
+
+async def _begin_outer_transaction(db: AsyncSession):
+    """
+    Open the database transaction of a session before its first savepoint. In its default transaction mode, the
+    sqlite3 module sends no BEGIN before a SAVEPOINT, so every released savepoint would commit on its own.
+    :param db: a session that didn't run any statement yet
+    """
+    connection = await db.connection()
+    if connection.dialect.name == "sqlite":
+        await connection.exec_driver_sql("BEGIN")
+
+
+def _publish_posts(posts):
+    """
+    Send the committed posts to the subscribers of the posts stream
+    :param posts: the new posts, models.Posts or schemas.Post, in id order
+    """
+    for post in posts:
+        post_broker.publish(post_event({"title": post.title, "description": post.description, "id": post.id,
+                                        "owner_id": post.owner_id}))
+
+
+async def create_author(db: AsyncSession, author: schemas.AuthorCreate):
     """
     Creates a new author to the database
     :param db: addresses the session of the database
     :param author: dict of infos for the post request
     :return: query of the created author in Author's table
     """
-    author.password = get_password_hash(author.password)
-    db_author = models.Authors(username=author.username, password=author.password)
+    author.password = await async_get_password_hash(author.password)
+    # A new author has no posts, so the collection is set up front instead of being lazy loaded later
+    db_author = models.Authors(username=author.username, password=author.password, posts=[])
     db.add(db_author)
-    db.commit()
-    db.refresh(db_author)
+    await db.execute(_bump_versions("authors"))
+    await db.commit()
+    principal_cache.delete(db_author.username)
+    response_cache.invalidate("author", db_author.id)
     return db_author
 
 
-def get_post(db: Session, post_id: int):
+async def get_post(db: AsyncSession, post_id: int, with_owner: bool = False):
     """
     Get a specific post from database
     :param db: addresses the session of the database
     :param post_id: stores the post's id
+    :param with_owner: also load the post's author in the same query
     :return: a single query where the post's id matches a Post_id in the db
     """
-    return db.query(models.Posts).filter(models.Posts.id == post_id).one_or_none()
+    query = select(models.Posts).filter(models.Posts.id == post_id)
+    if with_owner:
+        query = query.options(joinedload(models.Posts.owner))
+    result = await db.execute(query)
+    return result.scalars().one_or_none()
 
 
-def get_posts(db: Session, skip: int = 0, limit: int = 10):
+async def get_posts(db: AsyncSession, skip: int = 0, limit: int = 10, after_id: Optional[int] = None):
     """
     Get a query of many posts
     :param db: addresses the session of the database
     :param skip: how many posts we need to skip first (from where we should start)
     :param limit: how many posts we want to see
+    :param after_id: if given, the page starts right after this id through the primary key index and skip is ignored
     :return: query from skip to limit from Posts' table
     """
-    return db.query(models.Posts).offset(skip).limit(limit).all()
+    result = await db.execute(_paginate(select(models.Posts), models.Posts.id, skip, limit, after_id))
+    return result.scalars().all()
+
+
+async def get_post_id_from_end(db: AsyncSession, position: int) -> Optional[int]:
+    """
+    Id of a post counted from the newest one
+    :param db: addresses the session of the database
+    :param position: 0 for the newest post
+    :return: the id, or None if there are not that many posts
+    """
+    result = await db.execute(select(models.Posts.id).order_by(models.Posts.id.desc()).offset(position).limit(1))
+    return result.scalar_one_or_none()
+
+
+async def count_posts_between(db: AsyncSession, first_id: int, last_id: int) -> int:
+    """
+    Number of posts with an id in a range
+    :param db: addresses the session of the database
+    :param first_id: lowest id of the range
+    :param last_id: highest id of the range
+    :return: the number of posts
+    """
+    result = await db.execute(select(func.count()).select_from(models.Posts)
+                              .where(models.Posts.id.between(first_id, last_id)))
+    return result.scalar_one()
+
+
+def _fts_query(text: str) -> str:
+    """
+    Turn the searched text into an FTS5 query where every word must match, the FTS5 operators are not interpreted
+    :param text: the text given by the client
+    :return: the MATCH expression, empty if the text has no words
+    """
+    return " ".join(f'"{word}"' for word in re.findall(r"\w+", text))
+
+
+async def search_posts(db: AsyncSession, text: str, skip: int = 0, limit: int = 10):
+    """
+    Search the posts through the full text index of their title and description
+    :param db: addresses the session of the database
+    :param text: the searched words
+    :param skip: how many results we need to skip first
+    :param limit: how many results we want to see
+    :return: the matching posts, best ranked (bm25) first
+    """
+    query = _fts_query(text)
+    if not query:
+        return []
+    result = await db.execute(
+        select(models.Posts)
+        .join(models.posts_fts, models.posts_fts.c.rowid == models.Posts.id)
+        .filter(literal_column("posts_fts").op("MATCH")(query))
+        .order_by(models.posts_fts.c.rank, models.Posts.id)
+        .offset(skip)
+        .limit(limit)
+    )
+    return result.scalars().all()
+
+
+async def stream_posts(db: AsyncSession, owner_id: Optional[int] = None, fetch_size: int = 1000):
+    """
+    Read posts with a server side cursor, without loading the whole table
+    :param db: addresses the session of the database
+    :param owner_id: if given, only the posts of this author
+    :param fetch_size: how many rows are fetched from the cursor at a time
+    :return: async iterator of the posts rows (title, description, id, owner_id), ordered by id
+    """
+    query = _post_columns()
+    if owner_id is not None:
+        query = query.filter(models.Posts.owner_id == owner_id)
+    result = await db.stream(query.order_by(models.Posts.id).execution_options(yield_per=fetch_size))
+    async for row in result:
+        yield row
+
+
+def _post_columns():
+    """
+    Select of the posts columns, in the order of the schemas.Post keys
+    """
+    return select(models.Posts.title, models.Posts.description, models.Posts.id, models.Posts.owner_id)
+
+
+async def get_posts_rows(db: AsyncSession, skip: int = 0, limit: int = 10, after_id: Optional[int] = None):
+    """
+    Same page as get_posts, as plain dicts with the keys of schemas.Post, built from the needed columns only
+    :param db: addresses the session of the database
+    :param skip: how many posts we need to skip first (from where we should start)
+    :param limit: how many posts we want to see
+    :param after_id: if given, the page starts right after this id and skip is ignored
+    :return: list of dicts
+    """
+    result = await db.execute(_paginate(_post_columns(), models.Posts.id, skip, limit, after_id))
+    return [dict(row) for row in result.mappings()]
 
 
-def create_author_post(db: Session, post: schemas.PostCreate, author_id: int):
+async def create_author_post(db: AsyncSession, post: schemas.PostCreate, author_id: int):
     """
     Create a new post
     :param db: addresses the session of the database
@@ -86,6 +344,120 @@ def create_author_post(db: Session, post: schemas.PostCreate, author_id: int):
     """
     db_post = models.Posts(**post.dict(), owner_id=author_id)
     db.add(db_post)
-    db.commit()
-    db.refresh(db_post)
+    await db.execute(_count_posts(author_id, 1))
+    await db.execute(_bump_versions("posts", "authors"))
+    await db.commit()
+    await db.refresh(db_post)
+    # The author's page lists its posts
+    response_cache.invalidate("author", author_id)
+    response_cache.invalidate("post", db_post.id)
+    response_cache.invalidate("article", db_post.id)
+    _publish_posts([db_post])
     return db_post
+
+
+async def create_posts_of_authors(db: AsyncSession, posts: list[tuple[schemas.PostCreate, int]]):
+    """
+    Create posts of any authors in one transaction, with a savepoint each so a failing post doesn't cancel the others
+    :param db: addresses the session of the database
+    :param posts: (post, author id) pairs
+    :return: for every given post, in the same order, the created post or the IntegrityError it raised
+    """
+    results = []
+    created_per_author = collections.Counter()
+    await _begin_outer_transaction(db)
+    for post, author_id in posts:
+        db_post = models.Posts(**post.dict(), owner_id=author_id)
+        try:
+            async with db.begin_nested():
+                db.add(db_post)
+        except IntegrityError as error:
+            results.append(error)
+        else:
+            results.append(db_post)
+            created_per_author[author_id] += 1
+    for author_id, created in created_per_author.items():
+        await db.execute(_count_posts(author_id, created))
+    if created_per_author:
+        await db.execute(_bump_versions("posts", "authors"))
+    await db.commit()
+    for author_id in created_per_author:
+        response_cache.invalidate("author", author_id)
+    created_posts = [result for result in results if isinstance(result, models.Posts)]
+    for db_post in created_posts:
+        response_cache.invalidate("post", db_post.id)
+        response_cache.invalidate("article", db_post.id)
+    _publish_posts(sorted(created_posts, key=lambda db_post: db_post.id))
+    return results
+
+
+async def create_author_posts(db: AsyncSession, posts: list[tuple[int, schemas.PostCreate]], author_id: int):
+    """
+    Create many posts of an author in one transaction, with a single executemany insert
+    :param db: addresses the session of the database
+    :param posts: (index, post) pairs, the index identifies the post in the results
+    :param author_id: id of the current author/user
+    :return: list of schemas.BulkPostResult, one for every given post
+    """
+    results = []
+    accepted = {}
+    for index, post in posts:
+        if post.title in accepted:
+            results.append(schemas.BulkPostResult(index=index, error="Duplicate title in the request"))
+        else:
+            accepted[post.title] = (index, post)
+
+    # Titles are unique, the ones already used are reported instead of failing the whole insert
+    existing = await db.execute(select(models.Posts.title).filter(models.Posts.title.in_(list(accepted))))
+    for title in existing.scalars():
+        index, _ = accepted.pop(title)
+        results.append(schemas.BulkPostResult(index=index, error="Title already exists"))
+
+    if accepted:
+        rows = [{**post.dict(), "owner_id": author_id} for _, post in accepted.values()]
+        try:
+            await db.execute(insert(models.Posts), rows)
+            await db.execute(_count_posts(author_id, len(rows)))
+            await db.execute(_bump_versions("posts", "authors"))
+            await db.commit()
+        except IntegrityError:
+            # Another writer took one of the titles since they were checked, fall back to one insert per post
+            await db.rollback()
+            return results + await _create_author_posts_one_by_one(db, list(accepted.values()), author_id)
+        created = await db.execute(select(models.Posts).filter(models.Posts.title.in_(list(accepted)))
+                                   .order_by(models.Posts.id))
+        created_posts = created.scalars().all()
+        for db_post in created_posts:
+            index, _ = accepted[db_post.title]
+            results.append(schemas.BulkPostResult(index=index, post=schemas.Post.from_orm(db_post)))
+        response_cache.invalidate("author", author_id)
+        _publish_posts(created_posts)
+    return results
+
+
+async def _create_author_posts_one_by_one(db: AsyncSession, posts: list[tuple[int, schemas.PostCreate]],
+                                          author_id: int):
+    """
+    Create posts in one transaction with a savepoint each, so a failing post doesn't cancel the others
+    :param db: addresses the session of the database
+    :param posts: (index, post) pairs
+    :param author_id: id of the current author/user
+    :return: list of schemas.BulkPostResult, one for every given post
+    """
+    results = []
+    await _begin_outer_transaction(db)
+    for index, post in posts:
+        db_post = models.Posts(**post.dict(), owner_id=author_id)
+        try:
+            async with db.begin_nested():
+                db.add(db_post)
+        except IntegrityError:
+            results.append(schemas.BulkPostResult(index=index, error="Title already exists"))
+        else:
+            results.append(schemas.BulkPostResult(index=index, post=schemas.Post.from_orm(db_post)))
+    await db.execute(_count_posts(author_id, sum(result.post is not None for result in results)))
+    await db.execute(_bump_versions("posts", "authors"))
+    await db.commit()
+    response_cache.invalidate("author", author_id)
+    _publish_posts([result.post for result in results if result.post is not None])
+    return results
@@ -1,17 +1,187 @@
 """
 Database narratives
 """
-from sqlalchemy import create_engine
+import itertools
+import logging
+import os
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+
+from config.settings import settings
+
+logger = logging.getLogger(__name__)
+
+# Supported databases -> (sync driver, asyncio driver). Only SQLite: the search reads an FTS5 table and the migrations
+# create it.
+DRIVERS = {"sqlite": ("pysqlite", "aiosqlite")}
+
+
+def database_url(url: str, is_async: bool) -> str:
+    """
+    Same database, through the driver of the sync or of the async engine, whatever driver the URL names
+    :param url: the database URL, e.g. sqlite:///./sql_app.db or sqlite+aiosqlite:///./sql_app.db
+    :param is_async: if the URL is for create_async_engine
+    :return: the URL with the driver of DRIVERS, or a ValueError for another database
+    """
+    url = make_url(url)
+    backend = url.get_backend_name()
+    if backend not in DRIVERS:
+        raise ValueError(f"Unsupported database {backend!r}, the database URLs must be SQLite ones")
+    return url.set(drivername=f"{backend}+{DRIVERS[backend][is_async]}").render_as_string(hide_password=False)
+
+
+def async_database_url(url: str) -> str:
+    """
+    Same database, through the asyncio driver
+    :param url: the database URL
+    :return: check database_url
+    """
+    return database_url(url, is_async=True)
+
+
+SQLALCHEMY_DATABASE_URL = database_url(settings.DATABASE_URL, is_async=False)  # Connect to database
+ASYNC_SQLALCHEMY_DATABASE_URL = async_database_url(SQLALCHEMY_DATABASE_URL)
+
+
+def engine_options(url: str, is_async: bool) -> dict:
+    """
+    Connection pool arguments for an engine
+    :param url: the database URL
+    :param is_async: if the engine is created with create_async_engine
+    :return: keyword arguments for create_engine/create_async_engine
+    """
+    url = make_url(url)
+    if url.get_backend_name() != "sqlite":
+        return {"pool_size": settings.DB_POOL_SIZE, "max_overflow": settings.DB_MAX_OVERFLOW,
+                "pool_timeout": settings.DB_POOL_TIMEOUT, "pool_recycle": settings.DB_POOL_RECYCLE}
+    options = {"connect_args": {"check_same_thread": False}}
+    if url.database and url.database != ":memory:":
+        # SQLite file databases don't use a queue pool by default with every driver, it is set explicitly
+        options.update(poolclass=AsyncAdaptedQueuePool if is_async else QueuePool, pool_size=settings.DB_POOL_SIZE,
+                       max_overflow=settings.DB_MAX_OVERFLOW, pool_timeout=settings.DB_POOL_TIMEOUT,
+                       pool_recycle=settings.DB_POOL_RECYCLE)
+    return options
+
+
+def tune_sqlite(sync_engine: Engine):
+    """
+    Apply the SQLite PRAGMAs of the settings to every new connection of an engine
+    :param sync_engine: the engine, or the sync_engine of an async engine
+    """
+    if sync_engine.dialect.name != "sqlite":
+        return
+
+    @event.listens_for(sync_engine, "connect")
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute(f"PRAGMA journal_mode={settings.SQLITE_JOURNAL_MODE}")
+        cursor.execute(f"PRAGMA synchronous={settings.SQLITE_SYNCHRONOUS}")
+        cursor.execute(f"PRAGMA mmap_size={settings.SQLITE_MMAP_SIZE}")
+        cursor.execute(f"PRAGMA cache_size={settings.SQLITE_CACHE_SIZE}")
+        cursor.execute(f"PRAGMA busy_timeout={settings.SQLITE_BUSY_TIMEOUT_MS}")
+        cursor.close()
+
+
+def pool_status(sync_engine: Engine) -> dict:
+    """
+    Usage of an engine's connection pool, to size it from real numbers
+    :param sync_engine: the engine, or the sync_engine of an async engine
+    :return: dict with the pool's counters
+    """
+    pool = sync_engine.pool
+    status = {"pool_class": type(pool).__name__, "status": pool.status()}
+    if isinstance(pool, QueuePool):
+        status.update(size=pool.size(), checked_in=pool.checkedin(), checked_out=pool.checkedout(),
+                      overflow=pool.overflow())
+    return status
+
+
+def log_pool_status(sync_engine: Engine):
+    """
+    Write the pool usage to the log
+    :param sync_engine: the engine, or the sync_engine of an async engine
+    """
+    logger.info("Database pool %s: %s", sync_engine.url.render_as_string(hide_password=True),
+                pool_status(sync_engine))
 
-SQLALCHEMY_DATABASE_URL = "sqlite:///./sql_app.db"  # Connect to database
 
 # Add an engine to use the db
-engine = create_engine(SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False})
+engine = create_engine(SQLALCHEMY_DATABASE_URL, **engine_options(SQLALCHEMY_DATABASE_URL, is_async=False))
+tune_sqlite(engine)
+
+# The async engine is the one used by the application, the sync one stays for alembic and scripts
+async_engine = create_async_engine(ASYNC_SQLALCHEMY_DATABASE_URL,
+                                   **engine_options(ASYNC_SQLALCHEMY_DATABASE_URL, is_async=True))
+tune_sqlite(async_engine.sync_engine)
 
 # Create a new session for the engine
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# Async sessions keep their attributes after commit, so the returned objects can still be serialized
+AsyncSessionLocal = sessionmaker(async_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
+
+
+class ReadRouter:
+    """
+    Picks the session factory of the read-only routes: the replicas in round-robin, or the primary when there are none
+    """
+
+    def __init__(self, primary: sessionmaker, replicas: list):
+        self.primary = primary
+        self.set_replicas(replicas)
+
+    def set_replicas(self, replicas: list):
+        """
+        Replace the replica session factories
+        :param replicas: list of sessionmaker, bound to the replica engines
+        """
+        self.replicas = list(replicas)
+        self._next_replica = itertools.cycle(self.replicas)
+
+    def read_sessionmaker(self) -> sessionmaker:
+        """
+        The session factory to use for the next read-only request
+        :return: the next replica's sessionmaker, or the primary one
+        """
+        if not self.replicas:
+            return self.primary
+        return next(self._next_replica)
+
+
+def create_replica_engine(url: str):
+    """
+    Create a tuned async engine for a read replica
+    :param url: the replica's database URL
+    :return: the async engine
+    """
+    replica_url = async_database_url(url)
+    replica_engine = create_async_engine(replica_url, **engine_options(replica_url, is_async=True))
+    tune_sqlite(replica_engine.sync_engine)
+    return replica_engine
+
+
+replica_engines = [create_replica_engine(url) for url in settings.DATABASE_REPLICA_URLS]
+read_router = ReadRouter(AsyncSessionLocal, [
+    sessionmaker(replica_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
+    for replica_engine in replica_engines
+])
+
+
+def forget_connections_after_fork():
+    """
+    A forked worker must not use the connections it inherited, the parent still owns them: drop them from the pools
+    without closing them, the child opens its own on first use
+    """
+    for database_engine in [engine, async_engine, *replica_engines]:
+        getattr(database_engine, "sync_engine", database_engine).dispose(close=False)
+
+
+os.register_at_fork(after_in_child=forget_connections_after_fork)
+
 # To check the usage for declarative_base, you can check the documentation
 Base = declarative_base()
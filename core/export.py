@@ -0,0 +1,37 @@
+"""
+Streamed encodings of the posts export
+"""
+import json
+from typing import AsyncIterator
+
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+JSON_MEDIA_TYPE = "application/json"
+
+
+def _encode_post(row) -> str:
+    # Same keys, in the same order, as schemas.Post
+    return json.dumps({"title": row.title, "description": row.description, "id": row.id, "owner_id": row.owner_id},
+                      ensure_ascii=False, separators=(",", ":"))
+
+
+async def ndjson_lines(rows: AsyncIterator) -> AsyncIterator[bytes]:
+    """
+    Encode the rows as one JSON document per line
+    :param rows: posts rows, as they are fetched
+    :return: encoded lines
+    """
+    async for row in rows:
+        yield (_encode_post(row) + "\n").encode()
+
+
+async def json_array(rows: AsyncIterator) -> AsyncIterator[bytes]:
+    """
+    Encode the rows as a single JSON array, written one item at a time
+    :param rows: posts rows, as they are fetched
+    :return: encoded pieces of the array
+    """
+    separator = "["
+    async for row in rows:
+        yield (separator + _encode_post(row)).encode()
+        separator = ","
+    yield b"[]" if separator == "[" else b"]"
@@ -0,0 +1,327 @@
+"""
+In-process read model of the newest posts, answering the id lookups and id ordered pages of the posts without the
+database, the ORM or pydantic
+"""
+import array
+import asyncio
+import bisect
+import logging
+import mmap
+import os
+import struct
+import tempfile
+from typing import NamedTuple, Optional
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+import crud
+from caching import private_directory
+from config.settings import settings
+from serialization import dumps
+
+logger = logging.getLogger(__name__)
+
+# Snapshot layout: magic, post count, complete flag, the ids, the offsets of the bodies in the blob, the blob.
+# Integers are in the native byte order, a snapshot is only read on the host that wrote it.
+SNAPSHOT_MAGIC = b"HOTPOST1"
+SNAPSHOT_HEADER = struct.Struct("=8sqq")
+# Posts read from the database per query when the index is built or extended
+LOAD_PAGE_SIZE = 10000
+
+
+class HotPost(NamedTuple):
+    """
+    A post of the index, id and JSON body as sent by the posts routes
+    """
+    id: int
+    body: bytes
+
+
+class _Segment:
+    """
+    Posts in id order, stored as columns: their ids, and their JSON bodies one after the other in a blob
+    """
+    __slots__ = ("ids", "offsets", "blob")
+
+    def __init__(self, ids=None, offsets=None, blob=None):
+        self.ids = array.array("q") if ids is None else ids
+        self.offsets = array.array("q", [0]) if offsets is None else offsets
+        self.blob = bytearray() if blob is None else blob
+
+    def append(self, post_id: int, body: bytes):
+        self.ids.append(post_id)
+        self.blob += body
+        self.offsets.append(len(self.blob))
+
+    def body(self, position: int) -> bytes:
+        return bytes(self.blob[self.offsets[position]:self.offsets[position + 1]])
+
+    def __len__(self):
+        return len(self.ids)
+
+
+class HotPosts:
+    """
+    The newest posts, at most about max_posts of them. Posts are never updated nor deleted, so the index holds every
+    post between its first and last id and only has to learn the new ones: it reads them from the database when a
+    lookup or a page goes past its last id, whichever worker wrote them. A snapshot written at shutdown is memory
+    mapped at the next start, its pages are shared by the workers of the host.
+    """
+
+    def __init__(self, max_posts: int):
+        self.max_posts = max_posts
+        self.loaded = False
+        # True when the index holds every post of the table, it can then serve the offset pages too
+        self.complete = False
+        self.hits = 0
+        self.misses = 0
+        self.from_snapshot = False
+        # Version of the posts table (crud.get_table_versions) the index last caught up with
+        self._synced_version: Optional[int] = None
+        # Posts of the snapshot, read-only views of the mapped file, then the posts learnt since
+        self._base = _Segment()
+        self._tail = _Segment()
+        self._extend_lock = asyncio.Lock()
+
+    def __len__(self):
+        return len(self._base) + len(self._tail)
+
+    def _id_at(self, position: int) -> int:
+        if position < len(self._base):
+            return self._base.ids[position]
+        return self._tail.ids[position - len(self._base)]
+
+    def _post_at(self, position: int) -> HotPost:
+        if position < len(self._base):
+            return HotPost(self._base.ids[position], self._base.body(position))
+        position -= len(self._base)
+        return HotPost(self._tail.ids[position], self._tail.body(position))
+
+    def _position(self, post_id: int) -> int:
+        """
+        Position of the first post with an id above post_id
+        """
+        if len(self._base) and post_id < self._base.ids[-1]:
+            return bisect.bisect_right(self._base.ids, post_id)
+        return len(self._base) + bisect.bisect_right(self._tail.ids, post_id)
+
+    @property
+    def first_id(self) -> Optional[int]:
+        return self._id_at(0) if len(self) else None
+
+    @property
+    def last_id(self) -> int:
+        return self._id_at(len(self) - 1) if len(self) else 0
+
+    def _covers(self, post_id: int) -> bool:
+        return self.complete or (len(self) > 0 and post_id >= self.first_id)
+
+    def _serves(self, skip: int, limit: int, after_id: Optional[int]) -> bool:
+        if not self.loaded or skip < 0 or limit < 0:
+            return False
+        return self._covers(after_id + 1) if after_id is not None else self.complete
+
+    def _append(self, rows: list):
+        for row in rows:
+            self._tail.append(row["id"], dumps(row))
+        # Evicted by chunks, so the columns aren't copied for every new post
+        if len(self) > self.max_posts * 1.25:
+            self._base, self._tail = _Segment(), self._copy(len(self) - self.max_posts)
+            self.complete = False
+
+    def _copy(self, start: int) -> _Segment:
+        """
+        The posts from a position to the end, in a single segment
+        """
+        copy = _Segment()
+        for position in range(start, len(self)):
+            post = self._post_at(position)
+            copy.append(post.id, post.body)
+        return copy
+
+    async def _read_after(self, db: AsyncSession, after_id: int):
+        """
+        Append the posts of the database after an id, by pages
+        """
+        while True:
+            rows = await crud.get_posts_rows(db, limit=LOAD_PAGE_SIZE, after_id=after_id)
+            self._append(rows)
+            if len(rows) < LOAD_PAGE_SIZE:
+                return
+            after_id = rows[-1]["id"]
+
+    async def _extend(self, db: AsyncSession, needed_id: int, posts_version: Optional[int] = None):
+        """
+        Read the posts created after the last one of the index
+        :param db: session to read them from
+        :param needed_id: nothing is read if the index already went past this id meanwhile
+        :param posts_version: version of the posts table read from the same session, nothing is read if the index
+        already caught up with it
+        """
+        async with self._extend_lock:
+            if needed_id > self.last_id and (posts_version is None or posts_version != self._synced_version):
+                await self._read_after(db, self.last_id)
+                self._synced_version = posts_version
+
+    async def get(self, db: AsyncSession, post_id: int) -> Optional[HotPost]:
+        """
+        Look a post up
+        :param db: session the posts written since the last lookup are read from
+        :param post_id: id of the post
+        :return: the post, None if it doesn't exist, or a LookupError if the index can't tell
+        """
+        if not self.loaded or not self._covers(post_id):
+            self.misses += 1
+            raise LookupError(post_id)
+        if post_id > self.last_id:
+            await self._extend(db, post_id)
+        self.hits += 1
+        position = self._position(post_id) - 1
+        if position < 0 or self._id_at(position) != post_id:
+            return None
+        return self._post_at(position)
+
+    async def page(self, db: AsyncSession, skip: int, limit: int, after_id: Optional[int],
+                   posts_version: Optional[int] = None) -> Optional[list]:
+        """
+        Same page as crud.get_posts
+        :param db: session the posts written since the last lookup are read from
+        :param skip: how many posts to skip, only when the index holds the whole table
+        :param limit: how many posts to return
+        :param after_id: if given, the page starts after this id and skip is ignored
+        :param posts_version: version of the posts table if the caller read it, the posts written since the last page
+        are only looked for when it changed
+        :return: list of HotPost, or None if the index can't serve this page
+        """
+        if not self._serves(skip, limit, after_id):
+            self.misses += 1
+            return None
+        start = self._position(after_id) if after_id is not None else skip
+        if start + limit > len(self):
+            # The page reaches the end of the index, the posts written since belong to it
+            await self._extend(db, self.last_id + 1, posts_version)
+            if not self._serves(skip, limit, after_id):
+                # The oldest posts were evicted meanwhile
+                self.misses += 1
+                return None
+            start = self._position(after_id) if after_id is not None else skip
+        self.hits += 1
+        return [self._post_at(position) for position in range(start, min(start + limit, len(self)))]
+
+    async def load(self, db: AsyncSession, snapshot_path: Optional[str] = None):
+        """
+        Fill the index, from the snapshot if it is still valid or else from the database
+        :param db: session to read the posts from
+        :param snapshot_path: file written by save, if any
+        """
+        self._base, self._tail = _Segment(), _Segment()
+        # Read before the posts, a post written meanwhile makes the next page look for it
+        versions = await crud.get_table_versions(db, ("posts",))
+        self._synced_version = versions[0] if versions else None
+        if snapshot_path and os.path.exists(snapshot_path):
+            try:
+                self._map(snapshot_path)
+            except (OSError, RuntimeError, ValueError, struct.error):
+                logger.warning("Unreadable hot posts snapshot %s, loading from the database", snapshot_path)
+                self._base = _Segment()
+            if len(self._base) and not await self._matches_database(db):
+                logger.warning("Hot posts snapshot %s doesn't match the database, loading from the database",
+                               snapshot_path)
+                self._base = _Segment()
+        self.from_snapshot = len(self._base) > 0
+        if self.from_snapshot:
+            # Then the posts written since the snapshot
+            await self._read_after(db, self.last_id)
+        else:
+            self.complete = await crud.get_post_id_from_end(db, self.max_posts) is None
+            first_id = await crud.get_post_id_from_end(db, self.max_posts - 1)
+            await self._read_after(db, first_id - 1 if first_id is not None else 0)
+        self.loaded = True
+
+    def _map(self, snapshot_path: str):
+        """
+        Use the posts of a snapshot file, memory mapped. Its bodies are served as they are, so it must be in a directory
+        only the user can write to.
+        """
+        private_directory(os.path.dirname(os.path.abspath(snapshot_path)))
+        with open(snapshot_path, "rb") as file:
+            if os.fstat(file.fileno()).st_uid != os.getuid():
+                raise RuntimeError(f"Hot posts snapshot of another user: {snapshot_path}")
+            mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, count, complete = SNAPSHOT_HEADER.unpack_from(mapped)
+        if magic != SNAPSHOT_MAGIC:
+            raise ValueError(f"Not a hot posts snapshot: {snapshot_path}")
+        view = memoryview(mapped)
+        ids_end = SNAPSHOT_HEADER.size + count * 8
+        offsets_end = ids_end + (count + 1) * 8
+        if len(view) < offsets_end:
+            raise ValueError(f"Truncated hot posts snapshot: {snapshot_path}")
+        base = _Segment(view[SNAPSHOT_HEADER.size:ids_end].cast("q"), view[ids_end:offsets_end].cast("q"),
+                        view[offsets_end:])
+        if base.offsets[-1] != len(base.blob):
+            raise ValueError(f"Truncated hot posts snapshot: {snapshot_path}")
+        self._base = base
+        self.complete = bool(complete)
+
+    async def _matches_database(self, db: AsyncSession) -> bool:
+        """
+        Check the snapshot against the database, it may have been replaced since: its first and last posts, and that it
+        holds as many posts as the database between them
+        """
+        for position in (0, len(self._base) - 1):
+            post = self._post_at(position)
+            rows = await crud.get_posts_rows(db, limit=1, after_id=post.id - 1)
+            if not rows or dumps(rows[0]) != post.body:
+                return False
+        if await crud.count_posts_between(db, self.first_id, self._base.ids[-1]) != len(self._base):
+            return False
+        if self.complete:
+            oldest = await crud.get_posts_rows(db, limit=1)
+            return oldest[0]["id"] == self.first_id
+        return True
+
+    def save(self, snapshot_path: str):
+        """
+        Write the index to a snapshot file, replaced at once so a starting worker never maps a partial file
+        :param snapshot_path: where to write it, in a directory only the user can write to
+        """
+        if not self.loaded:
+            return
+        directory = os.path.dirname(os.path.abspath(snapshot_path))
+        try:
+            private_directory(directory)
+        except (OSError, RuntimeError):
+            logger.warning("Hot posts snapshot not written, %s isn't a private directory of the user", directory)
+            return
+        posts = self._copy(0)
+        descriptor, temporary_path = tempfile.mkstemp(dir=directory)
+        with os.fdopen(descriptor, "wb") as file:
+            file.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, len(posts), self.complete))
+            file.write(posts.ids.tobytes())
+            file.write(posts.offsets.tobytes())
+            file.write(posts.blob)
+        os.replace(temporary_path, snapshot_path)
+
+    def stats(self) -> dict:
+        """
+        Usage of the index
+        :return: dict with the number of posts and counters
+        """
+        return {
+            "posts": len(self),
+            "complete": int(self.complete),
+            "from_snapshot": int(self.from_snapshot),
+            "hits_total": self.hits,
+            "misses_total": self.misses,
+        }
+
+
+def posts_json(posts: list) -> bytes:
+    """
+    The JSON array of posts, as the list routes send it
+    :param posts: list of HotPost
+    """
+    return b"[" + b",".join(post.body for post in posts) + b"]"
+
+
+hot_posts = HotPosts(settings.HOT_POSTS_SIZE)
@@ -0,0 +1,203 @@
+"""
+Request and query metrics, exposed in the Prometheus text format
+"""
+import bisect
+import contextvars
+import logging
+import time
+from typing import Optional
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from config.settings import settings
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds of the histogram buckets, in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Upper bounds of the histogram buckets, in SQL statements
+STATEMENT_BUCKETS = (0, 1, 2, 3, 5, 10, 25, 50, 100)
+
+
+def _labels(names: tuple, values: tuple, *extra: str) -> str:
+    """
+    Render the labels of a series, nothing when there are none
+    """
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)] + list(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Histogram:
+    """
+    Cumulative histogram with a series per set of label values
+    """
+
+    def __init__(self, name: str, documentation: str, label_names: tuple, buckets: tuple):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self.buckets = buckets
+        # label values -> [bucket counts..., +Inf count, sum]
+        self._series: dict = {}
+
+    def observe(self, value: float, *label_values):
+        """
+        Record a measure
+        :param value: the measure
+        :param label_values: values of the histogram's labels, in order
+        """
+        series = self._series.get(label_values)
+        if series is None:
+            series = self._series[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect.bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def count(self, *label_values) -> int:
+        series = self._series.get(label_values)
+        return sum(series[:-1]) if series else 0
+
+    def render(self) -> list:
+        """
+        Lines of the histogram in the Prometheus text format
+        """
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for label_values, series in sorted(self._series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), series[:-1]):
+                cumulative += count
+                bucket_labels = _labels(self.label_names, label_values, f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.label_names, label_values)} {series[-1]}")
+            lines.append(f"{self.name}_count{_labels(self.label_names, label_values)} {cumulative}")
+        return lines
+
+    def clear(self):
+        self._series.clear()
+
+
+class Counter:
+    """
+    Monotonic counter with a series per set of label values
+    """
+
+    def __init__(self, name: str, documentation: str, label_names: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self._series: dict = {}
+
+    def inc(self, *label_values, amount: float = 1):
+        self._series[label_values] = self._series.get(label_values, 0) + amount
+
+    def value(self, *label_values) -> float:
+        return self._series.get(label_values, 0)
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        for label_values, value in sorted(self._series.items()):
+            lines.append(f"{self.name}{_labels(self.label_names, label_values)} {value}")
+        return lines
+
+    def clear(self):
+        self._series.clear()
+
+
+class RequestStats:
+    """
+    SQL activity of the request being handled
+    """
+    __slots__ = ("statements", "seconds")
+
+    def __init__(self):
+        self.statements = 0
+        self.seconds = 0.0
+
+
+request_duration = Histogram("http_request_duration_seconds", "Time to answer a request",
+                             ("method", "route", "status"), LATENCY_BUCKETS)
+request_statements = Histogram("http_request_db_statements", "SQL statements sent while answering a request",
+                               ("method", "route"), STATEMENT_BUCKETS)
+request_db_duration = Histogram("http_request_db_duration_seconds", "Time spent in SQL statements by a request",
+                                ("method", "route"), LATENCY_BUCKETS)
+statement_duration = Histogram("db_statement_duration_seconds", "Time to run a SQL statement", (), LATENCY_BUCKETS)
+slow_statements = Counter("db_slow_statements_total",
+                          "SQL statements slower than the SLOW_QUERY_THRESHOLD_MS setting")
+shed_requests = Counter("http_requests_shed_total", "Requests refused to protect the server", ("reason",))
+
+_current_request: contextvars.ContextVar[Optional[RequestStats]] = contextvars.ContextVar("current_request",
+                                                                                          default=None)
+
+
+def start_request() -> RequestStats:
+    """
+    Start counting the SQL statements of the current request (the current asyncio task and the ones it starts)
+    :return: the request's stats
+    """
+    stats = RequestStats()
+    _current_request.set(stats)
+    return stats
+
+
+def finish_request(method: str, route: str, status: int, duration: float, stats: RequestStats):
+    """
+    Record a handled request
+    :param method: HTTP method
+    :param route: path template of the matched route
+    :param status: response status code
+    :param duration: seconds taken to answer
+    :param stats: the request's stats
+    """
+    request_duration.observe(duration, method, route, str(status))
+    request_statements.observe(stats.statements, method, route)
+    request_db_duration.observe(stats.seconds, method, route)
+
+
+def instrument_engine(sync_engine: Engine):
+    """
+    Time every statement of an engine and attribute it to the current request
+    :param sync_engine: the engine, or the sync_engine of an async engine
+    """
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_start_time", []).append(time.perf_counter())
+
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        duration = time.perf_counter() - conn.info["query_start_time"].pop()
+        statement_duration.observe(duration)
+        stats = _current_request.get()
+        if stats is not None:
+            stats.statements += 1
+            stats.seconds += duration
+        if duration * 1000 >= settings.SLOW_QUERY_THRESHOLD_MS:
+            slow_statements.inc()
+            logger.warning("Slow SQL statement (%.1f ms): %s", duration * 1000, statement)
+
+
+def gauge(name: str, documentation: str, label_names: tuple, values: dict) -> list:
+    """
+    Lines of a gauge in the Prometheus text format
+    :param name: metric name
+    :param documentation: metric help
+    :param label_names: names of the gauge's labels
+    :param values: dict of label values (tuple) to value
+    """
+    lines = [f"# HELP {name} {documentation}", f"# TYPE {name} gauge"]
+    for label_values, value in values.items():
+        lines.append(f"{name}{_labels(label_names, label_values)} {value}")
+    return lines
+
+
+def render_metrics(extra_lines: list = ()) -> str:
+    """
+    Every metric in the Prometheus text format
+    :param extra_lines: lines of the metrics owned by other modules (pools, caches)
+    :return: the text exposition
+    """
+    lines = []
+    for metric in (request_duration, request_statements, request_db_duration, statement_duration, slow_statements,
+                   shed_requests):
+        lines += metric.render()
+    lines += extra_lines
+    return "\n".join(lines) + "\n"
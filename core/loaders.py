@@ -0,0 +1,67 @@
+"""
+Request-scoped loaders, batching and deduplicating the lookups of a request
+"""
+from typing import Optional
+
+from fastapi import HTTPException, status
+from sqlalchemy.ext.asyncio import AsyncSession
+
+import crud
+import models
+
+
+def parse_ids(ids: str, max_ids: int) -> list:
+    """
+    Read a comma separated list of ids
+    :param ids: e.g. '1,2,3'
+    :param max_ids: the MAX_BATCH_IDS setting
+    :return: the ids, or a 400 exception if one isn't a number or there are more than max_ids
+    """
+    try:
+        parsed = [int(author_id) for author_id in ids.split(",") if author_id.strip()]
+    except ValueError:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="ids must be comma separated integers")
+    check_batch_size(parsed, max_ids)
+    return parsed
+
+
+def check_batch_size(ids: list, max_ids: int):
+    """
+    Refuse the batches with too many ids, before anything is loaded
+    :param ids: the requested ids
+    :param max_ids: the MAX_BATCH_IDS setting
+    :return: nothing, or a 400 exception if there are more than max_ids
+    """
+    if len(ids) > max_ids:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail=f"At most {max_ids} ids can be asked at once")
+
+
+class AuthorLoader:
+    """
+    Memo of the authors loaded during one request: the ids asked together are fetched in one query, and an id is
+    never fetched twice
+    """
+
+    def __init__(self, db: AsyncSession, posts_loading: str = "selectin"):
+        self.db = db
+        self.posts_loading = posts_loading
+        # author id -> the author, or None when it doesn't exist
+        self._authors: dict = {}
+
+    async def load_many(self, author_ids: list) -> list:
+        """
+        Get authors by id
+        :param author_ids: ids of the authors, duplicates allowed
+        :return: for every id, in the same order, its author or None
+        """
+        unseen = [author_id for author_id in dict.fromkeys(author_ids) if author_id not in self._authors]
+        if unseen:
+            found = {author.id: author for author in
+                     await crud.get_authors_by_ids(self.db, unseen, posts_loading=self.posts_loading)}
+            for author_id in unseen:
+                self._authors[author_id] = found.get(author_id)
+        return [self._authors[author_id] for author_id in author_ids]
+
+    async def load(self, author_id: int) -> Optional[models.Authors]:
+        return (await self.load_many([author_id]))[0]
@@ -1,69 +1,223 @@
 """
 Main module for functionality
 """
+import asyncio
+import functools
+import logging
+import os
+import time
 from datetime import timedelta
+from typing import AsyncIterator, Literal, Optional
 
-import uvicorn
-from fastapi import Depends, FastAPI, HTTPException, Request, status
+from fastapi import APIRouter, Depends, FastAPI, Header, HTTPException, Query, Request, Response, status
+from fastapi.encoders import jsonable_encoder
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.middleware.trustedhost import TrustedHostMiddleware
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, JSONResponse, PlainTextResponse, StreamingResponse
 from fastapi.security import OAuth2PasswordRequestForm, OAuth2PasswordBearer
 from fastapi.staticfiles import StaticFiles
-from fastapi.templating import Jinja2Templates
 from jose import jwt, JWTError
-from passlib.context import CryptContext
-from sqlalchemy.orm import Session
+from sqlalchemy import inspect
+from starlette.background import BackgroundTask
+from sqlalchemy.ext.asyncio import AsyncSession
 
 import crud
-import models
 import schemas
-from config.settings import settings
-from database import SessionLocal, engine
-from security import verify_password, create_access_token
+from batching import post_writer
+from bulk import read_post_chunks
+from caching import cached_response, etag_matches, list_etag, principal_cache
+from config.settings import Settings, settings
+from database import AsyncSessionLocal, async_engine, log_pool_status, pool_status, read_router, replica_engines
+from export import JSON_MEDIA_TYPE, NDJSON_MEDIA_TYPE, json_array, ndjson_lines
+from hotset import hot_posts, posts_json
+from instrumentation import gauge, instrument_engine, render_metrics, shed_requests
+from loaders import AuthorLoader, check_batch_size, parse_ids
+from middlewares import AdmissionControlMiddleware, CompressionMiddleware, InstrumentationMiddleware
+from pagination import decode_cursor, set_next_cursor
+from polling import post_poller
+from pubsub import EVENT_STREAM_MEDIA_TYPE, Subscription, post_broker, post_event
+from ratelimit import client_address, create_rate_limiter, rate_limiter
+from security import HashingPoolSaturated, async_verify_password, create_access_token, hashing_pool
+from serialization import FastJSONResponse
+
+logger = logging.getLogger(__name__)
+
+# Time the SQL statements of every request
+for instrumented_engine in [async_engine, *replica_engines]:
+    instrument_engine(instrumented_engine.sync_engine)
+
+# Every route of the app, create_app mounts them
+router = APIRouter()
+
+# Cookie holding until when a client reads from the primary database
+READ_PRIMARY_COOKIE = "read_primary_until"
 
-origins = [
-    "http://localhost",
-    "http://localhost:8080",
-    "http://localhost:7000"
-]
+# Specify where our auth will be held
+oauth2_scheme = OAuth2PasswordBearer(tokenUrl='/token')
 
-models.Base.metadata.create_all(bind=engine)
 
-# We declare our fastapi app
-app = FastAPI()
+@functools.lru_cache()
+def get_templates():
+    """
+    Specify which templates we are using and where we store them. Built on the first rendered page, Jinja is slow to
+    import and most workers never render one.
+    :return: the templates with their compiled bytecode cached on disk
+    """
+    from fastapi.templating import Jinja2Templates
+    from jinja2 import FileSystemBytecodeCache
 
-# Add our middlewares
-app.add_middleware(TrustedHostMiddleware, allowed_hosts=['127.0.0.1', "localhost", "192.100.1.50"])
-app.add_middleware(CORSMiddleware, allow_origins=origins,
-                   allow_credentials=True, allow_methods=["*"], allow_headers=["*"])
+    templates = Jinja2Templates(directory='templates')
+    if settings.TEMPLATE_BYTECODE_CACHE_DIR:
+        os.makedirs(settings.TEMPLATE_BYTECODE_CACHE_DIR, mode=0o700, exist_ok=True)
+        templates.env.bytecode_cache = FileSystemBytecodeCache(settings.TEMPLATE_BYTECODE_CACHE_DIR)
+    else:
+        # Jinja's directory of the user, created with mode 0700 and checked to be owned by the user
+        templates.env.bytecode_cache = FileSystemBytecodeCache()
+    return templates
 
-# Add the static directory
-app.mount("/static", StaticFiles(directory="static"), name='static')
 
-# Specify which templates we are using and where we store them
-templates = Jinja2Templates(directory='templates')
+async def check_schema():
+    """
+    The schema is managed by alembic, warn at startup when the migrations were not applied
+    """
+    database_engine = AsyncSessionLocal.kw["bind"]
+    async with database_engine.connect() as connection:
+        tables = await connection.run_sync(lambda sync_connection: inspect(sync_connection).get_table_names())
+    if "authors" not in tables:
+        logger.warning("The database has no schema, run 'alembic upgrade head' from the core directory")
+    elif "table_versions" not in tables:
+        logger.warning("The database misses migrations, run 'alembic upgrade head' from the core directory")
 
-pwd_context = CryptContext(schemes=['bcrypt'], deprecated="auto")
 
-# Specify where our auth will be held
-oauth2_scheme = OAuth2PasswordBearer(tokenUrl='/token')
+async def prewarm():
+    """
+    Do the slow first-use work before the worker accepts requests: fill the connection pools, compile the templates
+    and start the hashing workers
+    """
+    for database_engine in [AsyncSessionLocal.kw["bind"], *replica_engines]:
+        pool_size = getattr(database_engine.sync_engine.pool, "size", lambda: 1)()
+        connections = [await database_engine.connect() for _ in range(pool_size)]
+        for connection in connections:
+            await connection.close()
+    get_templates().get_template("home.html")
+    await asyncio.get_running_loop().run_in_executor(hashing_pool.executor, int)
+
+
+def stop_hashing_pool():
+    """
+    Stop the bcrypt workers with the server
+    """
+    hashing_pool.shutdown()
+
+
+async def start_post_writer():
+    """
+    Start the group commit of the post creations
+    """
+    post_writer.start()
+
+
+async def stop_post_writer():
+    """
+    Write the queued posts before the database pool is closed
+    """
+    await post_writer.stop()
+
+
+async def stop_post_poller():
+    """
+    Stop following the posts written by the other workers
+    """
+    await post_poller.stop()
+
+
+async def load_hot_posts(snapshot_path: str):
+    """
+    Fill the index of the newest posts, from its snapshot when it is still valid
+    :param snapshot_path: the HOT_POSTS_SNAPSHOT_PATH setting of the app, empty to read the posts
+    """
+    async with AsyncSessionLocal() as db:
+        await hot_posts.load(db, snapshot_path or None)
+
+
+def save_hot_posts(snapshot_path: str):
+    """
+    Write the index of the newest posts, the next start maps it instead of reading the posts again
+    :param snapshot_path: the HOT_POSTS_SNAPSHOT_PATH setting of the app, empty to write nothing
+    """
+    if snapshot_path:
+        hot_posts.save(snapshot_path)
+
+
+async def close_database_pool():
+    """
+    Log how the connection pool was used, then close its connections
+    """
+    for database_engine in [async_engine, *replica_engines]:
+        log_pool_status(database_engine.sync_engine)
+        await database_engine.dispose()
+
+
+async def hashing_pool_saturated_handler(request: Request, exc: HashingPoolSaturated):
+    """
+    Shed the load when the hashing pool is full instead of letting the requests pile up
+    :param request: the rejected request
+    :param exc: the raised exception
+    :return: 503 response asking the client to retry later
+    """
+    shed_requests.inc("hashing_pool")
+    return JSONResponse(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, content={"detail": "Server is busy"},
+                        headers={"Retry-After": "1"})
 
 
 # Dependency
-def get_db():
+def get_settings(request: Request) -> Settings:
+    """
+    declare the settings of the app serving the request
+    :param request: the client request
+    :return: the settings create_app was given
+    """
+    return request.app.state.settings
+
+
+async def get_db():
     """
     declare our session
     :return: the session itself
     """
-    db = SessionLocal()
+    async with AsyncSessionLocal() as db:
+        yield db
+
+
+async def get_read_db(request: Request):
+    """
+    declare a session for the read-only routes, on a replica unless the client just wrote
+    :param request: the client request, its cookies tell if it must read from the primary. Its state records where
+    the session reads from, for the response cache (check caching.cached_response).
+    :return: the session itself
+    """
     try:
+        pinned = float(request.cookies.get(READ_PRIMARY_COOKIE, 0)) > time.time()
+    except ValueError:
+        pinned = False
+    read_sessionmaker = read_router.primary if pinned else read_router.read_sessionmaker()
+    request.state.read_pinned = pinned
+    request.state.read_from_replica = read_sessionmaker is not read_router.primary
+    async with read_sessionmaker() as db:
         yield db
-    finally:
-        db.close()
 
 
-def authenticate_user(username: str, password: str, db: Session):
+def pin_reads_to_primary(response: Response, app_settings: Settings):
+    """
+    After a successful write, send the client's reads to the primary until the replicas caught up
+    :param response: the outgoing response, gets the cookie
+    :param app_settings: the settings of the app, for READ_YOUR_WRITES_SECONDS
+    """
+    until = time.time() + app_settings.READ_YOUR_WRITES_SECONDS
+    response.set_cookie(READ_PRIMARY_COOKIE, f"{until:.3f}", max_age=app_settings.READ_YOUR_WRITES_SECONDS)
+
+
+async def authenticate_user(username: str, password: str, db: AsyncSession):
     """
     We check if the user can be considered authenticated
     :param username: given username
@@ -71,19 +225,19 @@ def authenticate_user(username: str, password: str, db: Session):
     :param db: the current session
     :return: verification if user with the given params exists
     """
-    user = crud.get_author_by_username(username=username, db=db)
+    user = await crud.get_author_by_username(username=username, db=db)
     if not user:
         return False
-    if not verify_password(password, user.password):
+    if not await async_verify_password(password, user.password):
         return False
     return user
 
 
-def get_current_user_from_token(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
+async def get_current_user_from_token(token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(get_db)):
     """
     We get the current user, and if he has a token
     :param token: verification if the token is valid
-    :param db: the current session
+    :param db: the current session, only used when the user isn't in the principal cache
     :return: if validated, the user, otherwise a credentials_exception
     """
     credentials_exception = HTTPException(
@@ -98,136 +252,583 @@ def get_current_user_from_token(token: str = Depends(oauth2_scheme), db: Session
             raise credentials_exception
     except JWTError:
         raise credentials_exception
-    user = crud.get_author_by_username(username=username, db=db)
-    if user is None:
-        raise credentials_exception
-    return user
+    principal = principal_cache.get(username)
+    if principal is None:
+        user = await crud.get_author_by_username(username=username, db=db)
+        if user is None:
+            raise credentials_exception
+        principal = schemas.Principal.from_orm(user)
+        # The token was checked above, so the entry can live as long as the token is valid
+        token_lifetime = payload["exp"] - time.time() if "exp" in payload else None
+        principal_cache.set(username, principal, ttl=token_lifetime)
+    return principal
+
+
+async def limit_token_requests(request: Request, form_data: OAuth2PasswordRequestForm = Depends()):
+    """
+    Count a login attempt per client address and per username, before bcrypt or the database are used
+    :param request: the client request
+    :param form_data: the login form, parsed once for this dependency and the route
+    """
+    request.app.state.rate_limiter.check("token_ip", client_address(request))
+    request.app.state.rate_limiter.check("token_user", form_data.username)
+
+
+def limit_by_address(rule: str):
+    """
+    Dependency counting the requests of a client address
+    :param rule: name of the rule of the RATE_LIMITS setting
+    """
+    def check_address(request: Request):
+        request.app.state.rate_limiter.check(rule, client_address(request))
+    return check_address
 
 
-@app.post("/token", response_model=schemas.Token)
-async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
+def limit_by_author(rule: str):
+    """
+    Dependency counting the requests of the authenticated author
+    :param rule: name of the rule of the RATE_LIMITS setting
+    """
+    def check_author(request: Request, current_user: schemas.Principal = Depends(get_current_user_from_token)):
+        request.app.state.rate_limiter.check(rule, current_user.id)
+    return check_author
+
+
+async def list_page_etag(request: Request, db: AsyncSession, tables: tuple) -> tuple[Optional[str], Optional[tuple]]:
+    """
+    ETag of a list page, from the versions of the tables it reads
+    :param request: the client request
+    :param db: the session the page will be read from
+    :param tables: names of the tables the page reads
+    :return: the weak ETag and the versions of the tables, both None if the database doesn't track them
+    """
+    versions = await crud.get_table_versions(db, tables)
+    return (None, None) if versions is None else (list_etag(request, versions), versions)
+
+
+def set_etag(response: Response, etag: Optional[str]):
+    """
+    Send the ETag of a list page
+    :param response: the outgoing response, gets the ETag header
+    :param etag: check list_page_etag, None sends no header
+    """
+    if etag is not None:
+        response.headers["ETag"] = etag
+
+
+@router.post("/token", response_model=schemas.Token, dependencies=[Depends(limit_token_requests)])
+async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(), db: AsyncSession = Depends(get_db),
+                                 app_settings: Settings = Depends(get_settings)):
     """
     Here we get the token for the user when loging in
     :param form_data: form for authentication (username, password etc...)
     :param db: the current session
+    :param app_settings: the settings of the app
     :return: dict access_token + token_type
     """
-    user = authenticate_user(form_data.username, form_data.password, db)
+    user = await authenticate_user(form_data.username, form_data.password, db)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="incorrect username or password"
         )
-    access_token_expires = timedelta(minutes=settings.ACCESS_TOKEN_EXPIRE_MINUTES)
+    access_token_expires = timedelta(minutes=app_settings.ACCESS_TOKEN_EXPIRE_MINUTES)
     access_token = create_access_token(
         data={"sub": user.username}, expires_delta=access_token_expires
     )
     return {"access_token": access_token, "token_type": "Bearer"}
 
 
-@app.get("/authors/", response_model=list[schemas.Author], status_code=status.HTTP_200_OK)
-async def read_authors(skip: int = 0, limit: int = 10, db: Session = Depends(get_db)):
+@router.get("/authors/", response_model=list[schemas.Author], status_code=status.HTTP_200_OK)
+async def read_authors(request: Request, response: Response, skip: int = 0, limit: int = 10,
+                       cursor: Optional[str] = None, include_posts: bool = True,
+                       db: AsyncSession = Depends(get_read_db), app_settings: Settings = Depends(get_settings)):
     """
     Get a list of authors
+    :param request: the client request, an If-None-Match still matching is answered without running the query
+    :param response: the outgoing response, gets the next page cursor and ETag headers
     :param skip: check crud.get_authors
     :param limit: check crud.get_authors
+    :param cursor: opaque cursor from a previous page, replaces skip
+    :param include_posts: if false, the posts are not loaded and every author has an empty posts list
     :param db: the current session
+    :param app_settings: the settings of the app
     :return: check crud.get_authors
     """
-    authors = crud.get_authors(db, skip, limit)
+    after_id = decode_cursor(cursor) if cursor else None
+    etag, _ = await list_page_etag(request, db, ("authors", "posts"))
+    if etag_matches(request, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+    if app_settings.FAST_SERIALIZATION:
+        rows = await crud.get_authors_rows(db, skip, limit, include_posts=include_posts, after_id=after_id)
+        fast_response = FastJSONResponse(rows)
+        set_next_cursor(fast_response, rows, limit)
+        set_etag(fast_response, etag)
+        return fast_response
+    # The posts of the whole page are fetched in a single batched query
+    authors = await crud.get_authors(db, skip, limit, posts_loading="selectin" if include_posts else "none",
+                                     after_id=after_id)
+    set_next_cursor(response, authors, limit)
+    set_etag(response, etag)
+    return authors
+
+
+@router.get("/authors/summary", response_model=list[schemas.AuthorSummary])
+async def read_authors_summary(request: Request, response: Response, skip: int = 0, limit: int = 10,
+                               cursor: Optional[str] = None, db: AsyncSession = Depends(get_read_db)):
+    """
+    Get a list of authors with their number of posts, its cost doesn't depend on how many posts they have
+    :param request: the client request, an If-None-Match still matching is answered without running the query
+    :param response: the outgoing response, gets the next page cursor and ETag headers
+    :param skip: check crud.get_authors_summary
+    :param limit: check crud.get_authors_summary
+    :param cursor: opaque cursor from a previous page, replaces skip
+    :param db: the current session
+    :return: check crud.get_authors_summary
+    """
+    after_id = decode_cursor(cursor) if cursor else None
+    etag, _ = await list_page_etag(request, db, ("authors",))
+    if etag_matches(request, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+    authors = await crud.get_authors_summary(db, skip, limit, after_id=after_id)
+    set_next_cursor(response, authors, limit)
+    set_etag(response, etag)
     return authors
 
 
-@app.post("/authors/", response_model=schemas.Author, response_model_exclude_unset=True)
-async def create_author(author: schemas.AuthorCreate, db: Session = Depends(get_db)):
+def get_author_loader(include_posts: bool = True, db: AsyncSession = Depends(get_read_db)):
+    """
+    declare the author loader of the request
+    :param include_posts: if the authors come with their posts
+    :param db: the current session
+    :return: the loader, shared by everything the request depends on
+    """
+    return AuthorLoader(db, posts_loading="selectin" if include_posts else "none")
+
+
+async def batch_authors(author_ids: list, loader: AuthorLoader):
+    """
+    Look up authors by id
+    :param author_ids: the requested ids
+    :param loader: the request's author loader
+    :return: the found authors in the order of the ids, each once, and the ids not found
+    """
+    author_ids = list(dict.fromkeys(author_ids))
+    authors = await loader.load_many(author_ids)
+    return {"authors": [author for author in authors if author is not None],
+            "missing": [author_id for author_id, author in zip(author_ids, authors) if author is None]}
+
+
+@router.get("/authors/batch", response_model=schemas.AuthorBatch)
+async def read_authors_batch(ids: str, loader: AuthorLoader = Depends(get_author_loader),
+                             app_settings: Settings = Depends(get_settings)):
+    """
+    Get many authors at once, with one query for the authors and one for their posts
+    :param ids: comma separated ids, e.g. 1,2,3
+    :param loader: the request's author loader
+    :param app_settings: the settings of the app, for MAX_BATCH_IDS
+    :return: check batch_authors
+    """
+    return await batch_authors(parse_ids(ids, app_settings.MAX_BATCH_IDS), loader)
+
+
+@router.post("/authors/batch", response_model=schemas.AuthorBatch)
+async def read_authors_batch_from_body(body: schemas.AuthorIds, loader: AuthorLoader = Depends(get_author_loader),
+                                       app_settings: Settings = Depends(get_settings)):
+    """
+    Same as GET /authors/batch, for the lists of ids too long for a URL
+    :param body: the ids
+    :param loader: the request's author loader
+    :param app_settings: the settings of the app, for MAX_BATCH_IDS
+    :return: check batch_authors
+    """
+    check_batch_size(body.ids, app_settings.MAX_BATCH_IDS)
+    return await batch_authors(body.ids, loader)
+
+
+@router.post("/authors/", response_model=schemas.Author, response_model_exclude_unset=True,
+             dependencies=[Depends(limit_by_address("create_author_ip"))])
+async def create_author(response: Response, author: schemas.AuthorCreate, db: AsyncSession = Depends(get_db),
+                        app_settings: Settings = Depends(get_settings)):
     """
     Create a new author
+    :param response: the outgoing response, pins the client's reads to the primary once the author is created
     :param author: check crud.create_author
     :param db: check crud.create_author
+    :param app_settings: the settings of the app
     :return: check crud.create_author
     """
     # First we check if the new author username exists (username must be unique)
-    new_author = crud.get_author_by_username(db, username=author.username)
+    new_author = await crud.get_author_by_username(db, username=author.username)
     if new_author:
         raise HTTPException(status_code=400, detail='Author already exists')
-    return crud.create_author(db=db, author=author)
+    created = await crud.create_author(db=db, author=author)
+    pin_reads_to_primary(response, app_settings)
+    return created
 
 
-@app.get("/author/{author_id}", response_model=schemas.Author)
-async def read_author(author_id: int, db: Session = Depends(get_db)):
+@router.get("/author/{author_id}", response_model=schemas.Author)
+async def read_author(request: Request, author_id: int, include_posts: bool = True,
+                      db: AsyncSession = Depends(get_read_db)):
     """
     Get the author
+    :param request: the client request, checked against the response cache
     :param author_id: give the author's id
+    :param include_posts: if false, the posts are not loaded and the author has an empty posts list
     :param db: the current session
     :return: the author if found in the database
     """
-    author = crud.get_author(db, author_id)
-    if author:
-        return author
-    raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Author not found!")
+    async def render():
+        # A single author is loaded together with the posts in one joined query
+        author = await crud.get_author(db, author_id, posts_loading="joined" if include_posts else "none")
+        if author:
+            return JSONResponse(jsonable_encoder(schemas.Author.from_orm(author)))
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Author not found!")
+
+    return await cached_response(request, "author", author_id, render)
 
 
-@app.get("/posts/", response_model=list[schemas.Post])
-async def read_posts(skip: int = 0, limit: int = 10, db: Session = Depends(get_db)):
+@router.get("/posts/", response_model=list[schemas.Post])
+async def read_posts(request: Request, response: Response, skip: int = 0, limit: int = 10,
+                     cursor: Optional[str] = None, db: AsyncSession = Depends(get_read_db),
+                     app_settings: Settings = Depends(get_settings)):
     """
     Gets a list of posts
+    :param request: the client request, an If-None-Match still matching is answered without running the query
+    :param response: the outgoing response, gets the next page cursor and ETag headers
     :param skip: check crud.get_posts
     :param limit: check crud.get_posts
+    :param cursor: opaque cursor from a previous page, replaces skip
     :param db: the current session
+    :param app_settings: the settings of the app
     :return: a list of posts if found in the database
     """
-    posts = crud.get_posts(db, skip, limit)
+    after_id = decode_cursor(cursor) if cursor else None
+    etag, versions = await list_page_etag(request, db, ("posts",))
+    if etag_matches(request, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+    hot_page = await hot_posts.page(db, skip, limit, after_id, versions[0] if versions else None)
+    if hot_page is not None:
+        hot_response = Response(posts_json(hot_page), media_type=JSON_MEDIA_TYPE)
+        set_next_cursor(hot_response, hot_page, limit)
+        set_etag(hot_response, etag)
+        return hot_response
+    if app_settings.FAST_SERIALIZATION:
+        rows = await crud.get_posts_rows(db, skip, limit, after_id=after_id)
+        fast_response = FastJSONResponse(rows)
+        set_next_cursor(fast_response, rows, limit)
+        set_etag(fast_response, etag)
+        return fast_response
+    posts = await crud.get_posts(db, skip, limit, after_id=after_id)
+    set_next_cursor(response, posts, limit)
+    set_etag(response, etag)
     return posts
 
 
-@app.get("/posts/{post_id}", response_model=schemas.Post, response_model_exclude_unset=True)
-async def read_post(post_id: int, db: Session = Depends(get_db)):
+@router.get("/posts/search", response_model=list[schemas.Post])
+async def search_posts(q: str = Query(..., min_length=1), skip: int = 0, limit: int = 10,
+                       db: AsyncSession = Depends(get_read_db)):
+    """
+    Full text search over the posts' titles and descriptions
+    :param q: the searched words, a post must contain all of them
+    :param skip: check crud.search_posts
+    :param limit: check crud.search_posts
+    :param db: the current session
+    :return: the matching posts, best results first
+    """
+    return await crud.search_posts(db, q, skip, limit)
+
+
+@router.get("/posts/export", response_class=StreamingResponse,
+            responses={200: {"content": {NDJSON_MEDIA_TYPE: {}, JSON_MEDIA_TYPE: {}}}})
+async def export_posts(export_format: Literal["ndjson", "json"] = Query("ndjson", alias="format"),
+                       owner_id: Optional[int] = None, db: AsyncSession = Depends(get_read_db),
+                       app_settings: Settings = Depends(get_settings)):
+    """
+    Streams every post, the memory used doesn't depend on the size of the table
+    :param export_format: "ndjson" for one post per line, "json" for a single array
+    :param owner_id: if given, only the posts of this author
+    :param db: the current session, it is closed once the whole export is sent
+    :param app_settings: the settings of the app
+    :return: the streamed export
+    """
+    rows = crud.stream_posts(db, owner_id=owner_id, fetch_size=app_settings.EXPORT_FETCH_SIZE)
+    if export_format == "json":
+        return StreamingResponse(json_array(rows), media_type=JSON_MEDIA_TYPE)
+    return StreamingResponse(ndjson_lines(rows), media_type=NDJSON_MEDIA_TYPE)
+
+
+async def missed_post_events(after_id: int, page_size: int) -> AsyncIterator:
+    """
+    Events of the posts created after an id, read from the primary by pages
+    :param after_id: id of the last post the subscriber got
+    :param page_size: the POST_STREAM_BACKFILL_PAGE_SIZE setting
+    :return: the events, in id order
+    """
+    while True:
+        async with AsyncSessionLocal() as db:
+            rows = await crud.get_posts_rows(db, limit=page_size, after_id=after_id)
+        for row in rows:
+            yield post_event(row)
+        if len(rows) < page_size:
+            return
+        after_id = rows[-1]["id"]
+
+
+async def post_event_stream(subscription: Subscription, last_event_id: Optional[int],
+                            app_settings: Settings) -> AsyncIterator[bytes]:
+    """
+    Frames of the posts stream: the posts the client missed since last_event_id, then the new ones as they are
+    created, by this worker or another one (check polling.PostPoller). A subscriber whose buffer overflowed reads the
+    posts it missed from the database, then goes on live.
+    :param subscription: subscription to post_broker, opened before reading the missed posts so none is created in
+    between without being sent, and closed with the stream
+    :param last_event_id: id of the last post the client got, None to start with the next new post
+    :param app_settings: the settings of the app, for POST_STREAM_BACKFILL_PAGE_SIZE and POST_STREAM_HEARTBEAT_SECONDS
+    :return: the server-sent events frames, with a keep-alive comment when the stream is idle
+    """
+    try:
+        last_id = catch_up_after = last_event_id
+        while True:
+            if catch_up_after is not None:
+                async for event in missed_post_events(catch_up_after, app_settings.POST_STREAM_BACKFILL_PAGE_SIZE):
+                    if last_id is None or event.id > last_id:
+                        last_id = event.id
+                        yield event.frame
+                catch_up_after = None
+            event = await subscription.get(app_settings.POST_STREAM_HEARTBEAT_SECONDS)
+            missed_after = subscription.take_missed()
+            if missed_after is not None:
+                catch_up_after = missed_after if last_id is None else last_id
+            elif event is None:
+                yield b": keep-alive\n\n"
+            elif last_id is None or event.id > last_id:
+                last_id = event.id
+                yield event.frame
+    finally:
+        post_broker.close(subscription)
+
+
+async def close_subscription(subscription: Subscription):
+    """
+    Close a stream's subscription, on the event loop where the broker publishes
+    :param subscription: the subscription to post_broker
+    """
+    post_broker.close(subscription)
+
+
+@router.get("/posts/stream", response_class=StreamingResponse,
+            responses={200: {"content": {EVENT_STREAM_MEDIA_TYPE: {}}}})
+async def stream_new_posts(last_event_id: Optional[int] = Header(None), app_settings: Settings = Depends(get_settings)):
+    """
+    Streams the new posts as server-sent events, instead of polling /posts/
+    :param last_event_id: id of the last post the client got, the posts created since are sent first
+    :param app_settings: the settings of the app, for the POST_STREAM_* settings
+    :return: the endless stream of events, the id of an event is the id of its post
+    """
+    if len(post_broker) >= app_settings.POST_STREAM_MAX_SUBSCRIBERS:
+        shed_requests.inc("post_stream")
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Too many open streams",
+                            headers={"Retry-After": str(int(app_settings.POST_STREAM_HEARTBEAT_SECONDS))})
+    # Subscribed here and not when the stream starts, so the concurrent connections can't all pass the check above.
+    # The background task closes the subscription even if the stream never started.
+    subscription = post_broker.open()
+    post_poller.start()
+    # Proxies must neither cache nor buffer the stream
+    return StreamingResponse(post_event_stream(subscription, last_event_id, app_settings),
+                             media_type=EVENT_STREAM_MEDIA_TYPE,
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+                             background=BackgroundTask(close_subscription, subscription))
+
+
+@router.get("/posts/{post_id}", response_model=schemas.Post, response_model_exclude_unset=True)
+async def read_post(request: Request, post_id: int, db: AsyncSession = Depends(get_read_db)):
     """
     Gets a single post by id
+    :param request: the client request, checked against the response cache
     :param post_id: gives the id
     :param db: the current session
     :return: if found, the post with the given id
     """
-    post = crud.get_post(db=db, post_id=post_id)
-    if not post:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='Post not found!')
-    return post
-
-
-@app.post("/author/{author_id}/posts/", response_model=schemas.Post)
-async def create_post(author_id: int, post: schemas.PostCreate, db: Session = Depends(get_db),
-                      current_user: schemas.Author = Depends(get_current_user_from_token)):
+    async def render():
+        try:
+            hot_post = await hot_posts.get(db, post_id)
+        except LookupError:
+            # Not one of the hot posts, or they are off
+            post = await crud.get_post(db=db, post_id=post_id)
+            if not post:
+                raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='Post not found!')
+            return JSONResponse(jsonable_encoder(schemas.Post.from_orm(post)))
+        if hot_post is None:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='Post not found!')
+        return Response(hot_post.body, media_type=JSON_MEDIA_TYPE)
+
+    return await cached_response(request, "post", post_id, render)
+
+
+@router.post("/author/{author_id}/posts/", response_model=schemas.Post,
+             dependencies=[Depends(limit_by_author("create_post_user"))])
+async def create_post(author_id: int, post: schemas.PostCreate, response: Response, db: AsyncSession = Depends(get_db),
+                      current_user: schemas.Principal = Depends(get_current_user_from_token),
+                      app_settings: Settings = Depends(get_settings)):
     """
     Creates a new post for the author
     :param author_id: author's id
     :param post: the infos of the post
+    :param response: the outgoing response, pins the client's reads to the primary once the post is created
     :param db: the current session
     :param current_user: the current user
+    :param app_settings: the settings of the app, POST_WRITE_BATCHING tells if the post goes through post_writer
     :return: the created post or an exception
     """
     # Checking if the author is the current user
     if author_id == current_user.id:
-        return crud.create_author_post(db=db, post=post, author_id=author_id)
+        if app_settings.POST_WRITE_BATCHING:
+            # Give the connection back while waiting, the writer needs one from the same pool
+            await db.close()
+            created = await post_writer.create(post, author_id)
+        else:
+            created = await crud.create_author_post(db=db, post=post, author_id=author_id)
+        pin_reads_to_primary(response, app_settings)
+        return created
     else:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="You have no permissions")
 
 
-@app.get("/article/{article_id}", response_class=HTMLResponse, response_model_exclude_unset=True)
-async def read_article(request: Request, article_id: int, db: Session = Depends(get_db)):
+@router.post("/author/{author_id}/posts/bulk", response_model=list[schemas.BulkPostResult],
+             dependencies=[Depends(limit_by_author("create_posts_bulk_user"))])
+async def create_posts_bulk(author_id: int, request: Request, response: Response, db: AsyncSession = Depends(get_db),
+                            current_user: schemas.Principal = Depends(get_current_user_from_token),
+                            app_settings: Settings = Depends(get_settings)):
+    """
+    Creates many posts for the author, in chunked transactions
+    :param author_id: author's id
+    :param request: the client request, its body is a JSON list of posts, or one post per line with the
+    application/x-ndjson content type
+    :param response: the outgoing response, pins the client's reads to the primary once the posts are written
+    :param db: the current session
+    :param current_user: the current user
+    :param app_settings: the settings of the app
+    :return: for every post of the body, in the same order, the created post or the reason it failed
+    """
+    if author_id != current_user.id:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="You have no permissions")
+    results = []
+    async for posts, invalid in read_post_chunks(request, app_settings.BULK_INSERT_CHUNK_SIZE,
+                                                 app_settings.MAX_BULK_POSTS):
+        results += invalid
+        results += await crud.create_author_posts(db, posts, author_id)
+    pin_reads_to_primary(response, app_settings)
+    return sorted(results, key=lambda result: result.index)
+
+
+@router.get("/article/{article_id}", response_class=HTMLResponse, response_model_exclude_unset=True)
+async def read_article(request: Request, article_id: int, db: AsyncSession = Depends(get_read_db),
+                       app_settings: Settings = Depends(get_settings)):
     """
     HTML representation of a post
     :param request: the client request ('GET', 'POST' etc...)
     :param article_id: the id of the needed post
     :param db: the current session
+    :param app_settings: the settings of the app
     :return: if found, a template with post infos, else an exception
     """
-    article = crud.get_post(db=db, post_id=article_id)
-    if article:
-        return templates.TemplateResponse("home.html", {'article_id': article_id,
-                                                        'article': article, 'request': request})
-    else:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No article was found!")
+    async def render():
+        article = await crud.get_post(db=db, post_id=article_id, with_owner=True)
+        if article:
+            return get_templates().TemplateResponse("home.html", {'article_id': article_id,
+                                                                  'article': article, 'request': request})
+        else:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No article was found!")
+
+    return await cached_response(request, "article", article_id, render,
+                                 cache_control=f"public, max-age={app_settings.ARTICLE_CACHE_MAX_AGE_SECONDS}")
+
+
+@router.get("/status/hashing-pool")
+async def read_hashing_pool_status():
+    """
+    Saturation metrics of the bcrypt pool
+    :return: check security.HashingPool.stats
+    """
+    return hashing_pool.stats()
+
+
+@router.get("/status/db-pool")
+async def read_db_pool_status():
+    """
+    Usage of the database connection pool
+    :return: check database.pool_status
+    """
+    return pool_status(async_engine.sync_engine)
+
+
+@router.get("/metrics", response_class=PlainTextResponse)
+async def read_metrics():
+    """
+    Request, query, pool and cache metrics for Prometheus
+    :return: check instrumentation.render_metrics
+    """
+    hashing = hashing_pool.stats()
+    database_pool = pool_status(async_engine.sync_engine)
+    extra_lines = (
+        gauge("hashing_pool", "State of the bcrypt pool", ("field",),
+              {(field,): value for field, value in hashing.items() if isinstance(value, (int, float))})
+        + gauge("db_pool", "State of the primary connection pool", ("field",),
+                {(field,): value for field, value in database_pool.items() if isinstance(value, (int, float))})
+        + gauge("post_writer", "State of the group commit of the post creations", ("field",),
+                {(field,): value for field, value in post_writer.stats().items()})
+        + gauge("post_stream", "State of the stream of the new posts", ("field",),
+                {(field,): value for field, value in {**post_broker.stats(), **post_poller.stats()}.items()})
+        + gauge("hot_posts", "State of the in-memory index of the newest posts", ("field",),
+                {(field,): value for field, value in hot_posts.stats().items()})
+        + gauge("principal_cache_entries", "Authors cached from their token", (), {(): len(principal_cache)})
+    )
+    return PlainTextResponse(render_metrics(extra_lines), media_type="text/plain; version=0.0.4")
+
+
+def create_app(app_settings: Settings = settings) -> FastAPI:
+    """
+    Build the app. Importing this module does no I/O, the work that needs the database or the disk happens in the
+    startup and shutdown hooks.
+    :param app_settings: the settings of the app, the routes read them from app.state.settings. The engines, caches,
+    pools and tokens of the worker are shared by its apps and keep using the module settings.
+    :return: the app, ready to serve
+    """
+    # We declare our fastapi app
+    on_startup = [check_schema, prewarm] if app_settings.SERVE_PREWARM else [check_schema]
+    on_shutdown = [stop_hashing_pool, stop_post_writer, stop_post_poller, close_database_pool]
+    if app_settings.POST_WRITE_BATCHING:
+        on_startup.append(start_post_writer)
+    if app_settings.HOT_POSTS_ENABLED:
+        on_startup.append(functools.partial(load_hot_posts, app_settings.HOT_POSTS_SNAPSHOT_PATH))
+        on_shutdown.insert(0, functools.partial(save_hot_posts, app_settings.HOT_POSTS_SNAPSHOT_PATH))
+    app = FastAPI(on_startup=on_startup, on_shutdown=on_shutdown)
+    app.state.settings = app_settings
+    app.state.rate_limiter = rate_limiter if app_settings is settings else create_rate_limiter(app_settings)
+
+    # Add our middlewares
+    app.add_middleware(TrustedHostMiddleware, allowed_hosts=app_settings.ALLOWED_HOSTS)
+    app.add_middleware(CORSMiddleware, allow_origins=app_settings.CORS_ORIGINS,
+                       allow_credentials=True, allow_methods=["*"], allow_headers=["*"],
+                       # Readable by the browser scripts paging the lists
+                       expose_headers=["X-Next-Cursor", "ETag"])
+    app.add_middleware(CompressionMiddleware, minimum_size=app_settings.COMPRESSION_MINIMUM_SIZE)
+    app.add_middleware(AdmissionControlMiddleware, max_concurrent=app_settings.MAX_CONCURRENT_REQUESTS)
+    # Outermost, so the timing covers the other middlewares too
+    app.add_middleware(InstrumentationMiddleware)
+    app.add_exception_handler(HashingPoolSaturated, hashing_pool_saturated_handler)
+
+    # Add the static directory
+    app.mount("/static", StaticFiles(directory="static"), name='static')
+    app.include_router(router)
+    return app
+
+
+app = create_app()
 
 
 if __name__ == '__main__':
-    uvicorn.run('main:app', port=7000, host='127.0.0.1')
+    from serve import serve
+
+    serve(settings)
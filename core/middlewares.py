@@ -1,22 +1,195 @@
 """
-Middleware functions
+Middlewares of the app
 """
+import asyncio
+import cProfile
+import io
+import pstats
 import time
+from urllib.parse import parse_qs
 
-from main import app
-from fastapi import Request
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
 
+from caching import encoded_etag
+from compression import StreamCompressor, available_encodings, choose_encoding
+from config.settings import settings
+from instrumentation import finish_request, shed_requests, start_request
 
-@app.middleware("http")
-async def add_process_time_header(request: Request, call_next):
+# Label of the requests no route matched, the raw paths would make a series per scanned URL
+UNMATCHED_ROUTE = "unmatched"
+# How many functions a profile report lists
+PROFILE_REPORT_LINES = 40
+# Monitoring must keep answering when the server sheds load, and the long lived posts streams have their own cap
+ADMISSION_EXEMPT_PREFIXES = ("/status/", "/metrics", "/posts/stream")
+# Statuses without a body to compress
+BODILESS_STATUSES = (204, 304)
+
+
+class AdmissionControlMiddleware:
+    """
+    Caps the requests handled at the same time. Above the cap a request gets a 503 with Retry-After right away, a
+    client retrying later is better served than one waiting behind a queue that only makes every request slower.
+    """
+
+    def __init__(self, app: ASGIApp, max_concurrent: int):
+        self.app = app
+        self.max_concurrent = max_concurrent
+        self.in_flight = 0
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if (scope["type"] != "http" or self.max_concurrent <= 0
+                or scope["path"].startswith(ADMISSION_EXEMPT_PREFIXES)):
+            await self.app(scope, receive, send)
+            return
+        if self.in_flight >= self.max_concurrent:
+            shed_requests.inc("concurrency")
+            body = b'{"detail":"Server is busy"}'
+            await send({"type": "http.response.start", "status": 503,
+                        "headers": [(b"content-type", b"application/json"), (b"retry-after", b"1"),
+                                    (b"content-length", str(len(body)).encode())]})
+            await send({"type": "http.response.body", "body": body})
+            return
+        self.in_flight += 1
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.in_flight -= 1
+
+
+class CompressionMiddleware:
     """
-    Function to give the headers a default 'X-process_Time'
-    :param request: We request the connection between client and server
-    :param call_next: The call from client to server
-    :return:
+    Compresses the responses with the best encoding the client accepts. Bodies under the minimum size, responses that
+    are already encoded (the pre-compressed cached ones) and event streams are sent as they are. A streamed body is
+    compressed chunk by chunk.
     """
-    start = time.time()
-    response = await call_next(request)
-    process_time = time.time() - start
-    response.headers["X-process_Time"] = str(process_time)
-    return response
+
+    def __init__(self, app: ASGIApp, minimum_size: int):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    def _should_compress(self, start: Message, body: Message) -> bool:
+        """
+        Decide from the start of the response and its first body message
+        """
+        headers = Headers(raw=start["headers"])
+        if start["status"] in BODILESS_STATUSES or "content-encoding" in headers:
+            return False
+        if headers.get("content-type", "").startswith("text/event-stream"):
+            return False
+        return body.get("more_body", False) or len(body.get("body", b"")) >= self.minimum_size
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        encoding = choose_encoding(Headers(scope=scope).get("accept-encoding", ""), available_encodings())
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        start = None
+        compressor = None
+
+        async def send_compressed(message: Message):
+            nonlocal start, compressor
+            if message["type"] == "http.response.start":
+                # Held back until the first body message tells if the response is worth compressing
+                start = message
+                return
+            if start is not None:
+                if self._should_compress(start, message):
+                    compressor = StreamCompressor(encoding)
+                    more_body = message.get("more_body", False)
+                    message = {**message, "body": compressor.compress(message.get("body", b""), not more_body)}
+                    headers = MutableHeaders(scope=start)
+                    headers["Content-Encoding"] = encoding
+                    headers.add_vary_header("Accept-Encoding")
+                    if "etag" in headers and not headers["etag"].startswith("W/"):
+                        headers["ETag"] = encoded_etag(headers["etag"], encoding)
+                    if more_body:
+                        del headers["Content-Length"]
+                    else:
+                        headers["Content-Length"] = str(len(message["body"]))
+                await send(start)
+                start = None
+            elif compressor is not None:
+                more_body = message.get("more_body", False)
+                message = {**message, "body": compressor.compress(message.get("body", b""), not more_body)}
+            await send(message)
+
+        await self.app(scope, receive, send_compressed)
+
+
+class InstrumentationMiddleware:
+    """
+    Times every request, counts its SQL statements per route template and adds an 'X-Process-Time' header.
+    With PROFILING_ENABLED, a request with ?__profile=1 gets its cProfile report instead of its body.
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+        self._route_paths: dict = {}
+        # cProfile can't run two profiles at once
+        self._profile_lock = asyncio.Lock()
+
+    def _route(self, scope: Scope) -> str:
+        """
+        Path template of the route that handled the request
+        :param scope: the request's scope, the router stores the matched endpoint in it
+        :return: the template, e.g. '/author/{author_id}'
+        """
+        endpoint = scope.get("endpoint")
+        if endpoint is None:
+            return UNMATCHED_ROUTE
+        if endpoint not in self._route_paths:
+            for route in scope["app"].routes:
+                self._route_paths[getattr(route, "endpoint", None) or getattr(route, "app", None)] = route.path
+        return self._route_paths.get(endpoint, UNMATCHED_ROUTE)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        if settings.PROFILING_ENABLED and parse_qs(scope["query_string"].decode()).get("__profile") == ["1"]:
+            await self._profile(scope, receive, send)
+            return
+
+        stats = start_request()
+        start = time.perf_counter()
+        status_code = 500
+
+        async def send_with_process_time(message: Message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                MutableHeaders(scope=message).append("X-Process-Time", f"{time.perf_counter() - start:.6f}")
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_process_time)
+        finally:
+            finish_request(scope["method"], self._route(scope), status_code, time.perf_counter() - start, stats)
+
+    async def _profile(self, scope: Scope, receive: Receive, send: Send):
+        """
+        Run the request under cProfile and answer with the report, sorted by cumulative time
+        """
+        async def discard(message: Message):
+            pass
+
+        async with self._profile_lock:
+            profiler = cProfile.Profile()
+            profiler.enable()
+            try:
+                await self.app(scope, receive, discard)
+            finally:
+                profiler.disable()
+
+        report = io.StringIO()
+        pstats.Stats(profiler, stream=report).sort_stats("cumulative").print_stats(PROFILE_REPORT_LINES)
+        body = report.getvalue().encode()
+        await send({"type": "http.response.start", "status": 200,
+                    "headers": [(b"content-type", b"text/plain; charset=utf-8"),
+                                (b"content-length", str(len(body)).encode())]})
+        await send({"type": "http.response.body", "body": body})
@@ -1,7 +1,7 @@
 """
 The module stores our db tables with their columns
 """
-from sqlalchemy import Column, Integer, ForeignKey, Boolean, String
+from sqlalchemy import DDL, Column, Integer, ForeignKey, Boolean, String, column, event, table
 from sqlalchemy.orm import relationship
 
 from database import Base
@@ -18,8 +18,10 @@ class Authors(Base):
     username = Column(String, unique=True, index=True)
     password = Column(String)
     is_active = Column(Boolean, default=True)
+    # Denormalized count of the author's posts, updated in the transactions creating them
+    post_count = Column(Integer, nullable=False, default=0, server_default="0")
 
-    posts = relationship("Posts", back_populates='owner')
+    posts = relationship("Posts", back_populates='owner', order_by="Posts.id")
 
 
 class Posts(Base):
@@ -35,3 +37,43 @@ class Posts(Base):
     owner_id = Column(Integer, ForeignKey("authors.id"))
 
     owner = relationship("Authors", back_populates="posts")
+
+
+class TableVersions(Base):
+    """
+    Counter of the writes of a table, bumped by the crud functions in the transaction of the write. The list routes
+    build their ETags from it, so a client polling an unchanged page is answered without running its query.
+    """
+    __tablename__ = 'table_versions'
+
+    name = Column(String, primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+
+
+# Tables with a version, their rows are created with the table
+VERSIONED_TABLES = ("authors", "posts")
+event.listen(TableVersions.__table__, "after_create",
+             DDL("INSERT INTO table_versions (name, version) VALUES " +
+                 ", ".join(f"('{name}', 0)" for name in VERSIONED_TABLES)))
+
+
+# Full text index of the posts' title and description: an SQLite FTS5 table reading its content from "posts", kept in
+# sync by triggers. It is created with the posts table, the migration adds it to existing databases.
+posts_fts = table("posts_fts", column("rowid"), column("rank"))
+
+POSTS_FTS_DDL = [
+    "CREATE VIRTUAL TABLE posts_fts USING fts5(title, description, content='posts', content_rowid='id')",
+    "CREATE TRIGGER posts_fts_insert AFTER INSERT ON posts BEGIN "
+    "INSERT INTO posts_fts(rowid, title, description) VALUES (new.id, new.title, new.description); END",
+    "CREATE TRIGGER posts_fts_delete AFTER DELETE ON posts BEGIN "
+    "INSERT INTO posts_fts(posts_fts, rowid, title, description) "
+    "VALUES ('delete', old.id, old.title, old.description); END",
+    "CREATE TRIGGER posts_fts_update AFTER UPDATE ON posts BEGIN "
+    "INSERT INTO posts_fts(posts_fts, rowid, title, description) "
+    "VALUES ('delete', old.id, old.title, old.description); "
+    "INSERT INTO posts_fts(rowid, title, description) VALUES (new.id, new.title, new.description); END",
+]
+
+for statement in POSTS_FTS_DDL:
+    event.listen(Posts.__table__, "after_create", DDL(statement).execute_if(dialect="sqlite"))
+event.listen(Posts.__table__, "before_drop", DDL("DROP TABLE IF EXISTS posts_fts").execute_if(dialect="sqlite"))
@@ -0,0 +1,48 @@
+"""
+Keyset (cursor) pagination helpers
+"""
+import base64
+import binascii
+
+from fastapi import HTTPException, Response, status
+
+# Header carrying the cursor of the next page, it is only sent when the page is full
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+
+
+def encode_cursor(last_id: int) -> str:
+    """
+    Build the opaque cursor pointing after the given id
+    :param last_id: id of the last row of the current page
+    :return: url safe cursor string
+    """
+    return base64.urlsafe_b64encode(f"id:{last_id}".encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> int:
+    """
+    Read the id stored inside a cursor
+    :param cursor: cursor given by the client
+    :return: the id after which the next page starts, or a 400 exception if the cursor is not valid
+    """
+    try:
+        decoded = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        prefix, last_id = decoded.split(":")
+        if prefix != "id":
+            raise ValueError(cursor)
+        return int(last_id)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor")
+
+
+def set_next_cursor(response: Response, rows: list, limit: int):
+    """
+    Add the cursor of the next page to the response headers when there may be more rows to read
+    :param response: the outgoing response
+    :param rows: rows of the current page, ordered by id, either objects or dicts
+    :param limit: requested page size
+    """
+    if rows and len(rows) >= limit:
+        last_row = rows[-1]
+        last_id = last_row["id"] if isinstance(last_row, dict) else last_row.id
+        response.headers[NEXT_CURSOR_HEADER] = encode_cursor(last_id)
@@ -0,0 +1,109 @@
+"""
+Publication of the posts written by the other workers to the posts stream of this one
+"""
+import asyncio
+import contextlib
+import logging
+from typing import Optional
+
+from sqlalchemy.orm import sessionmaker
+
+import crud
+from config.settings import settings
+from database import AsyncSessionLocal
+from pubsub import Broker, post_broker, post_event
+
+logger = logging.getLogger(__name__)
+
+
+class PostPoller:
+    """
+    Single task following the posts table for the subscribers of the worker. Every interval, it reads the version of
+    the table, and when it changed, the posts after the last published one, once for all the subscribers. A local post
+    coming after posts not published yet wakes it up at once, so the subscribers get them all in order.
+    """
+
+    def __init__(self, broker: Broker, session_factory: sessionmaker, interval: float, page_size: int):
+        self.broker = broker
+        self.session_factory = session_factory
+        self.interval = interval
+        self.page_size = page_size
+        self.polls = 0
+        self.read = 0
+        self._version: Optional[int] = None
+        self._wake: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        """
+        Start the poller task on the running event loop if it isn't running yet, called when a stream subscribes. A
+        poller not following the table yet finds its newest post right away.
+        """
+        if self._task is None or self._task.done():
+            self._wake = asyncio.Event()
+            self.broker.on_gap = self._wake.set
+            self._task = asyncio.create_task(self._run())
+        elif self.broker.last_id is None:
+            self._wake.set()
+
+    async def stop(self):
+        """
+        Stop the task, the broker then publishes every event as it comes
+        """
+        if self._task is not None:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+        self.broker.on_gap = None
+        self.broker.last_id = None
+
+    async def _run(self):
+        while True:
+            woken = self._wake.is_set()
+            self._wake.clear()
+            if len(self.broker):
+                try:
+                    await self._poll(woken)
+                except Exception:
+                    logger.exception("Polling the new posts failed")
+            else:
+                # Nobody to publish to, the table is followed again from its newest post once someone subscribes
+                self.broker.last_id = None
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._wake.wait(), self.interval)
+
+    async def _poll(self, woken: bool):
+        """
+        Publish the posts after the last published one
+        :param woken: True when a local post showed a gap, the posts are then read even if the version didn't change
+        """
+        self.polls += 1
+        async with self.session_factory() as db:
+            versions = await crud.get_table_versions(db, ("posts",))
+            version = versions[0] if versions else None
+            if self.broker.last_id is None:
+                # The streams start with the next new post, the ones that missed some read them themselves
+                self.broker.last_id = await crud.get_post_id_from_end(db, 0) or 0
+            elif woken or version is None or version != self._version:
+                while True:
+                    rows = await crud.get_posts_rows(db, limit=self.page_size, after_id=self.broker.last_id)
+                    self.read += len(rows)
+                    self.broker.publish_read(post_event(row) for row in rows)
+                    if len(rows) < self.page_size:
+                        break
+            self._version = version
+
+    def stats(self) -> dict:
+        """
+        Usage of the poller
+        :return: dict with counters
+        """
+        return {
+            "polls_total": self.polls,
+            "read_total": self.read,
+        }
+
+
+post_poller = PostPoller(post_broker, AsyncSessionLocal, settings.POST_STREAM_HEARTBEAT_SECONDS,
+                         settings.POST_STREAM_BACKFILL_PAGE_SIZE)
@@ -0,0 +1,191 @@
+"""
+In-process publish/subscribe of the new posts, feeding the server-sent events stream
+"""
+import asyncio
+import collections
+import contextlib
+from typing import Callable, Iterable, Iterator, NamedTuple, Optional
+
+from config.settings import settings
+from serialization import dumps
+
+EVENT_STREAM_MEDIA_TYPE = "text/event-stream"
+
+
+class Event(NamedTuple):
+    """
+    A published event, its frame is rendered once whatever the number of subscribers
+    """
+    id: int
+    frame: bytes
+
+
+def sse_event(event_id: int, name: str, data: bytes) -> Event:
+    """
+    Render a server-sent event
+    :param event_id: id of the event, sent back by the client in Last-Event-ID when it reconnects
+    :param name: type of the event
+    :param data: the event's payload, on a single line
+    :return: the event
+    """
+    return Event(event_id, b"id: %d\nevent: %s\ndata: %s\n\n" % (event_id, name.encode(), data))
+
+
+def post_event(post: dict) -> Event:
+    """
+    Event of a new post
+    :param post: the post, with the keys of schemas.Post
+    """
+    return sse_event(post["id"], "post", dumps(post))
+
+
+class Subscription:
+    """
+    Bounded buffer of the events a subscriber hasn't read yet. A subscriber too slow to keep up doesn't make the
+    buffer grow: the buffer is dropped and missed_after tells from where to read the missed events from the database.
+    """
+    __slots__ = ("maxsize", "missed_after", "_events", "_waiter")
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        # Set when events were dropped: id after which the subscriber missed them
+        self.missed_after: Optional[int] = None
+        self._events: collections.deque = collections.deque()
+        # Future of the subscriber waiting for an event, only while it waits
+        self._waiter: Optional[asyncio.Future] = None
+
+    def push(self, event: Event) -> bool:
+        """
+        Buffer an event
+        :param event: the published event
+        :return: False if the buffer was full and got dropped
+        """
+        overflowed = False
+        if self.missed_after is None:
+            if len(self._events) >= self.maxsize:
+                self.missed_after = (self._events[0] if self._events else event).id - 1
+                self._events.clear()
+                overflowed = True
+            else:
+                self._events.append(event)
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
+        return not overflowed
+
+    async def get(self, timeout: float) -> Optional[Event]:
+        """
+        Wait for the next event
+        :param timeout: seconds to wait at most
+        :return: the event, or None on timeout or when events were missed (check missed_after)
+        """
+        if not self._events and self.missed_after is None:
+            self._waiter = asyncio.get_running_loop().create_future()
+            try:
+                await asyncio.wait_for(self._waiter, timeout)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                self._waiter = None
+        return self._events.popleft() if self._events else None
+
+    def take_missed(self) -> Optional[int]:
+        """
+        Acknowledge the missed events, the next ones are buffered again
+        :return: id after which events were missed, or None
+        """
+        missed_after, self.missed_after = self.missed_after, None
+        return missed_after
+
+
+class Broker:
+    """
+    Fan-out of the published events to every subscriber of this process, in id order. Publishing never waits for a
+    subscriber.
+    """
+
+    def __init__(self, buffer_size: int):
+        self.buffer_size = buffer_size
+        self.published = 0
+        self.overflows = 0
+        # Id of the last published event, while a poller (polling.PostPoller) follows the table: an event coming
+        # after ones not published yet (written by another process) is then held back and on_gap wakes the poller up,
+        # which publishes them all in order
+        self.last_id: Optional[int] = None
+        self.on_gap: Optional[Callable[[], None]] = None
+        self._subscriptions: set = set()
+
+    def open(self) -> Subscription:
+        """
+        Receive the events published from now on, until the subscription is closed
+        :return: the subscription, it counts in the subscribers right away
+        """
+        subscription = Subscription(self.buffer_size)
+        self._subscriptions.add(subscription)
+        return subscription
+
+    def close(self, subscription: Subscription):
+        """
+        Stop sending events to a subscription, closing it twice is harmless
+        :param subscription: the subscription from open
+        """
+        self._subscriptions.discard(subscription)
+
+    @contextlib.contextmanager
+    def subscribe(self) -> Iterator[Subscription]:
+        """
+        Receive the events published from now on, until the context exits
+        """
+        subscription = self.open()
+        try:
+            yield subscription
+        finally:
+            self.close(subscription)
+
+    def publish(self, event: Event):
+        """
+        Send an event to every subscriber, unless it was already sent or comes after events not published yet
+        :param event: the event
+        """
+        if self.last_id is not None:
+            if event.id <= self.last_id:
+                return
+            if event.id > self.last_id + 1:
+                if self.on_gap is not None:
+                    self.on_gap()
+                return
+        self._send(event)
+
+    def publish_read(self, events: Iterable[Event]):
+        """
+        Send the events read from the database after the last published one, whatever their ids
+        :param events: the events, in id order
+        """
+        for event in events:
+            if self.last_id is None or event.id > self.last_id:
+                self._send(event)
+
+    def _send(self, event: Event):
+        if self.last_id is not None:
+            self.last_id = event.id
+        self.published += 1
+        for subscription in self._subscriptions:
+            if not subscription.push(event):
+                self.overflows += 1
+
+    def __len__(self):
+        return len(self._subscriptions)
+
+    def stats(self) -> dict:
+        """
+        Usage of the broker
+        :return: dict with the number of subscribers and counters
+        """
+        return {
+            "subscribers": len(self._subscriptions),
+            "published_total": self.published,
+            "overflows_total": self.overflows,
+        }
+
+
+# New posts, published by crud once they are committed
+post_broker = Broker(settings.POST_STREAM_BUFFER_SIZE)
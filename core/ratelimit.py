@@ -0,0 +1,123 @@
+"""
+Token bucket rate limiting of the expensive routes
+"""
+import math
+import time
+from collections import OrderedDict
+from typing import NamedTuple
+
+from fastapi import HTTPException, Request, status
+
+from config.settings import Settings, settings
+from instrumentation import shed_requests
+
+PERIODS = {"second": 1, "minute": 60, "hour": 3600}
+
+
+class Rate(NamedTuple):
+    """
+    A bucket holds up to capacity tokens, a request takes one and they come back at refill_per_second
+    """
+    capacity: int
+    refill_per_second: float
+
+
+def parse_rate(rate: str) -> Rate:
+    """
+    Read a rate of the RATE_LIMITS setting
+    :param rate: '<requests>/<second|minute|hour>', e.g. '10/minute'
+    :return: the rate, the whole amount can be used in a burst
+    """
+    requests, _, period = rate.partition("/")
+    if period not in PERIODS:
+        raise ValueError(f"Unknown rate limit period: {rate}")
+    if int(requests) < 1:
+        raise ValueError(f"A rate limit allows at least 1 request: {rate}")
+    return Rate(int(requests), int(requests) / PERIODS[period])
+
+
+class MemoryRateLimitBackend:
+    """
+    Buckets in a dict of this process, the least recently used keys are forgotten past maxsize
+    """
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        # key -> (tokens, monotonic time they were counted)
+        self._buckets: OrderedDict = OrderedDict()
+
+    def take(self, key: str, rate: Rate) -> float:
+        """
+        Take a token from a bucket
+        :param key: the bucket's key
+        :param rate: the bucket's rate
+        :return: 0 if a token was taken, else the seconds until the next one
+        """
+        now = time.monotonic()
+        tokens, counted_at = self._buckets.get(key, (rate.capacity, now))
+        tokens = min(rate.capacity, tokens + (now - counted_at) * rate.refill_per_second)
+        wait = 0.0
+        if tokens >= 1:
+            tokens -= 1
+        else:
+            wait = (1 - tokens) / rate.refill_per_second
+        self._buckets[key] = (tokens, now)
+        self._buckets.move_to_end(key)
+        while len(self._buckets) > self.maxsize:
+            self._buckets.popitem(last=False)
+        return wait
+
+    def clear(self):
+        self._buckets.clear()
+
+
+class RateLimiter:
+    """
+    Checks the requests against the named rules of the RATE_LIMITS setting
+    """
+
+    def __init__(self, backend, rules: dict):
+        self.backend = backend
+        self.rules = {name: parse_rate(rate) for name, rate in rules.items()}
+
+    def check(self, rule: str, key) -> None:
+        """
+        Count a request, before any expensive work is done for it
+        :param rule: name of the rule, a rule missing from the settings is not limited
+        :param key: what the rule limits, a client address or an author
+        :return: nothing, or a 429 HTTPException with the seconds to wait in Retry-After
+        """
+        rate = self.rules.get(rule)
+        if self.backend is None or rate is None:
+            return
+        wait = self.backend.take(f"{rule}:{key}", rate)
+        if wait:
+            shed_requests.inc("rate_limit")
+            raise HTTPException(status_code=status.HTTP_429_TOO_MANY_REQUESTS, detail="Too many requests",
+                                headers={"Retry-After": str(math.ceil(wait))})
+
+    def clear(self):
+        if self.backend is not None:
+            self.backend.clear()
+
+
+def client_address(request: Request) -> str:
+    return request.client.host if request.client else "unknown"
+
+
+def create_rate_limiter(app_settings: Settings) -> RateLimiter:
+    """
+    Build the rate limiter of an app
+    :param app_settings: the settings of the app, RATE_LIMIT_* and RATE_LIMITS
+    :return: the limiter, with buckets of its own
+    """
+    if app_settings.RATE_LIMIT_BACKEND == "memory":
+        backend = MemoryRateLimitBackend(app_settings.RATE_LIMIT_MAX_KEYS)
+    elif app_settings.RATE_LIMIT_BACKEND == "none":
+        backend = None
+    else:
+        raise ValueError(f"Unknown rate limit backend: {app_settings.RATE_LIMIT_BACKEND}")
+    return RateLimiter(backend, app_settings.RATE_LIMITS)
+
+
+rate_limiter = create_rate_limiter(settings)
@@ -1,7 +1,7 @@
 """
 Schemas to secure the correct way of validation with pydantic
 """
-from typing import Union
+from typing import Optional, Union
 from pydantic import BaseModel
 
 
@@ -31,6 +31,15 @@ class Post(PostBase):
         orm_mode = True
 
 
+class BulkPostResult(BaseModel):
+    """
+    Outcome of one item of a bulk post creation, either the created post or the reason it failed
+    """
+    index: int
+    post: Optional[Post] = None
+    error: Optional[str] = None
+
+
 class AuthorBase(BaseModel):
     """
     Getting the info about the author
@@ -57,6 +66,43 @@ class Author(AuthorBase):
         orm_mode = True
 
 
+class AuthorIds(BaseModel):
+    """
+    Body of a batch lookup of authors
+    """
+    ids: list[int]
+
+
+class AuthorBatch(BaseModel):
+    """
+    The authors of a batch lookup, in the order of the requested ids, and the ids that don't exist
+    """
+    authors: list[Author]
+    missing: list[int]
+
+
+class AuthorSummary(AuthorBase):
+    """
+    An author with the number of their posts, read without touching the posts table
+    """
+    id: int
+    post_count: int
+
+    class Config:
+        orm_mode = True
+
+
+class Principal(AuthorBase):
+    """
+    The authenticated author, without the posts, as it is kept in the principal cache
+    """
+    id: int
+    is_active: bool
+
+    class Config:
+        orm_mode = True
+
+
 class Token(BaseModel):
     """
     Token handler with validation infos
@@ -1,6 +1,9 @@
 """
 Module made for security actions
 """
+import asyncio
+import os
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime, timedelta
 from jose import jwt
 from typing import Optional
@@ -31,6 +34,140 @@ def get_password_hash(password: str):
     return pwd_context.hash(password)
 
 
+class HashingPoolSaturated(Exception):
+    """
+    Raised when every worker of the hashing pool is busy and its queue is full
+    """
+
+
+class HashingPool:
+    """
+    Bounded pool running the bcrypt functions away from the event loop. bcrypt releases the GIL, so threads are enough
+    to use several cores, processes can be chosen to keep the hashing fully out of the server process.
+    """
+
+    def __init__(self, kind: str = "thread", max_workers: int = 1, max_queue: int = 0):
+        if kind not in ("thread", "process"):
+            raise ValueError(f"Unknown hashing pool kind: {kind}")
+        self.kind = kind
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        # Calls accepted at the same time, the ones above max_workers wait in the executor queue
+        self.capacity = max_workers + max_queue
+        self.in_flight = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self._executor: Optional[Executor] = None
+
+    @property
+    def executor(self) -> Executor:
+        """
+        The executor is only started on first use, so importing the module stays cheap
+        """
+        if self._executor is None:
+            executor_class = ThreadPoolExecutor if self.kind == "thread" else ProcessPoolExecutor
+            self._executor = executor_class(max_workers=self.max_workers)
+        return self._executor
+
+    async def run(self, function, *args):
+        """
+        Run a function in the pool
+        :param function: a module level function, so it can also be sent to a process
+        :param args: the function's arguments
+        :return: the function's result, or HashingPoolSaturated if the pool can't accept more calls
+        """
+        if self.in_flight >= self.capacity:
+            self.rejected += 1
+            raise HashingPoolSaturated()
+        loop = asyncio.get_running_loop()
+        self.in_flight += 1
+        try:
+            future = self.executor.submit(function, *args)
+        except BaseException:
+            self.in_flight -= 1
+            raise
+        # A cancelled caller doesn't stop a call already running, its slot is given back once the call is done
+        future.add_done_callback(lambda done: self._release_threadsafe(loop, done))
+        return await asyncio.wrap_future(future)
+
+    def _release_threadsafe(self, loop: asyncio.AbstractEventLoop, done: Future):
+        """
+        Give back the slot of a finished call, on the event loop that made it
+        :param loop: the loop of the caller
+        :param done: the finished call
+        """
+        try:
+            loop.call_soon_threadsafe(self._release, done)
+        except RuntimeError:
+            # The loop is closed, nothing else can use the counters
+            self._release(done)
+
+    def _release(self, done: Future):
+        self.in_flight -= 1
+        if done.cancelled():
+            return
+        if done.exception() is None:
+            self.completed += 1
+        else:
+            self.failed += 1
+
+    def stats(self) -> dict:
+        """
+        Saturation metrics of the pool
+        :return: dict with the pool size, current load and counters
+        """
+        return {
+            "kind": self.kind,
+            "workers": self.max_workers,
+            "max_queue": self.max_queue,
+            "running": min(self.in_flight, self.max_workers),
+            "queued": max(self.in_flight - self.max_workers, 0),
+            "saturation": self.in_flight / self.capacity if self.capacity else 1.0,
+            "completed_total": self.completed,
+            "failed_total": self.failed,
+            "rejected_total": self.rejected,
+        }
+
+    def forget_after_fork(self):
+        """
+        A forked child inherits the executor object but not its threads, it starts its own executor on first use
+        """
+        self._executor = None
+        self.in_flight = self.completed = self.failed = self.rejected = 0
+
+    def shutdown(self):
+        """
+        Stop the workers, the pool starts new ones if it is used again
+        """
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+
+hashing_pool = HashingPool(settings.HASHING_POOL_KIND, settings.HASHING_POOL_WORKERS, settings.HASHING_POOL_MAX_QUEUE)
+os.register_at_fork(after_in_child=hashing_pool.forget_after_fork)
+
+
+async def async_verify_password(plain_password: str, hashed_password: str):
+    """
+    verify_password, run in the hashing pool
+    :param plain_password: the given password
+    :param hashed_password: stored password in db
+    :return: bool
+    """
+    return await hashing_pool.run(verify_password, plain_password, hashed_password)
+
+
+async def async_get_password_hash(password: str):
+    """
+    get_password_hash, run in the hashing pool
+    :param password: given password
+    :return: hashed password
+    """
+    return await hashing_pool.run(get_password_hash, password)
+
+
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     """
     Function to create access JWT
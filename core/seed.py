@@ -0,0 +1,317 @@
+"""
+Generate a SQLite database of authors and posts for scale testing
+
+    python seed.py --database big.db --authors 100000 --posts 10000000 --shards 4
+
+The posts per author follow a power law (--skew, 0 for the same number for everyone) and are interleaved in time like
+real ones. Every author is author<id> with the same password, hashed with bcrypt only once. The rows are written with
+executemany in a database without its indexes, which are built at the end along with the full text index. With
+--shards N, N processes generate the posts of their chunks in parallel into their own files, merged at the end; the
+data only depends on --seed, not on the number of shards.
+
+A JSON manifest (<database>.json) describes the dataset, so the database can be reused as a fixture, e.g. by
+benchmark.py --fixture.
+"""
+import argparse
+import array
+import contextlib
+import functools
+import json
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import NamedTuple
+
+DEFAULT_PASSWORD = "password"
+# Posts generated from one random state, a shard generates whole chunks so the data doesn't depend on the shards
+CHUNK_SIZE = 10000
+# Number of phrases the titles and descriptions are picked from, a power of two
+PHRASE_BITS = 12
+PHRASES = 1 << PHRASE_BITS
+PHRASE_MASK = PHRASES - 1
+WORDS = (
+    "about after again air also animal answer area back base because before begin between big book both bring "
+    "build call came carry cause change city close cold come country course cover cross day deep different direction "
+    "does done down draw early earth east even every example fact family far farm father feel field figure find fire "
+    "first fish follow food force form found four free friend full game garden give good govern great green ground "
+    "group grow hand hard head hear heard help high hold home horse house hundred idea important island keep kind "
+    "land large last late learn leave letter life light line list little live long look machine main make many map "
+    "mark measure men might mile mind money moon more morning mother mountain move music name near need never next "
+    "night north note number object ocean often open order other page paper part pass people picture piece place "
+    "plain plan plant point port pose power press problem product pull question quick rain reach read real record "
+    "rest river road rock room round rule run school science sea second self sentence serve ship short show side "
+    "simple since sing size sleep slow small snow song sound south space special spell stand star start state stay "
+    "step still stood story street strong study such sun sure surface system table tail take talk teach tell test "
+    "thing thought through time together told took top toward town travel tree true turn under unit until usual "
+    "very voice vowel walk wall want warm watch water weight west wheel while white whole wind winter wonder wood "
+    "word work world write year young"
+).split()
+
+
+class Manifest(NamedTuple):
+    """
+    What a seeded database holds
+    """
+    authors: int
+    posts: int
+    password: str
+    skew: float
+    seed: int
+    revision: str
+
+
+def posts_per_author(authors: int, posts: int, skew: float, seed: int) -> list:
+    """
+    Split the posts between the authors along a power law: the author of rank r gets a share proportional to
+    1 / r ** skew, and the ranks are shuffled so the most active authors are spread over the ids
+    :param authors: number of authors
+    :param posts: number of posts
+    :param skew: exponent of the power law, 0 gives everyone the same number of posts
+    :param seed: seed of the shuffling
+    :return: number of posts of every author, by author id - 1; the counts add up to posts exactly
+    """
+    weights = [1 / rank ** skew for rank in range(1, authors + 1)]
+    total = sum(weights)
+    shares = [posts * weight / total for weight in weights]
+    counts = [int(share) for share in shares]
+    # Largest remainders first, until every post has an author
+    by_remainder = sorted(range(authors), key=lambda rank: counts[rank] - shares[rank])
+    for rank in by_remainder[:posts - sum(counts)]:
+        counts[rank] += 1
+    random.Random(seed).shuffle(counts)
+    return counts
+
+
+def post_owners(counts: list, seed: int) -> array.array:
+    """
+    Author id of every post, in id order: each author has its share of the posts, at random times
+    :param counts: number of posts of every author, from posts_per_author
+    :param seed: seed of the shuffling
+    :return: array of the owner ids, the owner of post id i is at index i - 1
+    """
+    owners = array.array("q")
+    for author_id, count in enumerate(counts, start=1):
+        owners.extend([author_id] * count)
+    random.Random(seed).shuffle(owners)
+    return owners
+
+
+@functools.lru_cache(maxsize=4)
+def phrases(seed: int) -> tuple:
+    """
+    Random phrases the posts' text is made of, drawing words for every post would make generating them the slowest
+    part of the seeding
+    :param seed: seed of the dataset
+    :return: tuple of PHRASES phrases of 1 to 20 words
+    """
+    rng = random.Random(seed)
+    return tuple(" ".join(rng.choices(WORDS, k=rng.randint(1, 20))) for _ in range(PHRASES))
+
+
+def generate_chunk(seed: int, first_id: int, owners) -> list:
+    """
+    Rows of the posts of a chunk
+    :param seed: seed of the dataset
+    :param first_id: id of the chunk's first post, a multiple of CHUNK_SIZE plus one
+    :param owners: owner ids of the chunk's posts
+    :return: list of (id, title, description, owner_id), the titles are unique through the post id they contain
+    """
+    rng = random.Random(seed * 1_000_003 + first_id // CHUNK_SIZE)
+    texts = phrases(seed)
+    rows = []
+    for post_id, owner_id in enumerate(owners, start=first_id):
+        picks = rng.getrandbits(3 * PHRASE_BITS)
+        title = texts[picks & PHRASE_MASK]
+        description = f"{texts[picks >> PHRASE_BITS & PHRASE_MASK]} {texts[picks >> 2 * PHRASE_BITS]}"
+        rows.append((post_id, f"post {post_id} {title}", description, owner_id))
+    return rows
+
+
+def _fast_load(connection: sqlite3.Connection):
+    # Nothing to recover if the process dies, the database is generated again
+    connection.execute("PRAGMA journal_mode = OFF")
+    connection.execute("PRAGMA synchronous = OFF")
+    connection.execute("PRAGMA cache_size = -262144")
+
+
+def insert_posts(connection: sqlite3.Connection, seed: int, first_id: int, owners):
+    """
+    Generate and insert the posts of consecutive chunks
+    :param connection: database with a posts table
+    :param seed: seed of the dataset
+    :param first_id: id of the first post, the first of a chunk
+    :param owners: owner ids of the posts
+    """
+    for start in range(0, len(owners), CHUNK_SIZE):
+        connection.executemany("INSERT INTO posts (id, title, description, owner_id) VALUES (?, ?, ?, ?)",
+                               generate_chunk(seed, first_id + start, owners[start:start + CHUNK_SIZE]))
+
+
+def generate_shard(path: str, seed: int, first_id: int, owners: bytes) -> str:
+    """
+    Write the posts of a shard to their own database, run in a worker process
+    :param path: file of the shard
+    :param seed: seed of the dataset
+    :param first_id: id of the shard's first post
+    :param owners: owner ids of the shard's posts, as the bytes of an array
+    :return: the path
+    """
+    shard_owners = array.array("q")
+    shard_owners.frombytes(owners)
+    with contextlib.closing(sqlite3.connect(path)) as connection:
+        _fast_load(connection)
+        connection.execute("CREATE TABLE posts (id INTEGER PRIMARY KEY, title, description, owner_id)")
+        insert_posts(connection, seed, first_id, shard_owners)
+        connection.commit()
+    return path
+
+
+def head_revision() -> str:
+    """
+    Latest alembic revision, the schema created from the models is the one of this revision
+    """
+    from alembic.config import Config
+    from alembic.script import ScriptDirectory
+
+    directory = os.path.dirname(os.path.abspath(__file__))
+    config = Config(os.path.join(directory, "alembic.ini"))
+    config.set_main_option("script_location", os.path.join(directory, "alembic"))
+    return ScriptDirectory.from_config(config).get_current_head()
+
+
+def create_schema(path: str):
+    """
+    Create the tables of the models, with the alembic revision they match
+    :param path: the SQLite file
+    """
+    # Imported here, the app's modules read their settings at import
+    from sqlalchemy import create_engine
+
+    import models
+
+    engine = create_engine(f"sqlite:///{path}")
+    models.Base.metadata.create_all(bind=engine)
+    engine.dispose()
+    with contextlib.closing(sqlite3.connect(path)) as connection:
+        connection.execute("CREATE TABLE alembic_version (version_num VARCHAR(32) NOT NULL PRIMARY KEY)")
+        connection.execute("INSERT INTO alembic_version VALUES (?)", (head_revision(),))
+        connection.commit()
+
+
+def seed_database(path: str, authors: int, posts: int, password: str = DEFAULT_PASSWORD, skew: float = 1.1,
+                  seed: int = 0, shards: int = 1) -> Manifest:
+    """
+    Create and fill a database, then write its manifest next to it
+    :param path: the SQLite file to create, it must not exist
+    :param authors: number of authors, author1..authorN
+    :param posts: number of posts
+    :param password: password of every author
+    :param skew: exponent of the power law of the posts per author
+    :param seed: seed of all the random choices
+    :param shards: processes generating the posts
+    :return: the manifest
+    """
+    from security import get_password_hash
+
+    if os.path.exists(path):
+        raise FileExistsError(path)
+    create_schema(path)
+    counts = posts_per_author(authors, posts, skew, seed)
+    owners = post_owners(counts, seed)
+    password_hash = get_password_hash(password)
+
+    with contextlib.closing(sqlite3.connect(path)) as connection:
+        _fast_load(connection)
+        # The indexes and triggers are dropped while loading, building an index at once is much faster than
+        # updating it row by row, and the full text index is rebuilt from the posts at the end
+        deferred = connection.execute("SELECT type, name, sql FROM sqlite_master "
+                                      "WHERE type IN ('index', 'trigger') AND sql IS NOT NULL").fetchall()
+        for kind, name, _ in deferred:
+            connection.execute(f"DROP {kind} {name}")
+
+        connection.executemany(
+            "INSERT INTO authors (id, username, password, is_active, post_count) VALUES (?, ?, ?, 1, ?)",
+            ((author_id, f"author{author_id}", password_hash, count) for author_id, count in enumerate(counts, 1)))
+        if shards <= 1:
+            insert_posts(connection, seed, 1, owners)
+        else:
+            connection.commit()
+            _merge_shards(connection, os.path.dirname(os.path.abspath(path)), seed, owners, shards)
+
+        for _, _, sql in deferred:
+            connection.execute(sql)
+        connection.execute("INSERT INTO posts_fts(posts_fts) VALUES ('rebuild')")
+        connection.execute("UPDATE table_versions SET version = 1")
+        connection.commit()
+        connection.execute("ANALYZE")
+        connection.execute("PRAGMA journal_mode = DELETE")
+
+    manifest = Manifest(authors, posts, password, skew, seed, head_revision())
+    with open(f"{path}.json", "w") as file:
+        json.dump(manifest._asdict(), file, indent=2)
+    return manifest
+
+
+def _merge_shards(connection: sqlite3.Connection, directory: str, seed: int, owners: array.array, shards: int):
+    """
+    Generate the posts in shard files in parallel, then copy them in id order
+    """
+    chunks = (len(owners) + CHUNK_SIZE - 1) // CHUNK_SIZE
+    bounds = [chunks * shard // shards * CHUNK_SIZE for shard in range(shards + 1)]
+    with tempfile.TemporaryDirectory(dir=directory) as shard_directory, ProcessPoolExecutor(shards) as executor:
+        futures = [executor.submit(generate_shard, os.path.join(shard_directory, f"shard{shard}.db"), seed,
+                                   bounds[shard] + 1, owners[bounds[shard]:bounds[shard + 1]].tobytes())
+                   for shard in range(shards)]
+        for future in futures:
+            connection.execute("ATTACH DATABASE ? AS shard", (future.result(),))
+            connection.execute("INSERT INTO posts (id, title, description, owner_id) "
+                               "SELECT id, title, description, owner_id FROM shard.posts ORDER BY id")
+            connection.commit()
+            connection.execute("DETACH DATABASE shard")
+
+
+def read_manifest(path: str) -> Manifest:
+    """
+    Manifest of a seeded database
+    :param path: the SQLite file
+    """
+    with open(f"{path}.json") as file:
+        return Manifest(**json.load(file))
+
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--database", required=True, help="SQLite file to create")
+    parser.add_argument("--authors", type=int, default=1000, help="number of authors")
+    parser.add_argument("--posts", type=int, default=100000, help="number of posts")
+    parser.add_argument("--skew", type=float, default=1.1,
+                        help="exponent of the power law of the posts per author, 0 for the same number for everyone")
+    parser.add_argument("--password", default=DEFAULT_PASSWORD, help="password of every author")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the generated data")
+    parser.add_argument("--shards", type=int, default=1, help="processes generating the posts")
+    parser.add_argument("--force", action="store_true", help="replace the database if it exists")
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> int:
+    arguments = parse_arguments(argv)
+    if arguments.force:
+        for path in (arguments.database, f"{arguments.database}.json"):
+            if os.path.exists(path):
+                os.remove(path)
+    # The app's modules are imported for the schema and the password hash, their settings must be readable
+    os.environ.setdefault("DATABASE_URL", f"sqlite:///{os.path.abspath(arguments.database)}")
+    start = time.perf_counter()
+    manifest = seed_database(arguments.database, arguments.authors, arguments.posts, arguments.password,
+                             arguments.skew, arguments.seed, arguments.shards)
+    print(f"{manifest.authors} authors and {manifest.posts} posts written to {arguments.database} in "
+          f"{time.perf_counter() - start:.1f} s", file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
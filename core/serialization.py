@@ -0,0 +1,36 @@
+"""
+Fast JSON encoding of the list endpoints, producing the same bytes as FastAPI's default JSONResponse
+"""
+import json
+from typing import Any
+
+from fastapi.responses import JSONResponse
+
+try:
+    import orjson
+except ImportError:  # orjson is optional, the standard library encoder is used without it
+    orjson = None
+
+
+def dumps(content: Any) -> bytes:
+    """
+    Encode plain data (dicts, lists, str, int, bool, None) exactly like JSONResponse.render does
+    :param content: the data to encode
+    :return: the UTF-8 JSON document
+    """
+    if orjson is not None:
+        try:
+            return orjson.dumps(content)
+        except orjson.JSONEncodeError:
+            # e.g. lone surrogates in a string, that the standard encoder accepts
+            pass
+    return json.dumps(content, ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":")).encode("utf-8")
+
+
+class FastJSONResponse(JSONResponse):
+    """
+    JSON response for content that is already plain data, so it is neither validated nor passed to jsonable_encoder
+    """
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
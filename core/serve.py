@@ -0,0 +1,198 @@
+"""
+Production runner: a supervisor process sharing one listening socket between several uvicorn workers
+
+    python serve.py
+
+It is configured by the SERVE_* settings. The supervisor answers to signals:
+    SIGTERM, SIGINT  stop the workers gracefully (they finish the requests in progress), then exit
+    SIGHUP           rolling reload: start a new worker, wait until it serves, then stop an old one, one by one
+    SIGTTIN, SIGTTOU add or remove a worker
+A worker that dies is replaced.
+"""
+import asyncio
+import logging
+import multiprocessing
+import signal
+import time
+from typing import NamedTuple
+
+import uvicorn
+
+from config.settings import Settings, settings
+
+# uvicorn configures this logger, the supervisor and the workers then log the same way
+logger = logging.getLogger("uvicorn.error")
+
+STOP_SIGNALS = (signal.SIGTERM, signal.SIGINT)
+SUPERVISOR_SIGNALS = STOP_SIGNALS + (signal.SIGHUP, signal.SIGTTIN, signal.SIGTTOU)
+# How often the supervisor checks for signals and dead workers, in seconds
+POLL_INTERVAL = 0.2
+
+
+def run_worker(config: uvicorn.Config, sockets: list, ready):
+    """
+    Serve the app on the supervisor's sockets
+    :param config: uvicorn config of the app
+    :param sockets: the listening sockets, shared by every worker
+    :param ready: event set once the app started (prewarmed) and accepts connections
+    """
+    # A forked worker inherits the supervisor's handlers, uvicorn then installs its own for SIGTERM and SIGINT
+    for signum in SUPERVISOR_SIGNALS:
+        signal.signal(signum, signal.SIG_DFL)
+    config.configure_logging()
+    config.setup_event_loop()
+    server = uvicorn.Server(config)
+
+    async def serve_and_notify():
+        serving = asyncio.create_task(server.serve(sockets=sockets))
+        while not server.started and not serving.done():
+            await asyncio.sleep(0.05)
+        ready.set()
+        await serving
+
+    asyncio.run(serve_and_notify())
+
+
+class Worker(NamedTuple):
+    process: multiprocessing.Process
+    ready: object
+
+
+class Supervisor:
+    """
+    Starts, replaces and stops the workers
+    """
+
+    def __init__(self, app_settings: Settings):
+        self.settings = app_settings
+        self.worker_count = max(app_settings.SERVE_WORKERS, 1)
+        if self.worker_count > 1 and not self.shares_response_cache():
+            raise ValueError("Every worker would have its own response cache and serve pages outdated by the writes "
+                             "of the others: use RESPONSE_CACHE_BACKEND=file or none to run several workers")
+        # Forked workers share the preloaded app with the supervisor, spawned ones import the code again
+        self.context = multiprocessing.get_context("fork" if app_settings.SERVE_PRELOAD else "spawn")
+        self.workers: list = []
+        self.config = None
+        self.sockets: list = []
+        self._signals: list = []
+
+    def _config(self) -> uvicorn.Config:
+        app = "main:app"
+        if self.settings.SERVE_PRELOAD:
+            # Importing the app does no I/O, so the forked workers don't share connections or threads
+            from main import app
+        return uvicorn.Config(app, host=self.settings.SERVE_HOST, port=self.settings.SERVE_PORT,
+                              workers=self.worker_count)
+
+    def _handle_signal(self, signum, frame):
+        self._signals.append(signum)
+
+    def spawn(self) -> Worker:
+        """
+        Start a worker
+        :return: the worker, its ready event is set once it serves
+        """
+        ready = self.context.Event()
+        process = self.context.Process(target=run_worker, args=(self.config, self.sockets, ready))
+        process.start()
+        logger.info("Started worker %s", process.pid)
+        return Worker(process, ready)
+
+    def stop(self, worker: Worker):
+        """
+        Stop a worker: it stops accepting connections and finishes the requests in progress, or is killed after
+        SERVE_GRACEFUL_TIMEOUT_SECONDS
+        :param worker: the worker to stop
+        """
+        worker.process.terminate()
+        worker.process.join(self.settings.SERVE_GRACEFUL_TIMEOUT_SECONDS)
+        if worker.process.is_alive():
+            logger.warning("Worker %s didn't stop in time, killing it", worker.process.pid)
+            worker.process.kill()
+            worker.process.join()
+        logger.info("Stopped worker %s", worker.process.pid)
+
+    def reload(self):
+        """
+        Replace the workers one by one, a new worker must serve before an old one is stopped
+        """
+        for old_worker in list(self.workers):
+            new_worker = self.spawn()
+            if not new_worker.ready.wait(self.settings.SERVE_GRACEFUL_TIMEOUT_SECONDS):
+                logger.error("Worker %s didn't start, the reload is cancelled", new_worker.process.pid)
+                self.stop(new_worker)
+                return
+            self.workers.append(new_worker)
+            self.workers.remove(old_worker)
+            self.stop(old_worker)
+
+    def shares_response_cache(self) -> bool:
+        """
+        Whether a write invalidates the cached responses of every worker
+        :return: False with the in-memory response cache of each worker
+        """
+        return self.settings.RESPONSE_CACHE_BACKEND != "memory"
+
+    def scale(self, delta: int):
+        """
+        Add or remove workers
+        :param delta: number of workers to add, or to remove when negative
+        """
+        if self.worker_count + delta > 1 and not self.shares_response_cache():
+            logger.error("Not adding a worker, RESPONSE_CACHE_BACKEND=memory allows only one")
+            return
+        self.worker_count = max(self.worker_count + delta, 1)
+        while len(self.workers) < self.worker_count:
+            self.workers.append(self.spawn())
+        while len(self.workers) > self.worker_count:
+            self.stop(self.workers.pop())
+        logger.info("Running %s workers", self.worker_count)
+
+    def replace_dead_workers(self):
+        for worker in list(self.workers):
+            if not worker.process.is_alive():
+                logger.warning("Worker %s exited with code %s, starting a new one", worker.process.pid,
+                               worker.process.exitcode)
+                self.workers.remove(worker)
+                self.workers.append(self.spawn())
+
+    def run(self):
+        """
+        Serve until a stop signal
+        """
+        self.config = self._config()
+        self.sockets = [self.config.bind_socket()]
+        for signum in SUPERVISOR_SIGNALS:
+            signal.signal(signum, self._handle_signal)
+        self.scale(0)
+        try:
+            while True:
+                while self._signals:
+                    signum = self._signals.pop(0)
+                    if signum in STOP_SIGNALS:
+                        return
+                    if signum == signal.SIGHUP:
+                        self.reload()
+                    else:
+                        self.scale(1 if signum == signal.SIGTTIN else -1)
+                self.replace_dead_workers()
+                time.sleep(POLL_INTERVAL)
+        finally:
+            for worker in self.workers:
+                worker.process.terminate()
+            for worker in self.workers:
+                self.stop(worker)
+            for sock in self.sockets:
+                sock.close()
+
+
+def serve(app_settings: Settings = settings):
+    """
+    Run the app with the SERVE_* settings
+    :param app_settings: the settings of the app
+    """
+    Supervisor(app_settings).run()
+
+
+if __name__ == '__main__':
+    serve()
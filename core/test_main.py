@@ -1,10 +1,1318 @@
-from fastapi.testclient import TestClient
-from main import app
+import asyncio
+import contextlib
+import gzip
+import json
+import os
+import random
+import sqlite3
+import subprocess
+import signal
+import socket
+import sys
+import threading
+import time
+import zlib
 
+import brotli
+import pytest
+from fastapi import HTTPException
+from fastapi.routing import APIRoute
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, event, func, select, text
+from sqlalchemy.exc import IntegrityError, OperationalError
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import sessionmaker
 
-client = TestClient(app)
+import benchmark
+import crud
+import database
+import instrumentation
+import models
+import schemas
+import seed
+import serve
+from batching import PostWriter
+from caching import CachedResponse, FileBackend, MemoryBackend, ResponseCache, TTLCache, principal_cache, response_cache
+from compression import StreamCompressor, choose_encoding
+from config.settings import Settings, settings
+from database import (async_database_url, create_replica_engine, database_url, engine_options, pool_status, read_router,
+                      tune_sqlite)
+from loaders import AuthorLoader
+import main
+from hotset import HotPosts, posts_json
+from main import app, create_app, post_event_stream
+from middlewares import AdmissionControlMiddleware
+from polling import post_poller
+from pubsub import Broker, post_broker, post_event
+from ratelimit import MemoryRateLimitBackend, parse_rate, rate_limiter
+from security import HashingPool, HashingPoolSaturated, hashing_pool
 
 
-def test_read_main():
+def test_read_main(client):
     response = client.get("/posts/?skip=0&limit=10")
     assert response.status_code == 200
+
+
+def test_create_author(client, author):
+    assert author["username"] == "greg"
+    assert author["posts"] == []
+    assert client.post("/authors/", json={"username": "greg", "password": "other"}).status_code == 400
+
+
+def test_create_and_read_post(client, author, auth_headers):
+    response = client.post(f"/author/{author['id']}/posts/", json={"title": "First", "description": "Hello"},
+                           headers=auth_headers)
+    assert response.status_code == 200
+    post = response.json()
+    assert post == {"title": "First", "description": "Hello", "id": post["id"], "owner_id": author["id"]}
+
+    assert client.get(f"/posts/{post['id']}").json() == post
+    assert client.get("/posts/").json() == [post]
+    assert client.get(f"/author/{author['id']}").json()["posts"] == [post]
+    assert client.get("/authors/").json()[0]["posts"] == [post]
+    assert "First" in client.get(f"/article/{post['id']}").text
+
+
+def test_missing_objects(client):
+    assert client.get("/posts/1").status_code == 404
+    assert client.get("/author/1").status_code == 404
+    assert client.get("/article/1").status_code == 404
+
+
+def seed_authors(client, count, posts_per_author):
+    """
+    Create authors with their posts through the API
+    """
+    for index in range(count):
+        author = client.post("/authors/", json={"username": f"author{index}", "password": "secret"}).json()
+        token = client.post("/token", data={"username": f"author{index}", "password": "secret"}).json()
+        headers = {"Authorization": f"Bearer {token['access_token']}"}
+        for post_index in range(posts_per_author):
+            client.post(f"/author/{author['id']}/posts/", json={"title": f"post {index}-{post_index}"},
+                        headers=headers)
+
+
+@pytest.mark.parametrize("limit", [3, 10])
+def test_read_authors_query_count(client, sql_statements, limit):
+    seed_authors(client, 10, 2)
+
+    sql_statements.clear()
+    authors = client.get(f"/authors/?limit={limit}").json()
+    assert len(authors) == limit
+    assert all(len(author["posts"]) == 2 for author in authors)
+    # The table versions of the ETag, one query for the page of authors and one batched query for all of their posts
+    assert len(sql_statements) == 3
+
+    sql_statements.clear()
+    authors = client.get(f"/authors/?limit={limit}&include_posts=false").json()
+    assert all(author["posts"] == [] for author in authors)
+    assert len(sql_statements) == 2
+
+
+def test_read_authors_batch(client, sql_statements):
+    seed_authors(client, 3, 2)
+
+    sql_statements.clear()
+    response = client.get("/authors/batch?ids=3,1,42,3,1")
+    assert response.status_code == 200
+    batch = response.json()
+    # Each id once, in the requested order
+    assert [author["id"] for author in batch["authors"]] == [3, 1]
+    assert all(len(author["posts"]) == 2 for author in batch["authors"])
+    assert batch["missing"] == [42]
+    # One IN query for the authors and one for their posts
+    assert len(sql_statements) == 2
+    assert " IN (" in sql_statements[0]
+
+    sql_statements.clear()
+    batch = client.post("/authors/batch?include_posts=false", json={"ids": [2, 7]}).json()
+    assert [author["posts"] for author in batch["authors"]] == [[]]
+    assert batch["missing"] == [7]
+    assert len(sql_statements) == 1
+
+    assert client.get("/authors/batch?ids=1,x").status_code == 400
+    assert client.post("/authors/batch", json={"ids": list(range(settings.MAX_BATCH_IDS + 1))}).status_code == 400
+
+
+def test_author_loader_fetches_an_id_once(db_engine, sql_statements):
+    async def scenario():
+        async with AsyncSession(db_engine) as db:
+            db.add(models.Authors(username="greg", password="hash"))
+            await db.commit()
+            loader = AuthorLoader(db)
+            sql_statements.clear()
+            authors = await loader.load_many([1, 2, 1])
+            assert [author and author.username for author in authors] == ["greg", None, "greg"]
+            assert (await loader.load(1)).username == "greg"
+            assert await loader.load(2) is None
+            # Only the first call queried (authors then posts), the rest came from the memo
+            assert len(sql_statements) == 2
+
+    asyncio.run(scenario())
+
+
+def test_read_author_query_count(client, sql_statements):
+    seed_authors(client, 2, 3)
+
+    sql_statements.clear()
+    assert len(client.get("/author/1").json()["posts"]) == 3
+    assert len(sql_statements) == 1
+
+
+def test_read_posts_cursor_pagination(client, sql_statements):
+    seed_authors(client, 1, 5)
+
+    response = client.get("/posts/?limit=2")
+    titles = [post["title"] for post in response.json()]
+    while "X-Next-Cursor" in response.headers:
+        sql_statements.clear()
+        response = client.get(f"/posts/?limit=2&cursor={response.headers['X-Next-Cursor']}")
+        titles += [post["title"] for post in response.json()]
+        # The page starts from the primary key index instead of skipping rows
+        assert "WHERE posts.id > ?" in sql_statements[-1]
+    assert titles == [f"post 0-{index}" for index in range(5)]
+    # The offset mode gives the same pages
+    assert [post["title"] for post in client.get("/posts/?skip=2&limit=2").json()] == titles[2:4]
+
+
+def test_read_authors_cursor_pagination(client):
+    seed_authors(client, 3, 0)
+
+    first_page = client.get("/authors/?limit=2")
+    second_page = client.get(f"/authors/?limit=2&cursor={first_page.headers['X-Next-Cursor']}")
+    assert [author["username"] for author in second_page.json()] == ["author2"]
+    assert "X-Next-Cursor" not in second_page.headers
+    assert client.get("/authors/?cursor=not-a-cursor").status_code == 400
+
+
+def test_hashing_pool_rejects_above_capacity():
+    release = threading.Event()
+    pool = HashingPool("thread", max_workers=1, max_queue=1)
+
+    async def scenario():
+        calls = [asyncio.ensure_future(pool.run(release.wait)) for _ in range(2)]
+        await asyncio.sleep(0.05)
+        assert pool.stats()["running"] == 1 and pool.stats()["queued"] == 1
+        with pytest.raises(HashingPoolSaturated):
+            await pool.run(release.wait)
+        release.set()
+        await asyncio.gather(*calls)
+
+    asyncio.run(scenario())
+    pool.shutdown()
+    assert pool.stats()["completed_total"] == 2
+    assert pool.stats()["rejected_total"] == 1
+
+
+def test_hashing_pool_keeps_the_slot_of_a_cancelled_call():
+    release = threading.Event()
+    pool = HashingPool("thread", max_workers=1, max_queue=0)
+
+    async def scenario():
+        call = asyncio.ensure_future(pool.run(release.wait))
+        await asyncio.sleep(0.05)
+        call.cancel()
+        await asyncio.sleep(0.05)
+        # The thread is still hashing, a new call would wait behind it
+        assert pool.stats()["running"] == 1
+        with pytest.raises(HashingPoolSaturated):
+            await pool.run(release.wait)
+        release.set()
+        await asyncio.sleep(0.05)
+        assert pool.stats()["running"] == 0
+        with pytest.raises(ZeroDivisionError):
+            await pool.run(divmod, 1, 0)
+
+    asyncio.run(scenario())
+    pool.shutdown()
+    assert (pool.stats()["completed_total"], pool.stats()["failed_total"]) == (1, 1)
+
+
+def test_saturated_hashing_pool_returns_503(client, monkeypatch):
+    monkeypatch.setattr(hashing_pool, "capacity", 0)
+    response = client.post("/authors/", json={"username": "greg", "password": "secret"})
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "1"
+    assert client.get("/status/hashing-pool").json()["rejected_total"] >= 1
+
+
+def test_token_bucket(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr("ratelimit.time.monotonic", lambda: now[0])
+    backend = MemoryRateLimitBackend(maxsize=1)
+    rate = parse_rate("2/minute")
+    assert backend.take("a", rate) == 0 and backend.take("a", rate) == 0
+    assert backend.take("a", rate) == pytest.approx(30)
+    now[0] += 30
+    assert backend.take("a", rate) == 0
+    # Past maxsize the oldest bucket is forgotten, so it starts full again
+    backend.take("b", rate)
+    assert backend.take("a", rate) == 0 and backend.take("a", rate) == 0
+
+
+@pytest.mark.parametrize("rate", ["0/minute", "-1/minute", "10/day"])
+def test_parse_rate_rejects(rate):
+    with pytest.raises(ValueError):
+        parse_rate(rate)
+
+
+def test_token_rate_limit_runs_before_bcrypt(client, author, monkeypatch):
+    monkeypatch.setitem(rate_limiter.rules, "token_user", parse_rate("2/minute"))
+    for _ in range(2):
+        assert client.post("/token", data={"username": "greg", "password": "wrong"}).status_code == 401
+    hashes = hashing_pool.completed
+    response = client.post("/token", data={"username": "greg", "password": "secret"})
+    assert response.status_code == 429
+    assert 0 < int(response.headers["Retry-After"]) <= 30
+    assert hashing_pool.completed == hashes
+    # Another username from the same address only counts against the address rule
+    assert client.post("/token", data={"username": "other", "password": "wrong"}).status_code == 401
+
+
+def test_write_rate_limit_per_author(client, auth_headers, monkeypatch):
+    monkeypatch.setitem(rate_limiter.rules, "create_post_user", parse_rate("1/hour"))
+    assert client.post("/author/1/posts/", json={"title": "first"}, headers=auth_headers).status_code == 200
+    assert client.post("/author/1/posts/", json={"title": "second"}, headers=auth_headers).status_code == 429
+    assert 'http_requests_shed_total{reason="rate_limit"}' in client.get("/metrics").text
+
+
+def test_admission_control_sheds_above_the_cap():
+    release = asyncio.Event()
+
+    async def slow_app(scope, receive, send):
+        await release.wait()
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        await send({"type": "http.response.body", "body": b""})
+
+    middleware = AdmissionControlMiddleware(slow_app, max_concurrent=1)
+
+    async def call(path):
+        messages = []
+
+        async def send(message):
+            messages.append(message)
+
+        await middleware({"type": "http", "path": path}, None, send)
+        return messages[0]
+
+    async def scenario():
+        first = asyncio.ensure_future(call("/posts/"))
+        await asyncio.sleep(0)
+        shed = await call("/posts/")
+        assert shed["status"] == 503 and (b"retry-after", b"1") in shed["headers"]
+        # Monitoring still goes through
+        status_call = asyncio.ensure_future(call("/status/db-pool"))
+        release.set()
+        assert (await first)["status"] == 200 and (await status_call)["status"] == 200
+        assert middleware.in_flight == 0
+
+    asyncio.run(scenario())
+
+
+def test_ttl_cache():
+    cache = TTLCache(maxsize=2, ttl=60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")
+    cache.set("c", 3)
+    # "b" was the least recently used entry
+    assert (cache.get("a"), cache.get("b"), cache.get("c")) == (1, None, 3)
+    cache.set("a", 1, ttl=0)
+    assert cache.get("a") is None
+    cache.delete("c")
+    assert len(cache) == 0
+
+
+def test_authenticated_write_skips_author_query(client, author, auth_headers, sql_statements):
+    client.post(f"/author/{author['id']}/posts/", json={"title": "First"}, headers=auth_headers)
+    assert principal_cache.get("greg").id == author["id"]
+
+    sql_statements.clear()
+    response = client.post(f"/author/{author['id']}/posts/", json={"title": "Second"}, headers=auth_headers)
+    assert response.status_code == 200
+    assert not any("FROM authors" in statement for statement in sql_statements)
+
+
+def test_principal_cache_invalidated_on_author_write(client):
+    principal_cache.set("greg", "stale principal")
+    client.post("/authors/", json={"username": "greg", "password": "secret"})
+    assert principal_cache.get("greg") is None
+
+
+@pytest.mark.parametrize("path", ["/posts/1", "/article/1", "/author/1"])
+def test_response_cache_and_etag(client, sql_statements, path):
+    seed_authors(client, 1, 1)
+    # Reads pinned to the primary after the writes skip the cache
+    client.cookies.clear()
+
+    first = client.get(path)
+    sql_statements.clear()
+    second = client.get(path)
+    assert second.content == first.content
+    assert sql_statements == []
+
+    not_modified = client.get(path, headers={"If-None-Match": first.headers["ETag"]})
+    assert not_modified.status_code == 304
+    assert not_modified.content == b""
+    assert client.get(path, headers={"If-None-Match": '"stale"'}).status_code == 200
+
+
+def test_response_cache_skips_renders_older_than_invalidation():
+    cache = ResponseCache(MemoryBackend(10, 60), max_generations=1)
+    cached = CachedResponse(b"{}", "application/json", '"etag"')
+    generation = cache.generation("post", 1)
+    # A write lands while the response is rendered
+    cache.invalidate("post", 1)
+    cache.set("post", 1, "", cached, generation)
+    assert cache.get("post", 1, "") is None
+    cache.set("post", 1, "", cached, cache.generation("post", 1))
+    assert cache.get("post", 1, "") == cached
+
+    generation = cache.generation("post", 3)
+    cache.invalidate("post", 3)
+    # Forgotten, but still newer than the render
+    cache.invalidate("post", 4)
+    cache.set("post", 3, "", cached, generation)
+    assert cache.get("post", 3, "") is None
+
+
+def test_response_cache_invalidated_on_new_post(client, author, auth_headers):
+    assert client.get(f"/author/{author['id']}").json()["posts"] == []
+    client.post(f"/author/{author['id']}/posts/", json={"title": "First"}, headers=auth_headers)
+    assert len(client.get(f"/author/{author['id']}").json()["posts"]) == 1
+
+
+def test_file_response_cache_backend(tmp_path):
+    directory = tmp_path / "cache"
+    first_process, second_process = ResponseCache(FileBackend(directory, 60)), ResponseCache(FileBackend(directory, 60))
+    # Created on first use
+    assert not directory.exists()
+    cached = CachedResponse(b'{"id": 1}', "application/json", '"etag"', {"gzip": gzip.compress(b'{"id": 1}')})
+    first_process.set("post", 1, "", cached)
+    assert directory.stat().st_mode & 0o777 == 0o700
+    first_process.set("post", 1, "other", cached._replace(body=b"other", encodings={}, expires_at=time.time() + 60))
+    assert second_process.get("post", 1, "") == cached
+    assert second_process.get("post", 1, "other").body == b"other"
+    assert second_process.get("post", 1, "other").expires_at > time.time()
+    second_process.invalidate("post", 1)
+    assert first_process.get("post", 1, "") is None
+
+    # A file that isn't an entry is a miss
+    first_process.backend._path("post:2").write_bytes(b"\x80\x04garbage")
+    assert first_process.get("post", 2, "") is None
+
+    shared = tmp_path / "shared"
+    shared.mkdir(mode=0o777)
+    shared.chmod(0o777)
+    shared_backend = FileBackend(shared, 60)
+    with pytest.raises(RuntimeError):
+        shared_backend.get("post:1")
+
+
+def test_create_posts_bulk(client, author, auth_headers, monkeypatch):
+    monkeypatch.setattr(settings, "BULK_INSERT_CHUNK_SIZE", 2)
+    client.post(f"/author/{author['id']}/posts/", json={"title": "Existing"}, headers=auth_headers)
+    posts = [{"title": "One"}, {"title": "Existing"}, {"title": "Two", "description": "2"}, {"title": "One"},
+             {"description": "no title"}]
+
+    response = client.post(f"/author/{author['id']}/posts/bulk", json=posts, headers=auth_headers)
+    assert response.status_code == 200
+    results = response.json()
+    assert [result["index"] for result in results] == [0, 1, 2, 3, 4]
+    assert results[0]["post"]["title"] == "One" and results[2]["post"]["description"] == "2"
+    assert results[1]["error"] == "Title already exists"
+    assert results[3]["error"] == "Title already exists"
+    assert results[4]["error"].startswith("Invalid post")
+    assert len(client.get(f"/author/{author['id']}").json()["posts"]) == 3
+
+
+def test_create_posts_bulk_ndjson(client, author, auth_headers):
+    body = "\n".join(json.dumps({"title": f"post {index}"}) for index in range(20)) + "\nnot json\n"
+    response = client.post(f"/author/{author['id']}/posts/bulk", data=body,
+                           headers={**auth_headers, "Content-Type": "application/x-ndjson"})
+    results = response.json()
+    assert [result["post"]["title"] for result in results[:20]] == [f"post {index}" for index in range(20)]
+    assert results[20]["error"].startswith("Invalid post")
+    assert client.post(f"/author/{author['id'] + 1}/posts/bulk", json=[], headers=auth_headers).status_code == 401
+
+
+def test_create_posts_bulk_limits_and_errors(client, author, auth_headers, monkeypatch):
+    monkeypatch.setattr(settings, "MAX_BULK_POSTS", 2)
+    url = f"/author/{author['id']}/posts/bulk"
+    posts = [{"title": f"post {index}"} for index in range(3)]
+    assert client.post(url, json=posts, headers=auth_headers).status_code == 413
+    assert client.get(f"/author/{author['id']}").json()["posts"] == []
+
+    # The JSON array is decoded while it is received
+    body = (part for part in [b'[{"title": "post 0"}, {"tit', b'le": "post 1"}', b']'])
+    response = client.post(url, data=body, headers={**auth_headers, "Content-Type": "application/json"})
+    assert [result["post"]["title"] for result in response.json()] == ["post 0", "post 1"]
+    for body in ('{"title": "post"}', '[{"title": "post 2"},]', '[{"title": "post 2"}] []'):
+        response = client.post(url, data=body, headers={**auth_headers, "Content-Type": "application/json"})
+        assert response.status_code == 400
+
+
+def test_create_posts_one_by_one_reports_conflicts(db_engine):
+    TestingSessionLocal = sessionmaker(db_engine, class_=AsyncSession, expire_on_commit=False)
+
+    async def scenario():
+        async with TestingSessionLocal() as db:
+            posts = [(0, schemas.PostCreate(title="Same")), (1, schemas.PostCreate(title="Same")),
+                     (2, schemas.PostCreate(title="Other"))]
+            return await crud._create_author_posts_one_by_one(db, posts, author_id=1)
+
+    results = asyncio.run(scenario())
+    assert [result.error for result in results] == [None, "Title already exists", None]
+    assert results[2].post.title == "Other"
+
+
+def test_create_posts_one_by_one_is_all_or_nothing(db_engine, monkeypatch):
+    TestingSessionLocal = sessionmaker(db_engine, class_=AsyncSession, expire_on_commit=False)
+    monkeypatch.setattr(crud, "_count_posts", lambda author_id, created: text("UPDATE missing SET post_count = 1"))
+
+    async def scenario():
+        async with TestingSessionLocal() as db:
+            posts = [(0, schemas.PostCreate(title="One")), (1, schemas.PostCreate(title="Two"))]
+            with pytest.raises(OperationalError):
+                await crud._create_author_posts_one_by_one(db, posts, author_id=1)
+        async with TestingSessionLocal() as db:
+            return (await db.execute(select(func.count()).select_from(models.Posts))).scalar()
+
+    # The counter failed, so none of the posts of the chunk were kept
+    assert asyncio.run(scenario()) == 0
+
+
+def test_post_writer_group_commit(db_engine):
+    session_factory = sessionmaker(db_engine, class_=AsyncSession, expire_on_commit=False)
+    writer = PostWriter(session_factory, batch_size=10, window_seconds=0.05, queue_size=100)
+
+    async def scenario():
+        async with session_factory() as db:
+            db.add_all([models.Authors(username=username, password="hash") for username in ("greg", "bob")])
+            await db.commit()
+        titles = [f"post {index}" for index in range(24)] + ["post 0"]
+        results = await asyncio.gather(*(writer.create(schemas.PostCreate(title=title), index % 2 + 1)
+                                         for index, title in enumerate(titles)), return_exceptions=True)
+        await writer.stop()
+        async with session_factory() as db:
+            post_counts = (await db.execute(select(models.Authors.post_count).order_by(models.Authors.id))).scalars()
+            return results, list(post_counts)
+
+    results, post_counts = asyncio.run(scenario())
+    # Every caller got its own post, the duplicate title only failed its own creation
+    assert [result.title for result in results[:24]] == [f"post {index}" for index in range(24)]
+    assert isinstance(results[24], IntegrityError)
+    assert writer.batches == 3 and writer.written == 24
+    assert post_counts == [12, 12]
+
+
+def test_post_writer_batch_is_one_transaction(db_engine, sqlite_statements):
+    session_factory = sessionmaker(db_engine, class_=AsyncSession, expire_on_commit=False)
+
+    async def scenario():
+        async with session_factory() as db:
+            db.add(models.Authors(username="greg", password="hash"))
+            await db.commit()
+        sqlite_statements.clear()
+        async with session_factory() as db:
+            posts = [(schemas.PostCreate(title=title), 1) for title in ("One", "Two", "One")]
+            return await crud.create_posts_of_authors(db, posts)
+
+    results = asyncio.run(scenario())
+    assert isinstance(results[2], IntegrityError)
+    keywords = [statement.split()[0] for statement in sqlite_statements]
+    # The savepoints are inside the transaction, the counters are committed with the posts
+    assert keywords[0] == "BEGIN" and keywords.count("BEGIN") == 1 and keywords.count("COMMIT") == 1
+    assert keywords.index("COMMIT") > max(index for index, keyword in enumerate(keywords) if keyword == "UPDATE")
+
+
+def test_create_post_with_group_commit(client, auth_headers, monkeypatch):
+    monkeypatch.setattr(settings, "POST_WRITE_BATCHING", True)
+    response = client.post("/author/1/posts/", json={"title": "batched"}, headers=auth_headers)
+    assert response.status_code == 200
+    assert response.json()["title"] == "batched" and response.json()["owner_id"] == 1
+    assert client.get("/author/1").json()["posts"][0]["title"] == "batched"
+
+
+def test_post_broker_bounded_buffers():
+    broker = Broker(buffer_size=2)
+
+    async def scenario():
+        with broker.subscribe() as slow, broker.subscribe() as fast:
+            for post_id in (1, 2):
+                broker.publish(post_event({"id": post_id}))
+            assert [(await fast.get(1)).id for _ in range(2)] == [1, 2]
+            broker.publish(post_event({"id": 3}))
+            # The slow subscriber's full buffer is dropped instead of growing, it catches up from where it stopped
+            assert await slow.get(1) is None
+            assert slow.take_missed() == 0
+            assert (await fast.get(1)).id == 3
+            assert await fast.get(0.01) is None
+            broker.publish(post_event({"id": 4}))
+            assert (await slow.get(1)).frame == b'id: 4\nevent: post\ndata: {"id":4}\n\n'
+        return broker.stats()
+
+    assert asyncio.run(scenario()) == {"subscribers": 0, "published_total": 4, "overflows_total": 1}
+
+
+def test_stream_new_posts(client, author, auth_headers, monkeypatch):
+    monkeypatch.setattr(settings, "POST_STREAM_BACKFILL_PAGE_SIZE", 2)
+    monkeypatch.setattr(post_poller, "interval", 0.1)
+    for title in ("first", "second", "third"):
+        client.post(f"/author/{author['id']}/posts/", json={"title": title}, headers=auth_headers)
+
+    async def create_post(title):
+        async with database.AsyncSessionLocal() as db:
+            await crud.create_author_post(db, schemas.PostCreate(title=title), author["id"])
+
+    async def scenario():
+        messages = []
+        receive_disconnect = asyncio.Event()
+
+        async def receive():
+            await receive_disconnect.wait()
+            return {"type": "http.disconnect"}
+
+        async def send(message):
+            messages.append(message)
+
+        scope = {"type": "http", "method": "GET", "path": "/posts/stream", "raw_path": b"/posts/stream",
+                 "root_path": "", "scheme": "http", "query_string": b"", "server": ("localhost", 80),
+                 "client": ("127.0.0.1", 1234), "http_version": "1.1", "asgi": {"version": "3.0"},
+                 "headers": [(b"host", b"localhost"), (b"last-event-id", b"1"), (b"accept-encoding", b"gzip")]}
+        stream = asyncio.create_task(app(scope, receive, send))
+
+        async def frames(count):
+            while b"".join(message.get("body", b"") for message in messages).count(b"\n\n") < count:
+                await asyncio.sleep(0.01)
+
+        # The posts after the Last-Event-ID come first, then the new ones live
+        await asyncio.wait_for(frames(2), 5)
+        await create_post("live")
+        await asyncio.wait_for(frames(3), 5)
+        # A post written by another worker is read from the database by the poller, right away when the next local
+        # post shows the gap
+        polls = post_poller.polls
+        async with database.AsyncSessionLocal() as db:
+            db.add(models.Posts(title="other worker", owner_id=author["id"]))
+            await db.execute(crud._bump_versions("posts"))
+            await db.commit()
+        await create_post("after the gap")
+        await asyncio.wait_for(frames(5), 5)
+        # Or on its own within an interval
+        async with database.AsyncSessionLocal() as db:
+            db.add(models.Posts(title="quiet worker", owner_id=author["id"]))
+            await db.execute(crud._bump_versions("posts"))
+            await db.commit()
+        await asyncio.wait_for(frames(6), 5)
+        assert post_poller.polls > polls
+        receive_disconnect.set()
+        await asyncio.wait_for(stream, 5)
+        return messages
+
+    messages = asyncio.run(scenario())
+    headers = dict(messages[0]["headers"])
+    assert headers[b"content-type"].startswith(b"text/event-stream")
+    assert b"content-encoding" not in headers
+    body = b"".join(message.get("body", b"") for message in messages).decode()
+    events = [dict(line.split(": ", 1) for line in frame.splitlines()) for frame in body.split("\n\n") if frame]
+    assert [event["id"] for event in events] == ["2", "3", "4", "5", "6", "7"]
+    assert json.loads(events[2]["data"]) == {"title": "live", "description": None, "id": 4, "owner_id": author["id"]}
+    assert len(post_broker) == 0
+
+
+def test_post_stream_slots_reserved_by_the_handler(client, monkeypatch):
+    monkeypatch.setattr(settings, "POST_STREAM_MAX_SUBSCRIBERS", 1)
+
+    async def scenario():
+        # Two connections at once: the second is refused before the first stream started
+        first = await main.stream_new_posts(None, settings)
+        with pytest.raises(HTTPException) as refused:
+            await main.stream_new_posts(None, settings)
+        assert refused.value.status_code == 503
+        # Closed by the background task even if the stream never started
+        await first.background()
+        assert len(post_broker) == 0
+        await post_poller.stop()
+
+    asyncio.run(scenario())
+
+
+def test_post_stream_catches_up_after_an_overflow(client, author, monkeypatch):
+    monkeypatch.setattr(post_broker, "buffer_size", 1)
+    overflows = post_broker.overflows
+
+    async def scenario():
+        stream = post_event_stream(post_broker.open(), None, settings)
+        first = asyncio.create_task(anext(stream))
+        await asyncio.sleep(0.05)
+        async with database.AsyncSessionLocal() as db:
+            posts = [(schemas.PostCreate(title=f"post {index}"), author["id"]) for index in range(3)]
+            await crud.create_posts_of_authors(db, posts)
+        # Published at once, they overflow the buffer of one event and are read back from the database
+        frames = [await first] + [await anext(stream) for _ in range(2)]
+        await stream.aclose()
+        return frames
+
+    frames = asyncio.run(scenario())
+    assert [frame.split(b"\n")[0] for frame in frames] == [b"id: 1", b"id: 2", b"id: 3"]
+    assert post_broker.overflows == overflows + 1
+
+
+def test_hot_posts_index(client, author, auth_headers, tmp_path):
+    for index in range(3):
+        client.post(f"/author/{author['id']}/posts/", json={"title": f"post {index}", "description": "é"},
+                    headers=auth_headers)
+    index = HotPosts(max_posts=4)
+    snapshot_path = str(tmp_path / "hot.snapshot")
+
+    async def scenario():
+        async with database.AsyncSessionLocal() as db:
+            await index.load(db, snapshot_path)
+            assert index.complete and len(index) == 3 and not index.from_snapshot
+            first = await index.get(db, 1)
+            missing = await index.get(db, 99)
+            pages = [await index.page(db, 1, 5, None), await index.page(db, 0, 2, 1)]
+            # A page past the end reads the posts written since, whichever process wrote them
+            for title in ("post 3", "post 4", "post 5"):
+                await crud.create_author_post(db, schemas.PostCreate(title=title), author["id"])
+            newest = await index.page(db, 0, 10, 4)
+            # Past 5 posts the oldest ones are evicted, the index then only serves the pages after its first id
+            assert len(index) == 4 and not index.complete
+            with pytest.raises(LookupError):
+                await index.get(db, 1)
+            assert await index.page(db, 0, 2, None) is None
+            index.save(snapshot_path)
+
+            restarted = HotPosts(max_posts=4)
+            await restarted.load(db, snapshot_path)
+            snapshot_page = await restarted.page(db, 0, 10, 2)
+
+            # A snapshot whose first and last posts match but missing one in between isn't used
+            forged = HotPosts(max_posts=4)
+            forged.loaded = True
+            forged._append([row for row in await crud.get_posts_rows(db, limit=10, after_id=2) if row["id"] != 4])
+            forged.save(snapshot_path)
+            reloaded = HotPosts(max_posts=4)
+            await reloaded.load(db, snapshot_path)
+            assert not reloaded.from_snapshot and len(reloaded) == 4
+
+            # Nor is one in a directory others can write to, where it isn't written either
+            shared = tmp_path / "shared"
+            shared.mkdir()
+            shared.chmod(0o777)
+            restarted.save(str(shared / "hot.snapshot"))
+            assert not (shared / "hot.snapshot").exists()
+            restarted.save(snapshot_path)
+            os.replace(snapshot_path, shared / "hot.snapshot")
+            reloaded = HotPosts(max_posts=4)
+            await reloaded.load(db, str(shared / "hot.snapshot"))
+            assert not reloaded.from_snapshot
+            return first, missing, pages, newest, restarted, snapshot_page
+
+    first, missing, pages, newest, restarted, snapshot_page = asyncio.run(scenario())
+    assert first.body == client.get("/posts/1").content
+    assert missing is None
+    assert [[post.id for post in page] for page in pages] == [[2, 3], [2, 3]]
+    assert [post.id for post in newest] == [5, 6]
+    assert restarted.from_snapshot
+    assert posts_json(snapshot_page) == client.get("/posts/?cursor=aWQ6Mg&limit=10").content
+
+
+def test_hot_posts_routes(client, author, auth_headers, monkeypatch, sql_statements):
+    for index in range(3):
+        client.post(f"/author/{author['id']}/posts/", json={"title": f"post {index}"}, headers=auth_headers)
+    expected = [client.get("/posts/").content, client.get("/posts/2").content]
+    monkeypatch.setattr(main, "hot_posts", HotPosts(max_posts=10))
+    response_cache.clear()
+    asyncio.run(main.load_hot_posts(""))
+
+    sql_statements.clear()
+    page = client.get("/posts/")
+    # Only the table versions of the ETag are read
+    assert len(sql_statements) == 1
+    assert [page.content, client.get("/posts/2").content] == expected
+    assert client.get("/posts/4").status_code == 404
+    assert main.hot_posts.stats()["hits_total"] == 3
+    # A new post changes the version of the table, the next page looks for it
+    client.post(f"/author/{author['id']}/posts/", json={"title": "post 3"}, headers=auth_headers)
+    assert [post["title"] for post in client.get("/posts/").json()] == [f"post {index}" for index in range(4)]
+
+
+def test_export_posts(client, author, auth_headers):
+    posts = [{"title": f"post {index}", "description": "é"} for index in range(5)]
+    client.post(f"/author/{author['id']}/posts/bulk", json=posts, headers=auth_headers)
+    expected = client.get("/posts/?limit=100").json()
+
+    response = client.get("/posts/export")
+    assert response.headers["content-type"] == "application/x-ndjson"
+    assert [json.loads(line) for line in response.text.splitlines()] == expected
+    # The JSON export is the same document as the list endpoint
+    assert client.get("/posts/export?format=json").content == client.get("/posts/?limit=100").content
+    assert client.get(f"/posts/export?format=json&owner_id={author['id'] + 1}").json() == []
+
+
+def test_sqlite_tuning_and_pool_configuration(tmp_path):
+    url = f"sqlite:///{tmp_path / 'tuned.db'}"
+    tuned_engine = create_engine(url, **engine_options(url, is_async=False))
+    tune_sqlite(tuned_engine)
+    with tuned_engine.connect() as connection:
+        assert connection.exec_driver_sql("PRAGMA journal_mode").scalar() == "wal"
+        assert connection.exec_driver_sql("PRAGMA synchronous").scalar() == 1
+        assert connection.exec_driver_sql("PRAGMA busy_timeout").scalar() == settings.SQLITE_BUSY_TIMEOUT_MS
+        status = pool_status(tuned_engine)
+        assert (status["size"], status["checked_out"]) == (settings.DB_POOL_SIZE, 1)
+    assert async_database_url(url) == f"sqlite+aiosqlite:///{tmp_path / 'tuned.db'}"
+
+
+def test_database_urls_name_the_drivers():
+    for url in ("sqlite:///app.db", "sqlite+aiosqlite:///app.db"):
+        assert database_url(url, is_async=False) == "sqlite+pysqlite:///app.db"
+        assert database_url(url, is_async=True) == "sqlite+aiosqlite:///app.db"
+    for url in ("postgresql://user@db/app", "mysql://user@db/app"):
+        with pytest.raises(ValueError):
+            database_url(url, is_async=True)
+
+
+def test_read_db_pool_status(client):
+    assert client.get("/status/db-pool").json()["pool_class"] == "AsyncAdaptedQueuePool"
+
+
+@pytest.fixture
+def replicas(db_engine, tmp_path):
+    """
+    Two replica files holding a copy of the test database, that won't see the later writes
+    """
+    def make_replicas():
+        replica_engines = []
+        with sqlite3.connect(db_engine.url.database) as primary:
+            for index in range(2):
+                with sqlite3.connect(tmp_path / f"replica{index}.db") as replica:
+                    primary.backup(replica)
+                replica_engines.append(create_replica_engine(f"sqlite:///{tmp_path / f'replica{index}.db'}"))
+        read_router.set_replicas([sessionmaker(replica_engine, class_=AsyncSession, expire_on_commit=False)
+                                  for replica_engine in replica_engines])
+        return replica_engines
+
+    yield make_replicas
+    read_router.set_replicas([])
+
+
+def test_read_replica_routing(client, author, auth_headers, replicas, sql_statements):
+    client.post(f"/author/{author['id']}/posts/", json={"title": "Replicated"}, headers=auth_headers)
+    replica_engines = replicas()
+    replica_statements = [[], []]
+    for replica_engine, statements in zip(replica_engines, replica_statements):
+        event.listen(replica_engine.sync_engine, "before_cursor_execute",
+                     lambda *args, statements=statements: statements.append(args[2]))
+    client.post(f"/author/{author['id']}/posts/", json={"title": "Not replicated yet"}, headers=auth_headers)
+
+    # Right after its write, the client reads its own post from the primary
+    assert len(client.get("/posts/").json()) == 2
+    assert replica_statements == [[], []]
+
+    client.cookies.clear()
+    sql_statements.clear()
+    for _ in range(2):
+        assert [post["title"] for post in client.get("/posts/").json()] == ["Replicated"]
+    # One read (and its table versions) on each replica in turn, none on the primary
+    assert [len(statements) for statements in replica_statements] == [2, 2]
+    assert sql_statements == []
+
+
+def test_read_your_writes_skip_response_cache(client, author, auth_headers, replicas, monkeypatch):
+    replicas()
+    created = client.post(f"/author/{author['id']}/posts/", json={"title": "Not replicated yet"}, headers=auth_headers)
+    pinned_until = created.cookies[main.READ_PRIMARY_COOKIE]
+
+    # Another client reads from a replica that didn't see the post yet, what it got is only cached until the
+    # replicas caught up
+    client.cookies.clear()
+    assert client.get(f"/author/{author['id']}").json()["posts"] == []
+    replica_entry = response_cache.get("author", author["id"], "http://localhost/?")
+    assert replica_entry.expires_at == pytest.approx(time.time() + settings.READ_YOUR_WRITES_SECONDS, abs=1)
+
+    # The client that wrote skips the cache
+    client.cookies.set(main.READ_PRIMARY_COOKIE, pinned_until)
+    assert [post["title"] for post in client.get(f"/author/{author['id']}").json()["posts"]] == ["Not replicated yet"]
+    assert response_cache.get("author", author["id"], "http://localhost/?") == replica_entry
+
+    now = time.time()
+    monkeypatch.setattr("caching.time.time", lambda: now + settings.READ_YOUR_WRITES_SECONDS + 1)
+    assert response_cache.get("author", author["id"], "http://localhost/?") is None
+
+    # A failed write doesn't pin the reads
+    client.cookies.clear()
+    failed = client.post("/authors/", json={"username": "greg", "password": "secret"})
+    assert failed.status_code == 400
+    assert main.READ_PRIMARY_COOKIE not in failed.cookies
+
+
+def test_search_posts(client, author, auth_headers):
+    posts = [{"title": "Cooking pasta", "description": "Boil the pasta, then more pasta"},
+             {"title": "Gardening", "description": "Tomatoes grow next to the pasta shop"},
+             {"title": "Pasta night", "description": None},
+             {"title": "Unrelated", "description": "Nothing to see"}]
+    client.post(f"/author/{author['id']}/posts/bulk", json=posts, headers=auth_headers)
+
+    titles = [post["title"] for post in client.get("/posts/search?q=pasta").json()]
+    assert sorted(titles) == ["Cooking pasta", "Gardening", "Pasta night"]
+    assert titles[0] == "Cooking pasta"
+    assert [post["title"] for post in client.get("/posts/search?q=PASTA tomatoes").json()] == ["Gardening"]
+    assert len(client.get("/posts/search?q=pasta&skip=1&limit=1").json()) == 1
+    # FTS5 syntax in the searched text is not interpreted
+    assert client.get('/posts/search?q=pasta" OR NEAR(').status_code == 200
+    assert client.get("/posts/search?q=?!").json() == []
+
+
+def test_full_text_search_migration(tmp_path):
+    database_url = f"sqlite:///{tmp_path / 'migrated.db'}"
+    environment = {**os.environ, "DATABASE_URL": database_url}
+    alembic = [sys.executable, "-m", "alembic", "upgrade"]
+    subprocess.run(alembic + ["bfca5b75fec9"], env=environment, check=True, capture_output=True)
+    with sqlite3.connect(tmp_path / "migrated.db") as connection:
+        connection.execute("INSERT INTO posts (title, description) VALUES ('Old post', 'written before')")
+
+    subprocess.run(alembic + ["head"], env=environment, check=True, capture_output=True)
+    with sqlite3.connect(tmp_path / "migrated.db") as connection:
+        connection.execute("INSERT INTO posts (title, description) VALUES ('New post', 'written after')")
+        search = "SELECT rowid FROM posts_fts WHERE posts_fts MATCH ? ORDER BY rowid"
+        assert connection.execute(search, ["written"]).fetchall() == [(1,), (2,)]
+
+
+def test_post_count_migration(tmp_path):
+    database_url = f"sqlite:///{tmp_path / 'migrated.db'}"
+    environment = {**os.environ, "DATABASE_URL": database_url}
+    alembic = [sys.executable, "-m", "alembic", "upgrade"]
+    subprocess.run(alembic + ["4c1d2a7e9b3f"], env=environment, check=True, capture_output=True)
+    with sqlite3.connect(tmp_path / "migrated.db") as connection:
+        connection.executemany("INSERT INTO authors (username) VALUES (?)", [("greg",), ("ann",)])
+        connection.executemany("INSERT INTO posts (title, owner_id) VALUES (?, 1)", [("One",), ("Two",)])
+
+    subprocess.run(alembic + ["head"], env=environment, check=True, capture_output=True)
+    with sqlite3.connect(tmp_path / "migrated.db") as connection:
+        assert connection.execute("SELECT post_count FROM authors ORDER BY id").fetchall() == [(2,), (0,)]
+        assert connection.execute("SELECT name FROM table_versions ORDER BY name").fetchall() == [("authors",),
+                                                                                                 ("posts",)]
+
+
+def test_article_precompressed_variants(client, author, auth_headers):
+    post = client.post(f"/author/{author['id']}/posts/", json={"title": "Long", "description": "words " * 500},
+                       headers=auth_headers).json()
+
+    compressed = client.get(f"/article/{post['id']}", headers={"Accept-Encoding": "gzip"})
+    assert compressed.headers["Content-Encoding"] == "gzip"
+    assert compressed.headers["Cache-Control"] == f"public, max-age={settings.ARTICLE_CACHE_MAX_AGE_SECONDS}"
+    assert compressed.headers["Vary"] == "Accept-Encoding"
+    assert "words words" in compressed.text
+
+    identity = client.get(f"/article/{post['id']}", headers={"Accept-Encoding": "identity"})
+    assert "Content-Encoding" not in identity.headers
+    assert identity.text == compressed.text
+    assert identity.headers["ETag"] != compressed.headers["ETag"]
+
+    not_modified = client.get(f"/article/{post['id']}", headers={"If-None-Match": compressed.headers["ETag"],
+                                                                 "Accept-Encoding": "identity"})
+    assert not_modified.status_code == 304
+    bytecode_directory = main.get_templates().env.bytecode_cache.directory
+    assert os.listdir(bytecode_directory)
+    assert os.stat(bytecode_directory).st_mode & 0o077 == 0
+
+
+def test_choose_encoding():
+    assert choose_encoding("gzip, deflate, br", {"gzip": b"", "br": b""}) == "br"
+    assert choose_encoding("gzip;q=1.0, br;q=0.5", {"gzip": b"", "br": b""}) == "gzip"
+    assert choose_encoding("*", {"gzip": b""}) == "gzip"
+    assert choose_encoding("gzip;q=0, identity", {"gzip": b""}) is None
+    assert choose_encoding("", {"gzip": b""}) is None
+
+
+def test_list_etag_answers_without_the_query(client, author, auth_headers, sql_statements):
+    client.post(f"/author/{author['id']}/posts/", json={"title": "First"}, headers=auth_headers)
+    first = client.get("/posts/")
+    assert first.headers["ETag"].startswith('W/"')
+
+    sql_statements.clear()
+    not_modified = client.get("/posts/", headers={"If-None-Match": first.headers["ETag"]})
+    assert not_modified.status_code == 304
+    assert not_modified.headers["ETag"] == first.headers["ETag"]
+    assert len(sql_statements) == 1 and "table_versions" in sql_statements[0]
+    # Another page has another ETag
+    assert client.get("/posts/?limit=1").headers["ETag"] != first.headers["ETag"]
+
+    authors_etag = client.get("/authors/").headers["ETag"]
+    summary_etag = client.get("/authors/summary").headers["ETag"]
+    client.post(f"/author/{author['id']}/posts/", json={"title": "Second"}, headers=auth_headers)
+    # Every write of the read tables changes the ETags
+    assert client.get("/posts/", headers={"If-None-Match": first.headers["ETag"]}).status_code == 200
+    assert client.get("/authors/", headers={"If-None-Match": authors_etag}).status_code == 200
+    assert client.get("/authors/summary", headers={"If-None-Match": summary_etag}).status_code == 200
+
+
+def test_list_pages_without_table_versions(client, author, auth_headers, db_engine):
+    client.post(f"/author/{author['id']}/posts/", json={"title": "First"}, headers=auth_headers)
+
+    async def drop_table_versions():
+        async with db_engine.begin() as connection:
+            await connection.exec_driver_sql("DROP TABLE table_versions")
+
+    # A database not migrated to the table versions yet
+    asyncio.run(drop_table_versions())
+    for path in ("/posts/", "/authors/", "/authors/summary"):
+        response = client.get(path)
+        assert response.status_code == 200 and "ETag" not in response.headers
+    assert client.get("/posts/").json()[0]["title"] == "First"
+
+
+def test_list_compression(client, author, auth_headers):
+    posts = [{"title": f"post {index}", "description": "words " * 20} for index in range(10)]
+    client.post(f"/author/{author['id']}/posts/bulk", json=posts, headers=auth_headers)
+
+    identity = client.get("/authors/", headers={"Accept-Encoding": "identity"})
+    compressed = client.get("/authors/", headers={"Accept-Encoding": "gzip"})
+    assert "Content-Encoding" not in identity.headers
+    assert compressed.headers["Content-Encoding"] == "gzip"
+    assert compressed.headers["Vary"] == "Accept-Encoding"
+    assert int(compressed.headers["Content-Length"]) < len(identity.content) / 4
+    assert compressed.json() == identity.json()
+    # The weak ETag holds for both encodings
+    assert compressed.headers["ETag"] == identity.headers["ETag"]
+
+    # Under the minimum size, the body is sent as it is
+    small = client.get("/authors/summary", headers={"Accept-Encoding": "gzip"})
+    assert "Content-Encoding" not in small.headers
+
+    # A streamed body is compressed chunk by chunk
+    export = client.get("/posts/export", headers={"Accept-Encoding": "gzip"})
+    assert export.headers["Content-Encoding"] == "gzip"
+    assert [json.loads(line)["title"] for line in export.text.splitlines()] == [post["title"] for post in posts]
+
+
+def test_stream_compressor():
+    compressor = StreamCompressor("gzip")
+    chunks = [compressor.compress(b"first chunk " * 10, final=False), compressor.compress(b"last", final=True)]
+    # Every chunk is flushed, so the client can decode it before the next one comes
+    assert zlib.decompressobj(31).decompress(chunks[0]) == b"first chunk " * 10
+    assert gzip.decompress(b"".join(chunks)) == b"first chunk " * 10 + b"last"
+
+
+def test_brotli_responses(client, author, auth_headers):
+    compressor = StreamCompressor("br")
+    decompressor = brotli.Decompressor()
+    assert decompressor.process(compressor.compress(b"first chunk " * 10, final=False)) == b"first chunk " * 10
+    assert decompressor.process(compressor.compress(b"last", final=True)) == b"last"
+
+    posts = [{"title": f"post {index}", "description": "words " * 100} for index in range(10)]
+    client.post(f"/author/{author['id']}/posts/bulk", json=posts, headers=auth_headers)
+    identity = client.get("/posts/", headers={"Accept-Encoding": "identity"})
+    # Precompressed cache variant, compressed list page and compressed stream
+    for path, expected in [("/article/1", client.get("/article/1", headers={"Accept-Encoding": "identity"}).content),
+                           ("/posts/", identity.content), ("/posts/export", None)]:
+        response = client.get(path, headers={"Accept-Encoding": "gzip, br"}, stream=True)
+        assert response.headers["Content-Encoding"] == "br"
+        body = brotli.decompress(response.raw.read(decode_content=False))
+        if expected is not None:
+            assert body == expected
+        else:
+            assert [json.loads(line)["title"] for line in body.splitlines()] == [post["title"] for post in posts]
+
+
+GOLDEN_POSTS = (
+    '[{"title":"Première","description":"naïve \\"quoted\\" \\n line","id":1,"owner_id":1},'
+    '{"title":"No description","description":null,"id":2,"owner_id":1}]'
+).encode()
+GOLDEN_AUTHORS = (
+    '[{"username":"greg","id":1,"is_active":true,"posts":' + GOLDEN_POSTS.decode() + '},'
+    '{"username":"other","id":2,"is_active":true,"posts":[]}]'
+).encode()
+
+
+@pytest.mark.parametrize("fast_serialization", [False, True])
+def test_list_serialization_golden(client, author, auth_headers, monkeypatch, fast_serialization):
+    posts = [{"title": "Première", "description": 'naïve "quoted" \n line'}, {"title": "No description"}]
+    client.post(f"/author/{author['id']}/posts/bulk", json=posts, headers=auth_headers)
+    client.post("/authors/", json={"username": "other", "password": "secret"})
+    monkeypatch.setattr(settings, "FAST_SERIALIZATION", fast_serialization)
+
+    assert client.get("/posts/?limit=100").content == GOLDEN_POSTS
+    assert client.get("/authors/").content == GOLDEN_AUTHORS
+    assert client.get("/authors/?include_posts=false").json()[0]["posts"] == []
+    first_page = client.get("/posts/?limit=1")
+    assert client.get(f"/posts/?limit=1&cursor={first_page.headers['X-Next-Cursor']}").json()[0]["id"] == 2
+
+
+def test_read_authors_summary(client, author, auth_headers, sql_statements):
+    client.post(f"/author/{author['id']}/posts/", json={"title": "Single"}, headers=auth_headers)
+    posts = [{"title": "Bulk 1"}, {"title": "Bulk 2"}, {"title": "Single"}]
+    client.post(f"/author/{author['id']}/posts/bulk", json=posts, headers=auth_headers)
+    client.post("/authors/", json={"username": "other", "password": "secret"})
+
+    sql_statements.clear()
+    response = client.get("/authors/summary")
+    assert response.json() == [{"username": "greg", "id": author["id"], "post_count": 3},
+                               {"username": "other", "id": author["id"] + 1, "post_count": 0}]
+    assert len(sql_statements) == 2 and "posts" not in sql_statements[-1]
+    assert client.get("/authors/summary?limit=1").headers["X-Next-Cursor"]
+
+
+def test_request_metrics(client, monkeypatch):
+    seed_authors(client, 1, 3)
+    monkeypatch.setattr(settings, "SLOW_QUERY_THRESHOLD_MS", 0)
+    slow_statements = instrumentation.slow_statements.value()
+    requests = instrumentation.request_statements.count("GET", "/author/{author_id}")
+
+    response = client.get("/author/1")
+    assert float(response.headers["X-Process-Time"]) > 0
+    assert instrumentation.request_statements.count("GET", "/author/{author_id}") == requests + 1
+    assert instrumentation.slow_statements.value() > slow_statements
+    assert instrumentation.request_duration.count("GET", "/nowhere", "404") == 0
+    client.get("/nowhere")
+
+    metrics = client.get("/metrics")
+    assert metrics.headers["content-type"].startswith("text/plain; version=0.0.4")
+    # The routes are labelled by template, the paths nothing matched are grouped
+    assert 'http_request_duration_seconds_count{method="GET",route="/author/{author_id}",status="200"}' in metrics.text
+    assert 'route="unmatched",status="404"' in metrics.text
+    assert 'http_request_db_statements_bucket{method="GET",route="/author/{author_id}",le="1"}' in metrics.text
+    assert "db_slow_statements_total " in metrics.text
+    assert 'hashing_pool{field="saturation"}' in metrics.text
+
+
+def test_profile_request(client, monkeypatch):
+    assert "cumulative" not in client.get("/posts/?__profile=1").text
+    monkeypatch.setattr(settings, "PROFILING_ENABLED", True)
+    response = client.get("/posts/?__profile=1")
+    assert response.status_code == 200
+    assert "Ordered by: cumulative time" in response.text
+
+
+# Seconds importing main may take, a worker can't serve before
+IMPORT_TIME_BUDGET_SECONDS = 1.0
+
+
+def test_import_main_is_cheap(tmp_path):
+    database_path = tmp_path / "untouched.db"
+    script = ("import sys, time\n"
+              "start = time.perf_counter()\n"
+              "import main\n"
+              "print(time.perf_counter() - start)\n"
+              "print(sorted({'jinja2', 'uvicorn', 'alembic'} & set(sys.modules)))\n")
+    cache_path = tmp_path / "cache"
+    environment = {**os.environ, "DATABASE_URL": f"sqlite:///{database_path}", "RESPONSE_CACHE_BACKEND": "file",
+                   "RESPONSE_CACHE_DIR": str(cache_path)}
+    import_times = []
+    for _ in range(3):
+        result = subprocess.run([sys.executable, "-c", script], env=environment, capture_output=True, text=True,
+                                check=True, cwd=os.path.dirname(__file__))
+        import_time, lazy_modules = result.stdout.splitlines()
+        import_times.append(float(import_time))
+        assert lazy_modules == "[]"
+    # Nothing touched the database, the schema is alembic's job, nor the cache directory
+    assert not database_path.exists() and not cache_path.exists()
+    assert min(import_times) < IMPORT_TIME_BUDGET_SECONDS
+
+
+def test_create_app(client):
+    app = create_app(Settings())
+    assert app.state.settings.ALLOWED_HOSTS == ["127.0.0.1", "localhost", "192.100.1.50"]
+    assert {route.path for route in app.routes} == {route.path for route in client.app.routes}
+
+
+def test_cors_exposes_the_paging_headers(client):
+    response = client.get("/posts/", headers={"Origin": "http://localhost:8080"})
+    exposed = {header.strip() for header in response.headers["Access-Control-Expose-Headers"].split(",")}
+    assert {"X-Next-Cursor", "ETag"} <= exposed
+
+
+def test_create_app_settings_reach_the_routes(client, author, auth_headers, sql_statements):
+    app_settings = Settings()
+    app_settings.MAX_BATCH_IDS = 1
+    app_settings.RATE_LIMITS = {"create_author_ip": "1/hour"}
+    app_settings.READ_YOUR_WRITES_SECONDS = 7
+    app_settings.POST_STREAM_MAX_SUBSCRIBERS = 0
+    app_settings.POST_STREAM_HEARTBEAT_SECONDS = 0.05
+    app_settings.POST_STREAM_BACKFILL_PAGE_SIZE = 1
+    custom_client = TestClient(create_app(app_settings), base_url="http://localhost")
+
+    assert client.get("/authors/batch?ids=1,2").status_code == 200
+    assert custom_client.get("/authors/batch?ids=1,2").status_code == 400
+    response = custom_client.post("/authors/", json={"username": "ann", "password": "secret"})
+    assert response.status_code == 200
+    assert "Max-Age=7" in response.headers["set-cookie"]
+    assert custom_client.post("/authors/", json={"username": "bob", "password": "secret"}).status_code == 429
+    # The app of the module settings keeps its own rules
+    assert client.post("/authors/", json={"username": "bob", "password": "secret"}).status_code == 200
+
+    refused = custom_client.get("/posts/stream")
+    assert refused.status_code == 503 and refused.headers["Retry-After"] == "0"
+    for index in range(2):
+        client.post(f"/author/{author['id']}/posts/", json={"title": f"post {index}"}, headers=auth_headers)
+
+    async def stream_frames():
+        stream = post_event_stream(post_broker.open(), 0, app_settings)
+        frames = [await asyncio.wait_for(anext(stream), 1) for _ in range(3)]
+        await stream.aclose()
+        return frames
+
+    sql_statements.clear()
+    frames = asyncio.run(stream_frames())
+    assert [frame.split(b"\n")[0] for frame in frames] == [b"id: 1", b"id: 2", b": keep-alive"]
+    # The missed posts were read one per page
+    assert len([statement for statement in sql_statements if "FROM posts" in statement]) == 3
+
+
+def test_fork_forgets_connections_and_threads(client):
+    with database.engine.connect():
+        pass
+    assert database.engine.pool.checkedin() == 1
+    asyncio.run(hashing_pool.run(int))
+    assert hashing_pool.completed > 0
+
+    pid = os.fork()
+    if pid == 0:
+        # The child reports through its exit code
+        os._exit(0 if database.engine.pool.checkedin() == 0 and hashing_pool._executor is None
+                 and hashing_pool.completed == 0 else 1)
+    _, exit_status = os.waitpid(pid, 0)
+    assert os.waitstatus_to_exitcode(exit_status) == 0
+    # The parent keeps its connection
+    assert database.engine.pool.checkedin() == 1
+
+
+def worker_pids(supervisor_pid: int) -> set:
+    """
+    The pids of the uvicorn workers started by serve.py
+    """
+    pids = set()
+    for pid in filter(str.isdigit, os.listdir("/proc")):
+        try:
+            with open(f"/proc/{pid}/stat") as stat_file:
+                parent_pid = int(stat_file.read().rsplit(")", 1)[1].split()[1])
+            with open(f"/proc/{pid}/cmdline", "rb") as cmdline_file:
+                is_worker = b"spawn_main" in cmdline_file.read()
+        except OSError:
+            continue
+        if parent_pid == supervisor_pid and is_worker:
+            pids.add(int(pid))
+    return pids
+
+
+def wait_for(condition, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.1)
+
+
+def test_serve_scales_and_reloads(tmp_path):
+    database_path = tmp_path / "serve.db"
+    create_all_engine = create_engine(f"sqlite:///{database_path}")
+    models.Base.metadata.create_all(bind=create_all_engine)
+    create_all_engine.dispose()
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
+    environment = {**os.environ, "DATABASE_URL": f"sqlite:///{database_path}", "SERVE_PORT": str(port),
+                   "SERVE_WORKERS": "2", "SERVE_GRACEFUL_TIMEOUT_SECONDS": "10", "RESPONSE_CACHE_BACKEND": "file",
+                   "RESPONSE_CACHE_DIR": str(tmp_path / "cache")}
+    server = subprocess.Popen([sys.executable, "serve.py"], env=environment, cwd=os.path.dirname(__file__),
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    client = benchmark.HTTPClient(port)
+
+    def pool_status_answer():
+        try:
+            return asyncio.run(client.request("GET", "/status/db-pool"))
+        except OSError:
+            return None
+
+    try:
+        wait_for(lambda: len(worker_pids(server.pid)) == 2 and pool_status_answer())
+        status_code, body = pool_status_answer()
+        # The workers opened their pooled connections before their first request
+        assert status_code == 200 and json.loads(body)["checked_in"] == settings.DB_POOL_SIZE
+
+        server.send_signal(signal.SIGTTIN)
+        wait_for(lambda: len(worker_pids(server.pid)) == 3)
+        server.send_signal(signal.SIGTTOU)
+        wait_for(lambda: len(worker_pids(server.pid)) == 2)
+
+        old_workers = worker_pids(server.pid)
+        server.send_signal(signal.SIGHUP)
+        wait_for(lambda: len(worker_pids(server.pid)) == 2 and not worker_pids(server.pid) & old_workers)
+        assert pool_status_answer()[0] == 200
+
+        server.send_signal(signal.SIGTERM)
+        assert server.wait(30) == 0
+    finally:
+        server.kill()
+
+
+def test_serve_refuses_workers_with_their_own_response_cache():
+    serve_settings = Settings()
+    serve_settings.SERVE_WORKERS = 2
+    serve_settings.RESPONSE_CACHE_BACKEND = "memory"
+    with pytest.raises(ValueError):
+        serve.Supervisor(serve_settings)
+
+    serve_settings.SERVE_WORKERS = 1
+    supervisor = serve.Supervisor(serve_settings)
+    supervisor.scale(1)
+    assert supervisor.worker_count == 1 and not supervisor.workers
+
+
+def test_benchmark_covers_every_route():
+    dataset = benchmark.Dataset(authors=1, posts=1, tokens={1: "token"})
+    scenarios = benchmark.build_scenarios(dataset, random.Random(0), run_id="test")
+    covered = {(scenario.method, scenario.route) for scenario in scenarios}
+    routes = {(method, route.path) for route in app.routes if isinstance(route, APIRoute) for method in route.methods}
+    assert routes - benchmark.ENDLESS_ROUTES <= covered
+
+
+def test_benchmark_run(tmp_path):
+    output = tmp_path / "results.json"
+    command = [sys.executable, "benchmark.py", "--authors", "2", "--posts-per-author", "2", "--requests", "4",
+               "--concurrency", "2", "--only", "read_posts", "create_post", "--output", str(output)]
+    subprocess.run(command, check=True, capture_output=True)
+    results = json.loads(output.read_text())
+    assert results["meta"]["posts"] == 4
+    assert set(results["results"]) == {"read_posts", "create_post"}
+    assert results["results"]["read_posts"]["errors"] == 0
+    assert results["results"]["read_posts"]["queries_per_request"] == 2
+
+    slower = {"results": {"read_posts": {**results["results"]["read_posts"], "p95_ms": 1e6}}}
+    assert len(benchmark.regressions(slower, results, max_regression=0.25)) == 1
+    assert benchmark.regressions(results, results, max_regression=0.25) == []
+
+
+def test_seed_database(tmp_path):
+    path = str(tmp_path / "seeded.db")
+    manifest = seed.seed_database(path, authors=30, posts=seed.CHUNK_SIZE * 2 + 500, password="secret", seed=1)
+    assert seed.read_manifest(path) == manifest
+    with contextlib.closing(sqlite3.connect(path)) as connection:
+        counts = [count for count, in connection.execute("SELECT post_count FROM authors ORDER BY id")]
+        assert len(counts) == 30 and sum(counts) == manifest.posts
+        # Power law: the most active author wrote many times the average
+        assert max(counts) > 5 * manifest.posts / 30
+        assert connection.execute("SELECT owner_id, count(*) FROM posts GROUP BY owner_id ORDER BY owner_id"
+                                  ).fetchall() == [(index, count) for index, count in enumerate(counts, 1) if count]
+        assert connection.execute("SELECT count(DISTINCT title) FROM posts").fetchone() == (manifest.posts,)
+        assert connection.execute("SELECT rowid FROM posts_fts WHERE posts_fts MATCH '\"post 12345\"'"
+                                  ).fetchall() == [(12345,)]
+        assert connection.execute("SELECT version_num FROM alembic_version").fetchone() == (seed.head_revision(),)
+        posts = connection.execute("SELECT * FROM posts ORDER BY id").fetchall()
+
+    # Same data whatever the number of shards
+    sharded_path = str(tmp_path / "sharded.db")
+    seed.seed_database(sharded_path, authors=30, posts=manifest.posts, password="secret", seed=1, shards=2)
+    with contextlib.closing(sqlite3.connect(sharded_path)) as connection:
+        assert connection.execute("SELECT * FROM posts ORDER BY id").fetchall() == posts
+    with pytest.raises(FileExistsError):
+        seed.seed_database(path, authors=1, posts=1)
+
+    output = tmp_path / "results.json"
+    command = [sys.executable, "benchmark.py", "--fixture", path, "--requests", "4", "--concurrency", "2",
+               "--only", "login", "search_posts", "--output", str(output)]
+    subprocess.run(command, check=True, capture_output=True)
+    results = json.loads(output.read_text())
+    assert (results["meta"]["authors"], results["meta"]["posts"]) == (30, manifest.posts)
+    assert results["results"]["login"]["errors"] == results["results"]["search_posts"]["errors"] == 0